@@ -1,10 +1,25 @@
 import os
 import struct
 import codecs
+import datetime
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
 
 from simpledbf import Dbf5
 from simpledbf.simpledbf import DbfBase
 
+from fluxsus.dbc import DBCStream
+
+# Check for optional dependencies.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
 
 # -- copy from simpledbf library excluded assertion error --
 class DBFIX(DbfBase):
@@ -22,20 +37,31 @@ class DBFIX(DbfBase):
     ----------
 
     dbf : string
-        The name (with optional path) of the DBF file.
+        The name (with optional path) of the DBF file. Files with extension
+        '.dbc' (DATASUS compressed DBF) are decompressed on the fly while 
+        records are read, without an intermediate DBF file.
 
     codec : string, optional
         The codec to use when decoding text-based records. The default is
         'utf-8'. See Python's `codec` standard lib module for other options.
 
+    columns : list, optional
+        Names of the columns to read. Only the bytes of these columns (and
+        of the deletion flag) are touched and decoded. Default 'None', which
+        reads all columns.
+
     Attributes
     ----------
 
     dbf : string
         The input file name.
 
+    path : string
+        The input file name with its path.
+
     f : file object
-        The opened DBF file object
+        The opened DBF file object. For '.dbc' files, a stream of the
+        decompressed records (see `fluxsus.dbc.DBCStream`).
 
     numrec : int
         The number of records contained in this file.
@@ -49,19 +75,32 @@ class DBFIX(DbfBase):
     fields : list of tuples
         Column descriptions as a tuple: (Name, Type, # of bytes).
 
+    decimals : dict
+        Number of decimal places declared for each column.
+
     columns : list
-        The names of the data columns.
+        The names of the data columns to read, in file order.
 
     fmt : string
         The format string that is used to unpack each record from the file.
 
     fmtsiz : int
         The size of each record in bytes.
+
+    dtype : numpy.dtype
+        Structured dtype describing one record, with one fixed-width bytes
+        field per column (including the deletion flag).
+
+    offsets : dict
+        Byte offset of each field within a record.
     '''
-    def __init__(self, dbf, codec='utf-8'):
+    def __init__(self, dbf, codec='utf-8', columns=None):
         self._enc = codec
         path, name = os.path.split(dbf)
         self.dbf = name
+        self.path = dbf
+        # DATASUS compressed files: uncompressed header, compressed records
+        self.compressed = os.path.splitext(name)[1].lower() == '.dbc'
         # Escape quotes, set by indiviual runners
         self._esc = None
         # Reading as binary so bytes will always be returned
@@ -73,11 +112,13 @@ class DBFIX(DbfBase):
 
         # The first field is always a one byte deletion flag
         fields = [('DeletionFlag', 'C', 1),]
+        self.decimals = {'DeletionFlag': 0}
         for fieldno in range(self.numfields):
-            name, typ, size = struct.unpack('<11sc4xB15x', self.f.read(32))
+            name, typ, size, decimals = struct.unpack('<11sc4xBB14x', self.f.read(32))
             # eliminate NUL bytes from name string  
             name = name.strip(b'\x00')        
             fields.append((name.decode(self._enc), typ.decode(self._enc), size))
+            self.decimals[fields[-1][0]] = decimals
         self.fields = fields
         # Get the names only for DataFrame generation, skip delete flag
         self.columns = [f[0] for f in self.fields[1:]]
@@ -90,6 +131,461 @@ class DBFIX(DbfBase):
         self.fmt = ''.join(['{:d}s'.format(fieldinfo[2]) for 
                             fieldinfo in self.fields])
         self.fmtsiz = struct.calcsize(self.fmt)
+        # Same layout as a NumPy structured dtype, used by the vectorized
+        # decoder to view a block of records without unpacking them one by one
+        self.dtype = np.dtype([(name, 'S{:d}'.format(size)) for 
+                               name, typ, size in self.fields])
+        # Bytes below this value decode to the code point of same value
+        self._bulk_decodable = _identity_range(self._enc)
+
+        self.offsets = {}
+        offset = 0
+        for name, typ, size in self.fields:
+            self.offsets[name] = offset
+            offset += size
+
+        # Column projection, the deletion flag is always kept
+        if columns is not None:
+            unknown = [col for col in columns if col not in self.offsets]
+            if unknown:
+                err = 'Columns {} not found in "{}".'
+                raise ValueError(err.format(unknown, self.dbf))
+            self.columns = [col for col in self.columns if col in columns]
+        self._read_fields = [field for field in self.fields 
+                             if field[0] == 'DeletionFlag' or field[0] in self.columns]
+
+        # Map the record area with a dtype holding only the projected fields
+        # at their offsets, with the full record size as stride
+        self._view_dtype = np.dtype({
+            'names': [field[0] for field in self._read_fields],
+            'formats': ['S{:d}'.format(field[2]) for field in self._read_fields],
+            'offsets': [self.offsets[field[0]] for field in self._read_fields],
+            'itemsize': self.fmtsiz,
+        })
+        if self.compressed:
+            self.f = DBCStream(self.f, self.lenheader)
+        self._records = self._map_records()
+        self._pos = 0
+        self._keep_codes = False
+
+    def to_dataframe(self, chunksize=None, na='nan', n_jobs=None):
+        '''Return the DBF contents as a DataFrame.
+
+        Same interface as `DbfBase.to_dataframe`, but records are read as a
+        block into a NumPy structured array and decoded column by column
+        instead of record by record.
+
+        Parameters
+        ----------
+        chunksize : int, optional
+            Maximum number of records to process at any given time. If 'None'
+            (default), process all records.
+
+        na : various types accepted, optional
+            Value used to replace missing or malformed entries of text and
+            boolean columns. Numeric columns always use float('nan') and date
+            columns use NaT.
+
+        n_jobs : int, optional
+            Number of processes used to decode the file when chunksize is 
+            'None'. The record area is split into `n_jobs` contiguous byte
+            ranges decoded in parallel and concatenated in order. Default 
+            'None', which decodes in the current process. Ignored for '.dbc'
+            files, whose records can only be decompressed in order.
+
+        Returns
+        -------
+        DataFrame (chunksize == None)
+            The DBF contents as a Pandas DataFrame.
+
+        Generator (chunksize != None)
+            This generator returns DataFrames with the maximum number of
+            records equal to chunksize. (May be less)
+        '''
+        self._na_set(na)
+        if not chunksize:
+            if n_jobs is not None and n_jobs > 1 and not self.compressed:
+                return self._decode_parallel(n_jobs, na)
+            return self._decode_block(self._read_block(self.numrec))
+        else:
+            return self._df_chunks(chunksize)
+
+    def _decode_parallel(self, n_jobs, na):
+        '''Decode the remaining records in `n_jobs` processes.
+
+        See `to_dataframe`.
+        '''
+        # Records have a fixed width, so each range starts at a known byte
+        bounds = np.linspace(self._pos, self._records.shape[0], n_jobs+1).astype(int)
+        ranges = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) 
+                  if stop > start]
+        self._pos = self._records.shape[0]
+        if not ranges:
+            return self._decode_block(self._read_block(0))
+
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(_decode_range, self.path, self._enc, self.columns, 
+                                       na, self._esc, start, stop) for start, stop in ranges]
+            parts = [future.result() for future in futures]
+
+        self._dtypes = {}
+        data = {}
+        for name in self.columns:
+            columns = [part_data[name] for part_nrecs, part_data, part_dtypes in parts]
+            dtypes = set(part_dtypes[name] for part_nrecs, part_data, part_dtypes in parts)
+            if isinstance(columns[0], _TextColumn):
+                data[name] = self._merge_text(columns)
+            else:
+                # Integer and boolean columns become float and object when
+                # some range has missing values, as if decoded at once
+                data[name] = np.concatenate(columns)
+            self._dtypes[name] = 'float' if dtypes == {'int', 'float'} else dtypes.pop()
+        nrecs = sum(part_nrecs for part_nrecs, part_data, part_dtypes in parts)
+        return pd.DataFrame(data, columns=self.columns, copy=False, index=range(nrecs))
+
+    def _df_chunks(self, chunksize):
+        '''A vectorized DataFrame chunk generator.
+
+        See `to_dataframe`.
+        '''
+        idx = 0
+        for chunk in self._chunker(chunksize):
+            df = self._decode_block(self._read_block(chunk), start=idx)
+            idx += df.shape[0]
+            yield df
+
+    def _merge_text(self, columns):
+        '''Concatenate text columns decoded by different processes.'''
+        codes, offset = [], 0
+        for column in columns:
+            size = column.text.shape[0]
+            if column.codes is None:
+                codes.append(np.arange(offset, offset+size))
+            else:
+                codes.append(column.codes + offset)
+            offset += size
+        text = np.concatenate([column.text for column in columns])
+        return self._text_values(text, np.concatenate(codes))
+
+    def _map_records(self):
+        '''Memory map the record area of the file.
+
+        Files whose header overstates the number of records are cut at the
+        last complete record. Compressed files are not mapped, their records
+        are read from the decompressed stream.
+        '''
+        if self.compressed:
+            return None
+        nrecs = (os.path.getsize(self.path) - self.lenheader)//self.fmtsiz
+        nrecs = max(min(self.numrec, nrecs), 0)
+        if nrecs == 0:
+            return np.zeros(0, dtype=self._view_dtype)
+        return np.memmap(self.path, dtype=self._view_dtype, mode='r', 
+                         offset=self.lenheader, shape=(nrecs,))
+
+    def _read_block(self, nrecs):
+        '''View the next `nrecs` records as a NumPy structured array.
+
+        Nothing is read from disk until a field of the block is accessed,
+        except for compressed files, which are decompressed up to the end of
+        the block.
+        '''
+        if self.compressed:
+            nrecs = max(min(nrecs, self.numrec - self._pos), 0)
+            data = self.f.read(nrecs*self.fmtsiz)
+            # A truncated stream ends at the last complete record
+            block = np.frombuffer(data, dtype=self._view_dtype, 
+                                  count=len(data)//self.fmtsiz)
+            self._pos += block.shape[0]
+            return block
+        block = np.asarray(self._records[self._pos:self._pos+nrecs])
+        self._pos += block.shape[0]
+        return block
+
+    def _decode_block(self, block, start=0):
+        '''Decode a structured array of raw records into a DataFrame.
+
+        Parameters
+        ----------
+        block : numpy.ndarray
+            Records with dtype `self._view_dtype`.
+
+        start : int, optional
+            First value of the resulting DataFrame index.
+        '''
+        nrecs, data = self._decode_arrays(block)
+        return pd.DataFrame(data, columns=self.columns, copy=False,
+                            index=range(start, start+nrecs))
+
+    def _decode_arrays(self, block, types=None):
+        '''Decode a structured array of raw records into typed columns.
+
+        Parameters
+        ----------
+        block : numpy.ndarray
+            Records with dtype `self._view_dtype`.
+
+        types : dict, optional
+            DBF type to use for some columns instead of the declared one.
+
+        Returns
+        -------
+        nrecs : int
+            Number of records that were not deleted.
+
+        data : dict
+            One NumPy array per column read.
+        '''
+        types = types or {}
+        # If delete byte is not a space, record was deleted so skip. Only the
+        # flag column is read to find them, selection is done per column
+        active = block['DeletionFlag'] == b' '
+        deleted = not active.all()
+
+        self._dtypes = {}
+        data = {}
+        for name, typ, size in self._read_fields[1:]:
+            raw = block[name]
+            if deleted:
+                raw = raw[active]
+            data[name] = self._decode_column(name, types.get(name, typ), raw)
+        return int(active.sum()), data
+
+    def to_parquet(self, parquet_name, chunksize=100000, row_group_size=None, 
+                   na='nan', parse_dates=None, compression='snappy', schema=None):
+        '''Write the DBF contents to a Parquet file, chunk by chunk.
+
+        Records are decoded `chunksize` at a time into Arrow record batches
+        that are appended to the file as row groups, so memory usage does 
+        not depend on the size of the DBF file. The Arrow schema is fixed
+        from the header: C fields are strings, N fields are int64 (no 
+        decimals) or float64, F fields float64, D fields date32 and L fields
+        booleans, unless `schema` says otherwise. Missing values are stored
+        as nulls.
+
+        Parameters
+        ----------
+        parquet_name : string
+            The name (with optional path) of the Parquet file to create. An
+            existing file is overwritten.
+
+        chunksize : int, optional
+            Number of records decoded at a time. Default 100000.
+
+        row_group_size : int, optional
+            Number of records per Parquet row group. Chunks are buffered until
+            a row group is complete. Default 'None', which writes one row
+            group per chunk.
+
+        na : various types accepted, optional
+            See `to_dataframe`. Only values mapping to NaN or None are stored
+            as nulls.
+
+        parse_dates : list, optional
+            Names of C columns holding "YYYYMMDD" dates, stored as date32.
+
+        compression : string, optional
+            Parquet compression codec. Default 'snappy'.
+
+        schema : dict, optional
+            Type of some columns, as in `fluxsus.schemas`: 'category' 
+            (dictionary-encoded strings), 'string', integer types ('uint8',
+            ..., 'int64'), 'float32', 'float64' or 'date'. Values are parsed
+            as such during decoding, whatever the type in the header. Integer
+            values out of range raise an error.
+
+        Notes
+        -----
+        This method requires PyArrow.
+        '''
+        if pa is None:
+            raise ImportError('PyArrow is required to write Parquet files.')
+        self._na_set(na)
+        types = {name: 'D' for name in (parse_dates or [])}
+        types.update({name: _SCHEMA_DBF_TYPES[typ] for name, typ in (schema or {}).items()})
+        schema = self.arrow_schema(parse_dates=parse_dates, schema=schema)
+        if row_group_size is None:
+            row_group_size = chunksize
+
+        # Text columns stay as codes into their unique values until converted
+        self._keep_codes = True
+        try:
+            self._write_parquet(parquet_name, schema, chunksize, row_group_size, 
+                                types, compression)
+        finally:
+            self._keep_codes = False
+
+    def _write_parquet(self, parquet_name, schema, chunksize, row_group_size, types, compression):
+        '''Decode the remaining records into a Parquet file, see `to_parquet`.'''
+        with pq.ParquetWriter(parquet_name, schema, compression=compression) as writer:
+            buffered, nbuffered = [], 0
+            for chunk in self._chunker(chunksize):
+                nrecs, data = self._decode_arrays(self._read_block(chunk), types)
+                buffered.append(self._to_record_batch(data, schema))
+                nbuffered += nrecs
+                if nbuffered >= row_group_size:
+                    table = pa.Table.from_batches(buffered, schema=schema)
+                    # Keep the remainder of an incomplete row group buffered
+                    ncomplete = nbuffered - nbuffered % row_group_size
+                    writer.write_table(table.slice(0, ncomplete), row_group_size=row_group_size)
+                    buffered = table.slice(ncomplete).to_batches()
+                    nbuffered -= ncomplete
+            if nbuffered > 0:
+                writer.write_table(pa.Table.from_batches(buffered, schema=schema), 
+                                   row_group_size=row_group_size)
+
+    def arrow_schema(self, parse_dates=None, schema=None):
+        '''Arrow schema of the columns read, see `to_parquet`.'''
+        if pa is None:
+            raise ImportError('PyArrow is required to build Arrow schemas.')
+        parse_dates = parse_dates or []
+        schema = schema or {}
+        unknown = [typ for typ in schema.values() if typ not in _SCHEMA_DBF_TYPES]
+        if unknown:
+            err = 'Schema types {} not supported.'
+            raise ValueError(err.format(unknown))
+        arrow_fields = []
+        for name, typ, size in self._read_fields[1:]:
+            if name in schema:
+                arrow_type = _schema_arrow_type(schema[name])
+            elif typ == 'D' or name in parse_dates:
+                arrow_type = pa.date32()
+            elif typ == 'N' and self.decimals[name] == 0:
+                arrow_type = pa.int64()
+            elif typ in ('N', 'F'):
+                arrow_type = pa.float64()
+            elif typ == 'L':
+                arrow_type = pa.bool_()
+            else:
+                arrow_type = pa.string()
+            arrow_fields.append(pa.field(name, arrow_type))
+        return pa.schema(arrow_fields)
+
+    def _to_record_batch(self, data, schema):
+        '''Convert decoded columns into an Arrow record batch of `schema`.'''
+        arrays = []
+        for field in schema:
+            values = data[field.name]
+            if isinstance(values, _TextColumn) and not pd.isna(self._na):
+                values = pa.array(self._text_values(values.text, values.codes), type=field.type)
+            elif isinstance(values, _TextColumn):
+                values = _text_array(values, field.type)
+            elif pa.types.is_integer(field.type) and values.dtype.kind == 'f':
+                # Integer columns with missing values were decoded as floats
+                missing = np.isnan(values)
+                if (values[~missing] % 1 != 0).any():
+                    err = 'Column "{}" has decimal values but no declared decimals.'
+                    raise ValueError(err.format(field.name))
+                values = pa.array(np.where(missing, 0, values).astype(np.int64), 
+                                  mask=missing).cast(field.type)
+            elif pa.types.is_integer(field.type):
+                values = pa.array(values).cast(field.type)
+            elif pa.types.is_float32(field.type):
+                values = pa.array(values, from_pandas=True).cast(field.type)
+            else:
+                values = pa.array(values, type=field.type, from_pandas=True)
+            arrays.append(values)
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def _decode_text(self, raw):
+        '''Strip and decode an array of byte strings.
+
+        Returns a fixed-width unicode array when the bytes can be decoded in
+        bulk, otherwise an object array of strings.
+        '''
+        # Remove excess white space before decoding, as done record-wise
+        raw = np.ascontiguousarray(np.char.strip(raw))
+        chars = raw.view(np.uint8)
+        # Latin-1 maps every byte to the code point of same value, and most
+        # codecs agree with ASCII, so widening the bytes decodes in bulk
+        if chars.size and chars.max() < self._bulk_decodable:
+            width = raw.dtype.itemsize
+            text = chars.astype(np.uint32).view('U{:d}'.format(width))
+        else:
+            text = np.empty(raw.shape[0], dtype=object)
+            text[:] = [value.decode(self._enc) for value in raw]
+        # Escape quoted characters
+        if self._esc and text.dtype == object:
+            text[:] = [value.replace('"', self._esc + '"') for value in text]
+        elif self._esc:
+            text = np.char.replace(text, '"', self._esc + '"')
+        return text
+
+    def _text_values(self, text, codes=None):
+        '''Python strings of `text[codes]`, with NaN for empty strings.'''
+        values = text.astype(object)
+        # Convert empty strings to NaN
+        values[text == ''] = self._na
+        if codes is not None:
+            values = values[codes]
+        return values
+
+    def _decode_column(self, name, typ, raw):
+        '''Convert one column of fixed-width bytes into a typed array.
+
+        Parameters
+        ----------
+        name : string
+            Name of the column.
+
+        typ : string
+            DBF type of the column ('C', 'N', 'F', 'D' or 'L').
+
+        raw : numpy.ndarray
+            Column values with a bytes ('S') dtype.
+        '''
+        # String (character) types, remove excess white space. Columns are
+        # highly repetitive, so decode only the unique values
+        if typ == 'C':
+            self._dtypes[name] = 'str'
+            # Columns of (nearly) unique values gain nothing from factorizing
+            if _mostly_unique(raw):
+                codes, text = None, self._decode_text(raw)
+            else:
+                codes, uniq = _factorize(raw)
+                text = self._decode_text(uniq)
+            # Worker processes send the compact form back to the parent
+            if self._keep_codes:
+                return _TextColumn(codes, text)
+            return self._text_values(text, codes)
+
+        # Numeric type. Stored as string. A decimal anywhere in the column
+        # indicates a float, otherwise integers unless there are missing values
+        elif typ == 'N':
+            values, integral = _parse_numeric(raw)
+            if integral:
+                self._dtypes[name] = 'int'
+            else:
+                self._dtypes[name] = 'float'
+            return values
+
+        # Floating points are also stored as strings.
+        elif typ == 'F':
+            self._dtypes[name] = 'float'
+            values, integral = _parse_numeric(raw, allow_int=False)
+            return values
+
+        # Date stores as string "YYYYMMDD", convert to datetime64
+        elif typ == 'D':
+            self._dtypes[name] = 'date'
+            return _parse_date(raw)
+
+        # Booleans can have multiple entry values
+        elif typ == 'L':
+            self._dtypes[name] = 'bool'
+            is_true = np.isin(raw, [b'T', b't', b'Y', b'y'])
+            is_false = np.isin(raw, [b'F', b'f', b'N', b'n'])
+            if (is_true | is_false).all():
+                return is_true
+            # '?' indicates an empty value, convert this to NaN
+            values = np.full(raw.shape[0], self._na, dtype=object)
+            values[is_true] = True
+            values[is_false] = False
+            return values
+
+        else:
+            err = 'Column type "{}" not yet supported.'
+            raise ValueError(err.format(typ))
 
     def _get_recs(self, chunk=None):
         '''Generator that returns individual records.
@@ -102,6 +598,7 @@ class DBFIX(DbfBase):
         '''
         if chunk == None:
             chunk = self.numrec
+        selected = set(self.columns)
 
         for i in range(chunk):
             # Extract a single record
@@ -115,7 +612,7 @@ class DBFIX(DbfBase):
             result = []
             for idx, value in enumerate(record):
                 name, typ, size = self.fields[idx]
-                if name == 'DeletionFlag':
+                if name == 'DeletionFlag' or name not in selected:
                     continue
 
                 # String (character) types, remove excess white space
@@ -189,4 +686,188 @@ class DBFIX(DbfBase):
                     raise ValueError(err.format(value))
 
                 result.append(value)
-            yield result
\ No newline at end of file
+            yield result
+
+def _factorize(raw):
+    '''Encode a bytes column as integer codes plus its unique values.
+
+    Fields of up to 8 bytes are hashed as unsigned integers, which is much
+    faster than hashing the byte strings themselves.
+    '''
+    if raw.dtype.itemsize <= 8:
+        keys = np.ascontiguousarray(raw, dtype='S8').view(np.uint64)
+        codes, uniq = pd.factorize(keys)
+        return codes, np.asarray(uniq, dtype=np.uint64).view('S8')
+    codes, uniq = pd.factorize(raw)
+    return codes, np.asarray(uniq, dtype=raw.dtype)
+
+# Text column as codes into decoded unique values (codes None: one per record)
+_TextColumn = namedtuple('_TextColumn', ['codes', 'text'])
+
+# DBF type used to decode each schema type (see `fluxsus.schemas`)
+_SCHEMA_DBF_TYPES = {
+    'category': 'C', 'string': 'C', 'date': 'D', 'float32': 'N', 'float64': 'N',
+    'int8': 'N', 'int16': 'N', 'int32': 'N', 'int64': 'N',
+    'uint8': 'N', 'uint16': 'N', 'uint32': 'N', 'uint64': 'N',
+}
+
+def _schema_arrow_type(typ):
+    '''Arrow type of a schema type.'''
+    if typ == 'category':
+        return pa.dictionary(pa.int32(), pa.string())
+    if typ == 'date':
+        return pa.date32()
+    return getattr(pa, typ)()
+
+def _text_array(column, arrow_type):
+    '''Arrow string (or dictionary) array of a `_TextColumn`, empty strings as nulls.'''
+    empty = column.text == ''
+    if pa.types.is_dictionary(arrow_type):
+        if column.codes is None:
+            return pa.array(column.text, mask=empty).dictionary_encode().cast(arrow_type)
+        indices = pa.array(column.codes.astype(np.int32), mask=empty[column.codes])
+        return pa.DictionaryArray.from_arrays(indices, pa.array(column.text, type=pa.string()))
+    if column.codes is None:
+        return pa.array(column.text, mask=empty, type=arrow_type)
+    return pa.array(column.text[column.codes], mask=empty[column.codes], type=arrow_type)
+
+def _decode_range(path, codec, columns, na, esc, start, stop):
+    '''Decode records [start, stop) of a DBF file in a worker process.
+
+    Returns the number of records kept, the typed columns and their types.
+    '''
+    dbf = DBFIX(path, codec=codec, columns=columns)
+    dbf._na_set(na)
+    dbf._esc = esc
+    dbf._keep_codes = True
+    dbf._pos = start
+    nrecs, data = dbf._decode_arrays(dbf._read_block(stop - start))
+    return nrecs, data, dbf._dtypes
+
+def _mostly_unique(raw, probe=4096):
+    '''Whether the first `probe` values of a column are mostly distinct.'''
+    head = raw[:probe]
+    return head.shape[0] > 64 and 2*np.unique(head).shape[0] > head.shape[0]
+
+def _identity_range(codec):
+    '''Return n such that bytes below n decode to code points of same value.'''
+    for n in (256, 128):
+        try:
+            if bytes(range(n)).decode(codec) == ''.join(map(chr, range(n))):
+                return n
+        except UnicodeDecodeError:
+            pass
+    return 0
+
+def _parse_value(value, allow_int=True):
+    '''Record-wise parsing of a single numeric string, NaN when malformed.'''
+    try:
+        if allow_int and b'.' not in value:
+            return int(value)
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+def _parse_numeric(raw, allow_int=True):
+    '''Parse a column of fixed-width numeric strings.
+
+    Plain decimal entries (optional sign, digits and at most one point,
+    padded with blanks) are parsed with array arithmetic on the digits. Any
+    other entry falls back to Python's own parsing.
+
+    Parameters
+    ----------
+    raw : numpy.ndarray
+        Column values with a bytes ('S') dtype.
+
+    allow_int : bool, optional
+        Return int64 values when the column has no decimal point and no
+        missing value.
+
+    Returns
+    -------
+    values : numpy.ndarray
+        Parsed values as float64 (or int64). Blank entries become NaN.
+
+    integral : bool
+        Whether `values` holds integers.
+    '''
+    # Short fields are highly repetitive, parse only their unique values
+    if raw.dtype.itemsize <= 8:
+        codes, uniq = _factorize(raw)
+        values, integral = _parse_numeric_block(uniq.astype(raw.dtype), allow_int)
+        return values[codes], integral
+    return _parse_numeric_block(raw, allow_int)
+
+def _parse_numeric_block(raw, allow_int):
+    '''See `_parse_numeric`.'''
+    raw = np.ascontiguousarray(raw)
+    nrecs, width = raw.shape[0], raw.dtype.itemsize
+    chars = raw.view(np.uint8).reshape(nrecs, width)
+
+    mantissa = np.zeros(nrecs, dtype=np.int64)
+    decimals = np.zeros(nrecs, dtype=np.int64)
+    ndigits = np.zeros(nrecs, dtype=np.int64)
+    started = np.zeros(nrecs, dtype=bool)
+    ended = np.zeros(nrecs, dtype=bool)
+    has_point = np.zeros(nrecs, dtype=bool)
+    negative = np.zeros(nrecs, dtype=bool)
+    plain = np.ones(nrecs, dtype=bool)
+    # Scan the digits left to right, accumulating the mantissa as an exact
+    # integer and checking for a single run of characters with a leading sign
+    for pos in range(width):
+        char = chars[:, pos]
+        is_digit = (char >= ord('0')) & (char <= ord('9'))
+        is_point = char == ord('.')
+        is_minus = char == ord('-')
+        is_blank = (char == ord(' ')) | (char == 0)
+        plain &= is_digit | is_point | is_minus | is_blank
+        plain &= ~(ended & ~is_blank)
+        plain &= ~(is_minus & started)
+        plain &= ~(is_point & has_point)
+        ended |= started & is_blank
+        started |= ~is_blank
+        has_point |= is_point
+        negative |= is_minus
+        mantissa = np.where(is_digit, mantissa*10 + (char - ord('0')), mantissa)
+        decimals += is_digit & has_point
+        ndigits += is_digit
+    # Keep the mantissa exact in float64 arithmetic
+    plain &= ndigits <= 15
+    mantissa = np.where(negative, -mantissa, mantissa)
+
+    missing = plain & (ndigits == 0)
+    if allow_int and not has_point.any() and not missing.any() and plain.all():
+        return mantissa, True
+
+    # Exact mantissa over an exact power of ten rounds as float() does
+    values = mantissa / 10.0**decimals
+    values[missing] = np.nan
+    # Slow path: entries that are not plain decimals are parsed one by one
+    if not plain.all():
+        others = np.flatnonzero(~plain)
+        codes, uniq = pd.factorize(raw[others])
+        parsed = np.array([_parse_value(value, allow_int) for value in uniq], 
+                          dtype=np.float64)
+        values[others] = parsed[codes]
+    return values, False
+
+def _parse_date(raw):
+    '''Parse a column of "YYYYMMDD" strings as datetime64[D].
+
+    Blank and invalid dates become NaT.
+    '''
+    digits = np.frombuffer(raw.astype('S8').tobytes(), dtype=np.uint8)
+    digits = digits.reshape(-1, 8).astype(np.int64) - ord('0')
+    valid = ((digits >= 0) & (digits <= 9)).all(axis=1)
+    digits = np.where(valid[:, None], digits, 0)
+    y = digits[:, 0]*1000 + digits[:, 1]*100 + digits[:, 2]*10 + digits[:, 3]
+    m = digits[:, 4]*10 + digits[:, 5]
+    d = digits[:, 6]*10 + digits[:, 7]
+    valid &= (y > 0) & (m >= 1) & (m <= 12) & (d >= 1) & (d <= 31)
+
+    months = np.where(valid, (y - 1970)*12 + (m - 1), 0).astype('datetime64[M]')
+    dates = months.astype('datetime64[D]') + np.where(valid, d - 1, 0)
+    # Days past the end of the month (e.g. 20230231) roll over, reject them
+    valid &= dates.astype('datetime64[M]') == months
+    return np.where(valid, dates, np.datetime64('NaT'))
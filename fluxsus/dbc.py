@@ -0,0 +1,212 @@
+'''
+    Reader of DATASUS compressed DBF files (.dbc).
+
+    A .dbc file is the header of the DBF file, followed by a 4-byte CRC and by the
+    records compressed with the PKWARE Data Compression Library ("implode"). The
+    records are decompressed here as a stream, following Mark Adler's 'blast.c'
+    (zlib/contrib/blast), so no intermediate DBF file is needed.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import io
+import struct
+
+# -- maximum length of a Huffman code
+MAXBITS = 13
+# -- bit lengths of the literal, length and distance codes: each byte holds the
+# -- number of symbols minus one (high nibble) and their code length (low nibble)
+LITLEN = [
+    11, 124, 8, 7, 28, 7, 188, 13, 76, 4, 10, 8, 12, 10, 12, 10, 8, 23, 8,
+    9, 7, 6, 7, 8, 7, 6, 55, 8, 23, 24, 12, 11, 7, 9, 11, 12, 6, 7, 22, 5,
+    7, 24, 6, 11, 9, 6, 7, 22, 7, 11, 38, 7, 9, 8, 25, 11, 8, 11, 9, 12,
+    8, 12, 5, 38, 5, 38, 5, 11, 7, 5, 6, 21, 6, 10, 53, 8, 7, 24, 10, 27,
+    44, 253, 253, 253, 252, 252, 252, 13, 12, 45, 12, 45, 12, 61, 12, 45,
+    44, 173
+]
+LENLEN = [2, 35, 36, 53, 38, 23]
+DISTLEN = [2, 20, 53, 230, 247, 151, 248]
+# -- base and number of extra bits of each length symbol
+LENBASE = [3, 2, 4, 5, 6, 7, 8, 9, 10, 12, 16, 24, 40, 72, 136, 264]
+LENEXTRA = [0, 0, 0, 0, 0, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8]
+# -- length symbol marking the end of the stream
+END_LENGTH = 519
+
+def huffman_table(compact):
+    '''
+        Lookup table of a canonical Huffman code given its compact bit lengths.
+
+        The table is indexed by the next MAXBITS bits of the stream (read from the
+        least significant bit) and gives (symbol, code length). Codes are stored
+        inverted in the stream, as in PKWARE's format.
+    '''
+    lengths = []
+    for byte in compact:
+        lengths += [byte & 15] * ((byte >> 4) + 1)
+
+    table = [None] * (1 << MAXBITS)
+    code = 0
+    for length in range(1, MAXBITS+1):
+        for symbol, symbol_length in enumerate(lengths):
+            if symbol_length != length:
+                continue
+            # -- first bit of the code is its most significant bit, inverted
+            stream_bits = int(format(code, f'0{length}b')[::-1], 2) ^ ((1 << length) - 1)
+            for high in range(1 << (MAXBITS - length)):
+                table[stream_bits | (high << length)] = (symbol, length)
+            code += 1
+        code <<= 1
+    return table
+
+class TruncatedStreamError(ValueError):
+    '''
+        The compressed stream ended before its end code (e.g. an incomplete download).
+    '''
+
+LITCODE = huffman_table(LITLEN)
+LENCODE = huffman_table(LENLEN)
+DISTCODE = huffman_table(DISTLEN)
+
+def explode(read, chunksize=1<<16):
+    '''
+        Decompress a PKWARE DCL imploded stream.
+
+        Args:
+        -----
+            read:
+                Callable. Returns the next bytes of the compressed stream given a
+                number of bytes (e.g. the 'read' method of a file object).
+            chunksize:
+                Integer. Number of compressed bytes read at a time.
+
+        Return:
+        -------
+            Generator of bytes. Consecutive pieces of the decompressed stream.
+
+        Raises:
+        -------
+            TruncatedStreamError, if the stream ends before its end code, and
+            ValueError for other invalid streams.
+    '''
+    data = read(chunksize)
+    if len(data) < 2:
+        raise TruncatedStreamError('Truncated imploded stream: missing header.')
+    lit, dictbits = data[0], data[1]
+    pos = 2
+    bitbuf, bitcnt = 0, 0
+    if lit > 1:
+        raise ValueError('Invalid imploded stream: literal flag is not 0 or 1.')
+    if dictbits < 4 or dictbits > 6:
+        raise ValueError('Invalid imploded stream: dictionary size is not 1K, 2K or 4K.')
+
+    # -- the output keeps the last 4K bytes (maximum distance) after each yield
+    out = bytearray()
+    mask = (1 << MAXBITS) - 1
+    while True:
+        # -- a symbol takes at most 31 bits (flag, length, extra bits, distance)
+        if bitcnt < 32:
+            if len(data) - pos < 8:
+                data, pos = data[pos:] + read(chunksize), 0
+                if pos == len(data) and bitcnt == 0:
+                    raise TruncatedStreamError('Truncated imploded stream: missing end code.')
+            piece = data[pos:pos+8]
+            bitbuf |= int.from_bytes(piece, 'little') << bitcnt
+            bitcnt += 8*len(piece)
+            pos += len(piece)
+        flag = bitbuf & 1
+        bitbuf >>= 1
+        bitcnt -= 1
+        if flag:
+            # -- length of the copy
+            symbol, length = LENCODE[bitbuf & mask]
+            bitbuf >>= length
+            bitcnt -= length
+            extra = LENEXTRA[symbol]
+            size = LENBASE[symbol] + (bitbuf & ((1 << extra) - 1))
+            bitbuf >>= extra
+            bitcnt -= extra
+            # -- bits beyond the end of the input are read as zeros: check them before use
+            if bitcnt < 0:
+                raise TruncatedStreamError('Truncated imploded stream: unexpected end of data.')
+            if size == END_LENGTH:
+                break
+            # -- distance of the copy
+            low = 2 if size == 2 else dictbits
+            symbol, length = DISTCODE[bitbuf & mask]
+            bitbuf >>= length
+            dist = (symbol << low) + (bitbuf & ((1 << low) - 1)) + 1
+            bitbuf >>= low
+            bitcnt -= length + low
+            if bitcnt < 0:
+                raise TruncatedStreamError('Truncated imploded stream: unexpected end of data.')
+            if dist > len(out):
+                raise ValueError('Invalid imploded stream: distance too far back.')
+            start = len(out) - dist
+            if dist >= size:
+                out += out[start:start+size]
+            else:
+                # -- overlapping copy repeats the last 'dist' bytes
+                out += (out[start:] * (size // dist + 1))[:size]
+        elif lit:
+            symbol, length = LITCODE[bitbuf & mask]
+            bitbuf >>= length
+            bitcnt -= length
+            out.append(symbol)
+        else:
+            out.append(bitbuf & 0xff)
+            bitbuf >>= 8
+            bitcnt -= 8
+        if bitcnt < 0:
+            raise TruncatedStreamError('Truncated imploded stream: unexpected end of data.')
+
+        if len(out) >= 2*chunksize:
+            yield bytes(out[:-4096])
+            del out[:-4096]
+    yield bytes(out)
+
+class DBCStream(io.RawIOBase):
+    '''
+        Read-only file object over the decompressed records of a .dbc file.
+
+        Args:
+        -----
+            raw:
+                File object of the .dbc file (binary mode), at any position.
+            lenheader:
+                Integer. Length of the DBF header stored at the beginning of the
+                file. Default None, which reads it from the header.
+    '''
+    def __init__(self, raw, lenheader=None):
+        self.raw = raw
+        if lenheader is None:
+            raw.seek(8)
+            lenheader, = struct.unpack('<H', raw.read(2))
+        # -- skip the header and the CRC of the compressed records
+        raw.seek(lenheader + 4)
+        self._pieces = explode(raw.read)
+        self._buffer = bytearray()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            piece = next(self._pieces, None)
+            if piece is None:
+                break
+            self._buffer += piece
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.raw.close()
+        super().close()
@@ -0,0 +1,172 @@
+'''
+    Catalog of the monthly parquet files of the DATASUS systems (SIHSUS, CNES, ...).
+
+    Files named "XXUFYYMM.parquet" (e.g. "RDCE2301.parquet") are indexed once by
+    (prefix, UF, period), so the files of a period range are found by binary search
+    and read as a single Arrow dataset.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import os
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+import pyarrow.dataset as ds
+
+# -- prefix of the system, state code, year and month of competence
+FNAME_PATTERN = re.compile(r'^([A-Z]+)([A-Z]{2})(\d{2})(\d{2})$')
+# -- state code selecting the files of all states (e.g. "RDBR2301")
+NATIONAL_UF = "BR"
+
+def parse_period(period):
+    '''
+        Split a string "XXUFYYMM" into its prefix, state code and period.
+
+        Args:
+        -----
+            period:
+                String. Format "XXUFYYMM", where 'XX' stands for the preffix of the
+                file (as described by DATASUS), 'UF' stands for the state code, and
+                "YYMM" stands for the year and month of competence.
+
+        Return:
+        -------
+            prefix:
+                String.
+            uf:
+                String.
+            yearmonth:
+                Integer. Year and month as YYYYMM (e.g. 202301).
+    '''
+    match = FNAME_PATTERN.match(period.upper())
+    if match is None:
+        raise ValueError(f'"{period}" does not follow the format "XXUFYYMM".')
+    prefix, uf, yy, mm = match.groups()
+    # -- DATASUS files start in the 1990s
+    year = int(yy) + (1900 if int(yy)>=90 else 2000)
+    return prefix, uf, year*100 + int(mm)
+
+class SIHDataset:
+    def __init__(self, path, extension=".parquet"):
+        '''
+            Catalog of the monthly files of a folder, indexed by (prefix, UF, period).
+
+            Args:
+            -----
+                path:
+                    String. Folder containing the files "XXUFYYMM.parquet".
+                extension:
+                    String. Extension of the files to index.
+
+            Attributes:
+            -----------
+                periods:
+                    Dictionary. (prefix, UF) -> sorted list of periods (YYYYMM).
+                files:
+                    Dictionary. (prefix, UF) -> list of files, in the order of 'periods'.
+        '''
+        self.path = path
+        self.periods = {}
+        self.files = {}
+
+        index = defaultdict(list)
+        for fname in os.listdir(path):
+            stem, ext = os.path.splitext(fname)
+            if ext.lower() != extension.lower():
+                continue
+            try:
+                prefix, uf, yearmonth = parse_period(stem)
+            except ValueError:
+                continue
+            index[(prefix, uf)].append((yearmonth, os.path.join(path, fname)))
+
+        for key, entries in index.items():
+            entries.sort()
+            self.periods[key] = [ yearmonth for yearmonth, fname in entries ]
+            self.files[key] = [ fname for yearmonth, fname in entries ]
+
+    def files_between(self, init_period, final_period):
+        '''
+            Files of the period range [init_period, final_period].
+
+            Args:
+            -----
+                init_period:
+                    String. Format "XXUFYYMM" (see parse_period) of the first month.
+                final_period:
+                    String. Format "XXUFYYMM" of the last month. Must have the same
+                    prefix and state code as 'init_period'. The state code "BR" (see
+                    NATIONAL_UF) selects the files of all states.
+
+            Return:
+            -------
+                List of Strings. Paths to the files, in chronological order.
+        '''
+        return [ fname for yearmonth, fname in self.select(init_period, final_period) ]
+
+    def select(self, init_period, final_period):
+        '''
+            Same as 'files_between', with the period (YYYYMM) of each file.
+
+            Return:
+            -------
+                List of Tuples. (period, path to the file), in chronological order
+                (and by state within a period).
+        '''
+        prefix, uf, init = parse_period(init_period)
+        final_prefix, final_uf, final = parse_period(final_period)
+        if (prefix, uf) != (final_prefix, final_uf):
+            raise ValueError('Initial and final periods refer to different files.')
+
+        keys = [(prefix, uf)]
+        if uf == NATIONAL_UF:
+            keys = sorted( key for key in self.periods if key[0] == prefix and key[1] != NATIONAL_UF )
+        selected = []
+        for key in keys:
+            periods = self.periods.get(key, [])
+            left, right = bisect_left(periods, init), bisect_right(periods, final)
+            selected += list(zip(periods[left:right], self.files[key][left:right]))
+        if not len(selected):
+            raise Exception(f"no file between {init_period} and {final_period} was found.")
+        return sorted(selected)
+
+    def dataset(self, init_period, final_period):
+        '''
+            Arrow dataset of the files of the period range [init_period, final_period].
+        '''
+        return ds.dataset(self.files_between(init_period, final_period), format="parquet")
+
+    def to_table(self, init_period, final_period, columns=None, filter=None):
+        '''
+            Read the records of the period range [init_period, final_period].
+
+            Args:
+            -----
+                init_period:
+                    String. Format "XXUFYYMM" of the first month.
+                final_period:
+                    String. Format "XXUFYYMM" of the last month.
+                columns:
+                    List of Strings. Columns to read. Default None, which reads all.
+                filter:
+                    pyarrow.compute.Expression. Only records satisfying it are read
+                    (e.g. pyarrow.dataset.field("MORTE")==1).
+
+            Return:
+            -------
+                pyarrow.Table.
+        '''
+        return self.dataset(init_period, final_period).to_table(columns=columns, filter=filter)
+
+    def to_pandas(self, init_period, final_period, columns=None, filter=None):
+        '''
+            Same as 'to_table', as a pandas.DataFrame.
+
+            Dictionary-encoded fields (see fluxsus.schemas) become categoricals shared
+            by all files, and dates become datetime64.
+        '''
+        table = self.to_table(init_period, final_period, columns=columns, filter=filter)
+        return table.to_pandas(date_as_object=False)
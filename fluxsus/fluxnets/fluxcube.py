@@ -0,0 +1,440 @@
+'''
+    Monthly flux cube of the SIHSUS admissions.
+
+    The admissions of each monthly file are aggregated once into cells holding the
+    number of admissions and the total cost (VAL_TOT) per (month, city of residence,
+    target, ICD-10 group), where the target is either the city of the admission
+    (MUNIC_MOV) or the health unit (CNES) and the group is the chapter, block or
+    3-character category of the main diagnosis. The network of any window of months
+    is then built by summing the cells of the window instead of reading the records,
+    at the level of the cube or any coarser one.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import os
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from fluxsus import icd10
+from fluxsus.fluxnets.catalog import SIHDataset, parse_period
+from fluxsus.fluxnets.sketches import CostSketch, DistinctSketch
+
+class FluxCube:
+    def __init__(self, target="MUNIC_MOV", cells=None, prefix=None, uf=None, icd_level='chapter', cost_sketch=False, distinct=None,
+                 sources=None):
+        '''
+            Number of admissions and total cost per month, pair of nodes and ICD-10 group.
+
+            Args:
+            -----
+                target:
+                    String. Field of the target nodes: "MUNIC_MOV" (city flux network)
+                    or "CNES" (city to hospital flux network).
+                cells:
+                    pandas.DataFrame. Precomputed cells (see 'update').
+                prefix:
+                    String. Preffix of the SIHSUS files of the cube (e.g. "RD").
+                uf:
+                    String. State code of the SIHSUS files of the cube (e.g. "CE").
+                icd_level:
+                    String. Level of the ICD-10 groups of the cells: 'chapter', 'block'
+                    or 'category' (see fluxsus.icd10). Networks can be stratified at
+                    this level or any coarser one.
+                cost_sketch:
+                    Bool or CostSketch. Whether to also keep monthly sketches of the cost
+                    of the admissions per pair of nodes (see fluxsus.fluxnets.sketches),
+                    or the precomputed sketches (keys "PERIOD", "MUNIC_RES" and target).
+                distinct:
+                    List of Strings or Dictionary. Fields whose monthly sketches of distinct
+                    values per pair of nodes are kept (e.g. ["N_AIH", "CNES"]), or the
+                    precomputed sketches (field -> DistinctSketch).
+                sources:
+                    Dictionary. Month (YYYYMM) -> files aggregated into its cells (see
+                    'update').
+
+            Attributes:
+            -----------
+                cells:
+                    pandas.DataFrame. Columns "PERIOD" (YYYYMM of the file), "MUNIC_RES",
+                    target, "ICD" (id of the ICD-10 group, or -1 for codes outside of
+                    the classification), "sum" and "count" of VAL_TOT.
+                sketches:
+                    CostSketch. Monthly sketches of the cost, or None.
+                distinct_sketches:
+                    Dictionary. Field -> monthly sketches of its distinct values.
+                sources:
+                    Dictionary. Month (YYYYMM) -> list of [name, size, modification time
+                    in ns] of the files aggregated into its cells.
+        '''
+        if target not in ["MUNIC_MOV", "CNES"]:
+            raise ValueError('target must be "MUNIC_MOV" or "CNES".')
+        if icd_level not in icd10.LEVELS:
+            raise ValueError(f'icd_level must be one of {icd10.LEVELS}.')
+        self.target = target
+        self.prefix = prefix
+        self.uf = uf
+        self.icd_level = icd_level
+        if cells is None:
+            cells = pd.DataFrame({"PERIOD": pd.Series(dtype='int32'), "MUNIC_RES": pd.Series(dtype=str),
+                                  target: pd.Series(dtype=str), "ICD": pd.Series(dtype='int16'),
+                                  "sum": pd.Series(dtype='float64'), "count": pd.Series(dtype='int64')})
+        # -- cubes saved before the ICD-10 levels hold chapters only
+        cells = cells.rename({"CHAPTER": "ICD"}, axis=1)
+        self.cells = cells[["PERIOD", "MUNIC_RES", target, "ICD", "sum", "count"]]
+        self.sketches = None
+        if isinstance(cost_sketch, CostSketch):
+            self.sketches = cost_sketch
+        elif cost_sketch:
+            self.sketches = CostSketch(["PERIOD", "MUNIC_RES", target])
+        if isinstance(distinct, dict):
+            self.distinct_sketches = dict(distinct)
+        else:
+            self.distinct_sketches = { field: DistinctSketch(["PERIOD", "MUNIC_RES", target]) for field in (distinct or []) }
+        self.sources = dict(sources or {})
+
+    @property
+    def periods(self):
+        '''
+            Sorted array of the months (YYYYMM) in the cube.
+        '''
+        return np.sort(self.cells["PERIOD"].unique())
+
+    def update(self, sihpath, init_period, final_period):
+        '''
+            Aggregate the SIHSUS files of the period range not yet in the cube.
+
+            Months already in the cube are aggregated again when their files changed
+            (name, size or modification time, see 'sources'), replacing their cells and
+            sketches. Months without a record of their files (e.g. cubes saved by
+            older versions) are aggregated again as well.
+
+            Args:
+            -----
+                sihpath:
+                    String or SIHDataset. Folder containing the SIHSUS parquet files,
+                    or its catalog (see fluxsus.fluxnets.catalog).
+                init_period:
+                    String. Format "XXUFYYMM" of the first month.
+                final_period:
+                    String. Format "XXUFYYMM" of the last month.
+
+            Return:
+            -------
+                self.
+        '''
+        prefix, uf, _ = parse_period(init_period)
+        self._check_files(prefix, uf)
+        self.prefix, self.uf = prefix, uf
+
+        dataset = sihpath if isinstance(sihpath, SIHDataset) else SIHDataset(sihpath)
+        done = set(self.periods.tolist())
+        files = {}
+        for period, fname in dataset.select(init_period, final_period):
+            files.setdefault(period, []).append(fname)
+
+        new_cells, new_sketches, changed = [], [], []
+        new_distinct = { field: [] for field in self.distinct_sketches }
+        for period, fnames in files.items():
+            sources = file_sources(fnames)
+            if period in done and self.sources.get(period) == sources:
+                continue
+            if period in done:
+                changed.append(period)
+            for fname in fnames:
+                cells, sketch, distinct = self._aggregate_file(period, fname)
+                new_cells.append(cells)
+                if sketch is not None:
+                    new_sketches.append(sketch)
+                for field, distinct_sketch in distinct.items():
+                    new_distinct[field].append(distinct_sketch)
+            self.sources[period] = sources
+        if len(changed):
+            self._drop_periods(changed)
+        if len(new_cells):
+            cells = pd.concat([self.cells]+new_cells, ignore_index=True)
+            self.cells = cells.sort_values(by="PERIOD", kind='stable').reset_index(drop=True)
+        if len(new_sketches):
+            self.sketches = self.sketches.merge(*new_sketches)
+        # -- monthly sketches merged once (the months do not share rows, "PERIOD" is a key)
+        for field, sketches in new_distinct.items():
+            if len(sketches):
+                self.distinct_sketches[field] = self.distinct_sketches[field].merge(*sketches)
+        return self
+
+    def _drop_periods(self, periods):
+        '''
+            Remove the cells and sketches of a list of months.
+        '''
+        self.cells = self.cells[~self.cells["PERIOD"].isin(periods)].reset_index(drop=True)
+        if self.sketches is not None:
+            self.sketches = self.sketches.take(~self.sketches.index["PERIOD"].isin(periods))
+        for field, sketch in self.distinct_sketches.items():
+            self.distinct_sketches[field] = sketch.take(~sketch.index["PERIOD"].isin(periods))
+
+    def _aggregate_file(self, period, fname):
+        '''
+            Cells (and sketches, if kept) of a single monthly file.
+        '''
+        fields = ["MUNIC_RES", self.target, "VAL_TOT", "DIAG_PRINC"]
+        sih_df = pd.read_parquet(fname, columns=fields+[ field for field in self.distinct_sketches if field not in fields ])
+        for col in ["MUNIC_RES", self.target]:
+            if isinstance(sih_df[col].dtype, pd.CategoricalDtype):
+                sih_df[col] = sih_df[col].astype(sih_df[col].cat.categories.dtype)
+        sih_df["ICD"] = icd10.classify(sih_df["DIAG_PRINC"], level=self.icd_level)
+        cells = sih_df.groupby(["MUNIC_RES", self.target, "ICD"], observed=True)["VAL_TOT"].agg(['sum', 'count']).reset_index()
+        cells.insert(0, "PERIOD", np.int32(period))
+        sih_df["PERIOD"] = np.int32(period)
+        sketch = None
+        if self.sketches is not None:
+            sketch = CostSketch.from_records(sih_df, self.sketches.keys)
+        distinct = { field: DistinctSketch.from_records(sih_df, ["PERIOD", "MUNIC_RES", self.target], field)
+                     for field in self.distinct_sketches }
+        return cells, sketch, distinct
+
+    def periods_between(self, init_period, final_period):
+        '''
+            Months (YYYYMM) of the cube within the period range [init_period, final_period].
+
+            Args:
+            -----
+                init_period:
+                    String or Integer. Format "XXUFYYMM" or YYYYMM of the first month.
+                final_period:
+                    String or Integer. Format "XXUFYYMM" or YYYYMM of the last month.
+        '''
+        init, final = self._yearmonth(init_period), self._yearmonth(final_period)
+        periods = self.periods
+        return periods[(periods>=init) & (periods<=final)]
+
+    def aggregate(self, init_period, final_period, multilayer_icd=False, icd_level=None):
+        '''
+            Number of admissions and total cost per pair of nodes within a period range.
+
+            Args:
+            -----
+                init_period:
+                    String or Integer. Format "XXUFYYMM" or YYYYMM of the first month.
+                final_period:
+                    String or Integer. Format "XXUFYYMM" or YYYYMM of the last month.
+                multilayer_icd:
+                    Bool. Whether to also aggregate the fluxes of each ICD-10 group.
+                icd_level:
+                    String. Level of the ICD-10 groups. Default None, which uses the
+                    level of the cube.
+
+            Return:
+            -------
+                edges:
+                    pandas.DataFrame. Columns "MUNIC_RES", target, "sum" and "count".
+                icd_edges:
+                    pandas.DataFrame. Same as 'edges' per ICD-10 group, with the column
+                    "ICD" (id of the group, see fluxsus.icd10.names). None if 'multilayer_icd'
+                    is False.
+        '''
+        init, final = self._yearmonth(init_period), self._yearmonth(final_period)
+        if not len(self.periods_between(init, final)):
+            raise Exception(f"no month between {init_period} and {final_period} was found in the cube.")
+        window = self.cells[(self.cells["PERIOD"]>=init) & (self.cells["PERIOD"]<=final)]
+        edges = window.groupby(["MUNIC_RES", self.target])[["sum", "count"]].sum().reset_index()
+
+        icd_edges = None
+        if multilayer_icd:
+            window = self._coarsen(window, icd_level)
+            icd_edges = window[window["ICD"]>=0].groupby(["MUNIC_RES", self.target, "ICD"])[["sum", "count"]].sum().reset_index()
+        return edges, icd_edges
+
+    def _coarsen(self, cells, icd_level):
+        '''
+            Cells with the ICD-10 groups of the cube converted into a coarser level.
+        '''
+        if icd_level is None or icd_level == self.icd_level:
+            return cells
+        return cells.assign(ICD=icd10.coarsen(cells["ICD"].to_numpy(), self.icd_level, icd_level))
+
+    def cost_sketch(self, init_period, final_period):
+        '''
+            Sketches of the cost per pair of nodes within a period range, merged from
+            the monthly sketches.
+
+            Return:
+            -------
+                CostSketch. Keys "MUNIC_RES" and target.
+        '''
+        if self.sketches is None:
+            raise Exception("the cube does not keep cost sketches (see 'cost_sketch').")
+        init, final = self._yearmonth(init_period), self._yearmonth(final_period)
+        periods = self.sketches.index["PERIOD"]
+        return self.sketches.take((periods>=init) & (periods<=final)).combine(["MUNIC_RES", self.target])
+
+    def distinct_sketch(self, field, init_period, final_period):
+        '''
+            Sketches of the distinct values of a field per pair of nodes within a period
+            range, merged from the monthly sketches.
+
+            Return:
+            -------
+                DistinctSketch. Keys "MUNIC_RES" and target.
+        '''
+        if field not in self.distinct_sketches:
+            raise Exception(f"the cube does not keep distinct sketches of {field} (see 'distinct').")
+        init, final = self._yearmonth(init_period), self._yearmonth(final_period)
+        sketch = self.distinct_sketches[field]
+        periods = sketch.index["PERIOD"]
+        return sketch.take((periods>=init) & (periods<=final)).combine(["MUNIC_RES", self.target])
+
+    def rolling(self, init_period, final_period, window=3, step=1, multilayer_icd=False, icd_level=None):
+        '''
+            Fluxes of a series of sliding windows of months within a period range.
+
+            The sums of the current window are kept per pair of nodes (and ICD-10 group):
+            moving the window only adds the months entering it and subtracts the ones
+            leaving it, so each window costs the same regardless of its length.
+
+            Args:
+            -----
+                init_period:
+                    String or Integer. Format "XXUFYYMM" or YYYYMM of the first month
+                    of the first window.
+                final_period:
+                    String or Integer. Format "XXUFYYMM" or YYYYMM of the last month
+                    of the last window.
+                window:
+                    Integer. Number of months of each window.
+                step:
+                    Integer. Number of months between the beginning of consecutive windows.
+                multilayer_icd:
+                    Bool. Whether to also aggregate the fluxes of each ICD-10 group.
+                icd_level:
+                    String. Level of the ICD-10 groups. Default None, which uses the
+                    level of the cube.
+
+            Return:
+            -------
+                Generator of Tuples. (first month, last month, edges, icd_edges) of
+                each window, with months as YYYYMM and the tables as in 'aggregate'.
+        '''
+        if window < 1 or step < 1:
+            raise ValueError('window and step must be positive.')
+        months = month_range(self._yearmonth(init_period), self._yearmonth(final_period))
+        keys = ["MUNIC_RES", self.target] + (["ICD"] if multilayer_icd else [])
+
+        cells = self.cells[(self.cells["PERIOD"]>=months[0]) & (self.cells["PERIOD"]<=months[-1])]
+        if multilayer_icd:
+            cells = self._coarsen(cells, icd_level)
+        cells = cells.groupby(["PERIOD"]+keys).agg(sum=("sum", "sum"), count=("count", "sum"), cells=("count", "size")).reset_index()
+        # -- each pair of nodes (and ICD-10 group) gets an index into the running sums
+        key_index = cells.groupby(keys, sort=False).ngroup().to_numpy()
+        key_df = cells[keys].drop_duplicates().reset_index(drop=True)
+        # -- cells of each month are contiguous (sorted by period)
+        bounds = np.searchsorted(cells["PERIOD"].to_numpy(), np.array(months+[months[-1]+1]))
+        values = { col: cells[col].to_numpy() for col in ["sum", "count", "cells"] }
+        running = { col: np.zeros(key_df.shape[0], dtype=values[col].dtype) for col in values }
+
+        def move(month, sign):
+            rows = slice(bounds[month], bounds[month+1])
+            for col in running:
+                np.add.at(running[col], key_index[rows], sign*values[col][rows])
+
+        start = 0
+        for month in range(min(window, len(months))):
+            move(month, +1)
+        while start+window <= len(months):
+            active = running["cells"] > 0
+            window_df = key_df[active].reset_index(drop=True)
+            window_df["sum"] = running["sum"][active]
+            window_df["count"] = running["count"][active]
+
+            icd_edges = None
+            if multilayer_icd:
+                edges = window_df.groupby(["MUNIC_RES", self.target])[["sum", "count"]].sum().reset_index()
+                icd_edges = window_df[window_df["ICD"]>=0].reset_index(drop=True)
+            else:
+                edges = window_df
+            yield months[start], months[start+window-1], edges, icd_edges
+
+            # -- months leaving and entering the window
+            for month in range(start, min(start+step, start+window)):
+                move(month, -1)
+            for month in range(max(start+window, start+step), min(start+step+window, len(months))):
+                move(month, +1)
+            # -- avoid residues of the floating point subtraction on emptied cells
+            running["sum"][running["cells"]==0] = 0
+            start += step
+
+    def to_parquet(self, fname):
+        '''
+            Save the cube (cells and the files they refer to) as a parquet file. The
+            cost sketches, if kept, are saved alongside it (see 'sketch_fname').
+        '''
+        table = pa.Table.from_pandas(self.cells, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'fluxcube'] = json.dumps({'target': self.target, 'prefix': self.prefix, 'uf': self.uf,
+                                            'icd_level': self.icd_level, 'cost_sketch': self.sketches is not None,
+                                            'distinct': list(self.distinct_sketches.keys()),
+                                            'sources': { str(period): sources for period, sources in self.sources.items() }}).encode()
+        pq.write_table(table.replace_schema_metadata(metadata), fname)
+        if self.sketches is not None:
+            self.sketches.to_parquet(sketch_fname(fname))
+        for field, sketch in self.distinct_sketches.items():
+            sketch.to_parquet(sketch_fname(fname, field))
+        return self
+
+    @classmethod
+    def read_parquet(cls, fname):
+        '''
+            Load a cube saved with 'to_parquet'.
+        '''
+        table = pq.read_table(fname)
+        info = json.loads(table.schema.metadata[b'fluxcube'])
+        sketches = CostSketch.read_parquet(sketch_fname(fname)) if info.get('cost_sketch', False) else False
+        distinct = { field: DistinctSketch.read_parquet(sketch_fname(fname, field)) for field in info.get('distinct', []) }
+        sources = { int(period): files for period, files in info.get('sources', {}).items() }
+        return cls(info['target'], table.to_pandas(), prefix=info['prefix'], uf=info['uf'],
+                   icd_level=info.get('icd_level', 'chapter'), cost_sketch=sketches, distinct=distinct, sources=sources)
+
+    def _yearmonth(self, period):
+        '''
+            Period YYYYMM given either as an integer or a string "XXUFYYMM".
+        '''
+        if not isinstance(period, str):
+            return int(period)
+        prefix, uf, yearmonth = parse_period(period)
+        self._check_files(prefix, uf)
+        return yearmonth
+
+    def _check_files(self, prefix, uf):
+        if self.prefix is not None and (prefix, uf) != (self.prefix, self.uf):
+            raise ValueError(f'The cube refers to the files "{self.prefix}{self.uf}", not "{prefix}{uf}".')
+
+def month_range(init, final):
+    '''
+        List of the months (YYYYMM) between 'init' and 'final' (inclusive).
+    '''
+    first, last = (init//100)*12 + init%100 - 1, (final//100)*12 + final%100 - 1
+    return [ (n//12)*100 + n%12 + 1 for n in range(first, last+1) ]
+
+def file_sources(fnames):
+    '''
+        Name, size and modification time (ns) of each file, to tell whether the files
+        of a month changed since they were aggregated.
+    '''
+    sources = []
+    for fname in fnames:
+        stat = os.stat(fname)
+        sources.append([os.path.basename(fname), stat.st_size, stat.st_mtime_ns])
+    return sources
+
+def sketch_fname(fname, field=None):
+    '''
+        File of the cost sketches (or of the distinct values of a field) of a cube saved
+        as 'fname' (e.g. "cube.costs.parquet" or "cube.distinct_N_AIH.parquet").
+    '''
+    stem, ext = os.path.splitext(fname)
+    if field is not None:
+        return f'{stem}.distinct_{field}{ext}'
+    return f'{stem}.costs{ext}'
@@ -11,11 +11,19 @@ import numpy as np
 import pandas as pd
 from collections import defaultdict
 import networkx as nx
+import scipy.sparse as sp
 
+from fluxsus import icd10
 import fluxsus.fluxnets.fnets_utils as futils
+from fluxsus.fluxnets import strata as fstrata
+from fluxsus.fluxnets.sparsenet import SparseNet
+from fluxsus.fluxnets.streaming import FluxAccumulator
+from fluxsus.fluxnets import projections as fproj
+from fluxsus.fluxnets import sketches as fsketch
+from fluxsus.fluxnets import stay as fstay
 
 class BaseFlux:
-    def __init__(self, cnes_df, geodata_df):
+    def __init__(self, cnes_df, geodata_df, backend='networkx'):
         '''
             Interface to create flux networks referring to hospital admissions. A flux is defined when 
             an individual from a given city is admitted to a hospital in another city. Considering the data 
@@ -31,22 +39,49 @@ class BaseFlux:
                     pandas.DataFrame.
                 geodata_df:
                     pandas.DataFrame.
+                backend:
+                    String. Container of the edges: 'networkx' (edges added to 'graph')
+                    or 'sparse' (edges kept as sparse matrices in 'sparse', see
+                    fluxsus.fluxnets.sparsenet; 'graph' then holds only the nodes).
 
             Attributes:
             -----------
                 graph:
                     networkx.DiGraph or networkx.Graph.
+                sparse:
+                    SparseNet. Network of the 'sparse' backend.
         '''
+        if backend not in ['networkx', 'sparse']:
+            raise ValueError('backend must be "networkx" or "sparse".')
+        self.backend = backend
+        self.sparse = None
         self.sih_df = None
         self.cnes_df = cnes_df.copy()
         self.geodata_df = geodata_df.copy()
         self.count_sum_edge_with_code = None
-
-        self.cnes_df = self.cnes_df.merge(self.geodata_df[["GEOCOD6", "MACRO_ID", "CRES_ID", "MACRO_NOME"]], left_on="CODUFMUN", right_on="GEOCOD6", how='left').drop("GEOCOD6", axis=1)
+        # -- suffix of the attributes of each layer and, for the 'networkx' backend, the fluxes of
+        # -- the layers as sparse matrices (edges of 'count_sum_edge_with_code', layers) per attribute
+        self.layers = None
+        self.edge_layer_attrs = {}
+        # -- fluxes per (source, target, stratum) of the last call to 'calculate_fluxes' with strata
+        self.flux_tensor = None
+        # -- sketches of the cost per edge of the last call to 'calculate_fluxes' with cost_sketch
+        self.cost_sketch = None
+        # -- field -> sketches of its distinct values per edge (see 'calculate_fluxes' with distinct)
+        self.distinct_sketches = {}
+
+        # -- regions of the health units (geodata of other states may not have them)
+        regions = [ col for col in ["MACRO_ID", "CRES_ID", "MACRO_NOME"] if col in self.geodata_df.columns ]
+        self.cnes_df = self.cnes_df.merge(self.geodata_df[["GEOCOD6"]+regions], left_on="CODUFMUN", right_on="GEOCOD6", how='left').drop("GEOCOD6", axis=1)
 
         self.graph = None
         self.code_to_muni_label = None
         self.code_to_hosp_label = None
+        # -- codes of the nodes -> labels, as pandas.Series (see '_labels')
+        self.muni_labels = None
+        self.hosp_labels = None
+        # -- macro and micro (CRES) region of the nodes, as arrays indexed by label
+        self.node_regions = None
         self.nodes_metadata = None
         self.edges_metadata = None
 
@@ -59,8 +94,349 @@ class BaseFlux:
     def calculate_fluxes(self):
         pass
 
+    def rolling(self, cube, init_period, final_period, window=3, step=1, multilayer_icd=False, icd_level=None, **kwargs):
+        '''
+            Networks of a series of sliding windows of months, built from the running
+            sums of a flux cube (see FluxCube.rolling).
+
+            The same instance is updated for each window, so each network must be
+            used (e.g. saved with 'to_gml') before moving to the next one.
+
+            Args:
+            -----
+                cube:
+                    FluxCube. Monthly fluxes with the target of the network.
+                init_period:
+                    String or Integer. Format "XXUFYYMM" or YYYYMM of the first month
+                    of the first window.
+                final_period:
+                    String or Integer. Format "XXUFYYMM" or YYYYMM of the last month
+                    of the last window.
+                window:
+                    Integer. Number of months of each window.
+                step:
+                    Integer. Number of months between the beginning of consecutive windows.
+                multilayer_icd:
+                    Bool. Whether we should include information of stratified fluxes
+                    based on ICD-10 groups.
+                icd_level:
+                    String. Level of the ICD-10 groups ('chapter', 'block' or 'category').
+                    Default None, which uses the level of the cube.
+                kwargs:
+                    Options of the fluxes of the network (e.g. 'self_edges' of CityFlux).
+
+            Return:
+            -------
+                Generator of Tuples. (first month, last month, self) of each window,
+                with months as YYYYMM.
+        '''
+        icd_level = cube.icd_level if icd_level is None else icd_level
+        nodes_graph = self.define_network().graph
+        for init, final, edges, icd_edges in cube.rolling(init_period, final_period, window=window, step=step, 
+                                                          multilayer_icd=multilayer_icd, icd_level=icd_level):
+            self.graph = nodes_graph.copy()
+            self.graph.graph['init_period'] = str(init)
+            self.graph.graph['final_period'] = str(final)
+            yield init, final, self._set_edges(edges, icd_edges, icd_level=icd_level, **kwargs)
+
+    def snapshots(self, index, start, end, length, stride=None, **kwargs):
+        '''
+            Networks of a series of windows of dates, built from the cumulative fluxes
+            of a day-resolution index of the admissions (see SnapshotIndex.snapshots).
+
+            The same instance is updated for each window, so each network must be
+            used (e.g. saved with 'to_gml') before moving to the next one.
+
+            Args:
+            -----
+                index:
+                    SnapshotIndex. Daily fluxes with the target of the network.
+                start:
+                    Date. First day of the first window.
+                end:
+                    Date. Last day of the last window.
+                length:
+                    Integer. Number of days of each window.
+                stride:
+                    Integer. Number of days between the beginning of consecutive
+                    windows. Default None, which uses 'length'.
+                kwargs:
+                    Options of the fluxes of the network (e.g. 'self_edges' of CityFlux).
+
+            Return:
+            -------
+                Generator of Tuples. (first day, last day, self) of each window.
+        '''
+        nodes_graph = self.define_network().graph
+        for first, last, edges, icd_edges in index.snapshots(start, end, length, stride=stride):
+            self.graph = nodes_graph.copy()
+            self.graph.graph['init_period'] = str(first)
+            self.graph.graph['final_period'] = str(last)
+            yield first, last, self._set_edges(edges, icd_edges, icd_level=index.icd_level, **kwargs)
+
+    @staticmethod
+    def _label_index(code_to_label):
+        '''
+            Codes -> labels of a dictionary as a pandas.Series indexed by code, for
+            vectorized lookups.
+        '''
+        return pd.Series(list(code_to_label.values()), index=list(code_to_label.keys()), dtype=np.int64)
+
+    @staticmethod
+    def _labels(label_index, codes):
+        '''
+            Label of each code (-1 if the code is not a node of the network).
+        '''
+        position = label_index.index.get_indexer(np.asarray(codes))
+        return np.where(position>=0, label_index.to_numpy()[position], -1)
+
+    @staticmethod
+    def _region_attrs(source_regions, target_regions, source_outside=False, target_outside=False):
+        '''
+            Macro and micro (CRES) regions of the endpoints of the edges, and the
+            region they share (-1 if none).
+
+            The integer regions of one side are given as floats when any flux has a
+            code of that side outside of the network, as done by the left merges with
+            the region tables (the fluxes are filtered after the merge). The shared
+            region is then a float as well, unless no endpoints share the region.
+
+            Args:
+            -----
+                source_regions:
+                    Dictionary. 'macro' and 'cres' -> region of each source node of the edges.
+                target_regions:
+                    Dictionary. Same for the target nodes.
+                source_outside:
+                    Bool. Whether any flux has a source code outside of the network.
+                target_outside:
+                    Bool. Same for the target codes.
+        '''
+        def side(regions, outside):
+            if outside and np.issubdtype(regions.dtype, np.integer):
+                return regions.astype(np.float64)
+            return regions
+
+        attrs, shared = {}, {}
+        for region, name in [('macro', 'macro'), ('cres', 'micro')]:
+            source = side(np.asarray(source_regions[region]), source_outside)
+            target = side(np.asarray(target_regions[region]), target_outside)
+            attrs[f'source_{name}'], attrs[f'target_{name}'] = source, target
+            equal = source==target
+            shared[f'same_{name}'] = np.where(equal, source.astype(np.result_type(source, target)), -1)
+            if not equal.any() and np.issubdtype(shared[f'same_{name}'].dtype, np.floating):
+                shared[f'same_{name}'] = shared[f'same_{name}'].astype(np.int64)
+        attrs = {name: attrs[name] for name in ['source_macro', 'target_macro', 'source_micro', 'target_micro']}
+        return {**attrs, **shared}
+
+    @staticmethod
+    def _cost_attrs(edges, sketch):
+        '''
+            Quantiles of the cost of each edge (e.g. 'cost_p90'), aligned with 'edges'
+            (NaN for edges without sketch).
+        '''
+        quantiles = futils.decategorize(sketch.quantiles(fsketch.COST_QUANTILES), sketch.keys)
+        table = edges[sketch.keys].merge(quantiles, on=sketch.keys, how='left')
+        return { f'cost_p{round(q*100)}': table[q].to_numpy() for q in fsketch.COST_QUANTILES }
+
+    @staticmethod
+    def _distinct_attrs(edges, sketches):
+        '''
+            Estimated number of distinct values of each field per edge (e.g.
+            'distinct_n_aih'), aligned with 'edges' (NaN for edges without sketch).
+        '''
+        attrs = {}
+        for field, sketch in sketches.items():
+            estimate = futils.decategorize(sketch.estimate(), sketch.keys)
+            attrs[f'distinct_{field.lower()}'] = edges[sketch.keys].merge(estimate, on=sketch.keys, how='left')["distinct"].to_numpy()
+        return attrs
+
+    def _stream_fluxes(self, sihpath, init_period, final_period, target, multilayer_icd=False, icd_level='chapter', strata=None, 
+                       cost_sketch=False, distinct=None, stay=False, batch_size=500000):
+        '''
+            Fluxes of the period aggregated out-of-core (see fluxsus.fluxnets.streaming):
+            the files are read in batches of records and reduced as they are read.
+
+            Return:
+            -------
+                edges:
+                    pandas.DataFrame. Columns "MUNIC_RES", target, "sum" and "count" (and
+                    the columns fluxsus.fluxnets.stay.VALUES if 'stay' is True).
+                icd_edges:
+                    pandas.DataFrame. Same as 'edges' per ICD-10 group (column "ICD"),
+                    or None if 'multilayer_icd' is False.
+        '''
+        files = futils.as_dataset(sihpath).files_between(init_period, final_period)
+        acc = FluxAccumulator.from_parquet(files, target, multilayer_icd=multilayer_icd, icd_level=icd_level,
+                                           strata=strata, cost_sketch=cost_sketch, distinct=distinct, stay=stay,
+                                           batch_size=batch_size)
+        if acc.init_period is not None:
+            self.graph.graph['init_period'] = str(acc.init_period)
+            self.graph.graph['final_period'] = str(acc.final_period)
+        edges, icd_edges, self.flux_tensor = acc.fluxes()
+        self.cost_sketch = acc.sketch()
+        self.distinct_sketches = acc.distinct_sketches()
+        return edges, icd_edges
+
+    def _layer_edges(self, icd_edges=None, icd_level='chapter', tensor=None, strata=None):
+        '''
+            Fluxes of all layers of the network (ICD-10 groups, then the layers of
+            each dimension of 'strata') in a single table.
+
+            Args:
+            -----
+                icd_edges:
+                    pandas.DataFrame. Fluxes per ICD-10 group with the labels of the nodes
+                    in the columns "source" and "target", and the columns "ICD", "sum"
+                    and "count".
+                icd_level:
+                    String. Level of the ICD-10 groups of 'icd_edges'.
+                tensor:
+                    pandas.DataFrame. Fluxes per stratum (see strata.flux_tensor) with
+                    the labels of the nodes in the columns "source" and "target".
+                strata:
+                    List of Strings. Dimensions of 'tensor'.
+
+            Return:
+            -------
+                layer_edges:
+                    pandas.DataFrame. Columns "source", "target", "LAYER" (position in
+                    'layers'), "sum" and "count" (and fluxsus.fluxnets.stay.VALUES if all
+                    the fluxes have them). None if there are no layers.
+                layers:
+                    List of Strings. Suffix of the attributes of each layer.
+        '''
+        tables, layers = [], []
+        if icd_edges is not None:
+            icd_layers = futils.icd_layers(icd_level, icd_edges["ICD"].to_numpy())
+            tables.append(icd_edges.assign(LAYER=pd.Index(list(icd_layers.keys())).get_indexer(icd_edges["ICD"].to_numpy())))
+            layers += list(icd_layers.values())
+        if tensor is not None:
+            strata_edges = fstrata.layer_edges(tensor, strata, ["source", "target"])
+            tables.append(strata_edges.assign(LAYER=strata_edges["LAYER"]+len(layers)))
+            layers += fstrata.layer_names(strata)
+        if not len(tables):
+            return None, None
+        values = ["sum", "count"] + (fstay.VALUES if all( fstay.has_stay(table) for table in tables ) else [])
+        return pd.concat([ table[["source", "target", "LAYER"]+values] for table in tables ], ignore_index=True), layers
+
+    @staticmethod
+    def _layer_values(layer_edges):
+        '''
+            Attributes of the fluxes of each row of 'layer_edges': 'admission_count' and
+            'total_cost', and the totals and means of the length of stay and ICU days
+            when available (see fluxsus.fluxnets.stay).
+        '''
+        values = {'admission_count': layer_edges["count"].to_numpy(), 'total_cost': layer_edges["sum"].to_numpy()}
+        if fstay.has_stay(layer_edges):
+            values.update(fstay.stay_attrs(layer_edges))
+        return values
+
+    def _add_edges(self, source, target, attrs, layer_edges=None, layers=None):
+        '''
+            Bulk load of the edges into the graph from columns of attributes.
+
+            Args:
+            -----
+                source:
+                    numpy.ndarray. Label of the source node of each edge.
+                target:
+                    numpy.ndarray. Label of the target node of each edge.
+                attrs:
+                    Dictionary. Name of the attribute -> array aligned with 'source'.
+                layer_edges:
+                    pandas.DataFrame. Fluxes per layer (see '_layer_edges'). Each layer
+                    becomes a set of attributes ('admission_count_ch1', 'total_cost_ch1',
+                    ..., see '_layer_values'), zero for the edges without fluxes in the layer.
+                layers:
+                    List of Strings. Suffix of the attributes of each layer.
+        '''
+        attrs = dict(attrs)
+        self.layers = layers
+        if self.backend == 'sparse':
+            return self._add_sparse_edges(source, target, attrs, layer_edges, layers)
+        self.edge_layer_attrs = {}
+        if layer_edges is not None:
+            # -- fluxes of the (edge, layer) pairs, one sparse matrix per attribute
+            found, row, column = self._layer_positions(source, target, layer_edges)
+            self.edge_layer_attrs = { name: sp.csc_matrix((values[found].astype(np.float64), (row, column)), shape=(len(source), len(layers)))
+                                      for name, values in self._layer_values(layer_edges).items() }
+
+        self.count_sum_edge_with_code = pd.DataFrame({'source': source, 'target': target, **attrs})
+        # -- the attributes of the layers are expanded one column at a time
+        names = list(attrs.keys())
+        columns = [ np.asarray(col).tolist() for col in attrs.values() ]
+        for n, layer in enumerate(layers or []):
+            for name, matrix in self.edge_layer_attrs.items():
+                names.append(f'{name}_{layer}')
+                columns.append(matrix[:, n].toarray().ravel().tolist())
+        values = zip(*columns)
+        self.edges_metadata = [ (u, v, dict(zip(names, row))) for u, v, row in zip(source.tolist(), target.tolist(), values) ]
+        self.graph.add_edges_from(self.edges_metadata)
+        return self
+
+    def _add_sparse_edges(self, source, target, attrs, layer_edges=None, layers=None):
+        '''
+            Same as '_add_edges' for the 'sparse' backend: one CSR matrix per edge
+            attribute, and the fluxes of the layers stacked per attribute.
+        '''
+        layer_attrs = None
+        if layer_edges is not None:
+            n = max(self.graph.nodes)+1
+            found, row, column = self._layer_positions(source, target, layer_edges)
+            rows = column*n + layer_edges["source"].to_numpy()[found]
+            cols = layer_edges["target"].to_numpy()[found]
+            layer_attrs = { name: sp.csr_matrix((values[found].astype(np.float64), (rows, cols)), shape=(len(layers)*n, n))
+                            for name, values in self._layer_values(layer_edges).items() }
+        self.count_sum_edge_with_code = None
+        self.edges_metadata = None
+        self.sparse = SparseNet(self.graph, source, target, attrs, layers=layers, layer_attrs=layer_attrs)
+        return self
+
+    @staticmethod
+    def _layer_positions(source, target, layer_edges):
+        '''
+            Fluxes of 'layer_edges' that belong to an edge and to a layer (mask), with
+            the position of their edge and their layer.
+        '''
+        edge_key = (source.astype(np.int64) << 32) + target
+        layer_key = (layer_edges["source"].to_numpy().astype(np.int64) << 32) + layer_edges["target"].to_numpy()
+        row = pd.Index(edge_key).get_indexer(layer_key)
+        column = layer_edges["LAYER"].to_numpy()
+        found = (row>=0) & (column>=0)
+        return found, row[found], column[found]
+
+    def to_networkx(self):
+        '''
+            networkx graph of the network, built from the sparse matrices for the
+            'sparse' backend.
+        '''
+        if self.backend == 'sparse' and self.sparse is not None:
+            return self.sparse.to_networkx()
+        return self.graph
+
+    def to_gml(self, output):
+        if self.graph is not None:
+            nx.write_gml(self.to_networkx(), os.path.join(output))
+
 
 class CityFlux(BaseFlux):
+    def __init__(self, cnes_df, geodata_df, backend='networkx', national=False):
+        '''
+            Flux network between cities (see BaseFlux).
+
+            Args:
+            -----
+                national:
+                    Bool. Whether to include all the municipalities of 'geodata_df' (e.g.
+                    the 5,570 of IBGE, see 'define_network'), so fluxes between states
+                    are kept. Region fields (MACRO_ID, CRES_ID, ...) become optional.
+        '''
+        super().__init__(cnes_df, geodata_df, backend=backend)
+        self.national = national
+        # -- attributes of the nodes, one column per attribute and one row per label
+        self.node_table = None
+
     def define_network(self):
         '''
             Define the nodes (cities) of the network and their metadata.
@@ -68,6 +444,8 @@ class CityFlux(BaseFlux):
             Metadata refers to the name and code of a city, and the ids of the
             micro/macro regions for which the city belongs to. 
         '''
+        if self.national:
+            return self._define_national_network()
         self.graph = nx.DiGraph()
 
         municip_codes = self.geodata_df["GEOCOD6"].tolist()
@@ -80,6 +458,7 @@ class CityFlux(BaseFlux):
 
         # -- return -1 if city code not included in the network
         self.code_to_muni_label = defaultdict(lambda: -1, { municip_codes[n]: n for n in range(len(municip_codes)) })
+        self.node_regions = {'macro': np.array(macro_ids), 'cres': np.array(cres_ids)}
 
         self.nodes_metadata = []
         for label, mun_code in enumerate(municip_codes):
@@ -94,11 +473,53 @@ class CityFlux(BaseFlux):
                          'lon': lon_[label] } )
             )
         self.graph.add_nodes_from(self.nodes_metadata)
+        self.muni_labels = self._label_index(self.code_to_muni_label)
         for v in self.graph.nodes():
             self.geopos_net.update( {v: np.array([self.graph.nodes[v]['lon'], self.graph.nodes[v]['lat']])} )
         return self
 
-    def calculate_fluxes(self, sih_df, multilayer_icd=False, self_edges=False):
+    def _define_national_network(self):
+        '''
+            Nodes of all the municipalities of 'geodata_df', labeled from 0 in the
+            order of their codes (6 digits, as in the SIHSUS files, the IBGE check
+            digit is dropped). Their attributes are kept as columns of 'node_table',
+            and fields missing from 'geodata_df' are filled with -1 (ids), '' (names)
+            or NaN (coordinates).
+        '''
+        self.graph = nx.DiGraph()
+        geodata_df = self.geodata_df.assign(GEOCOD6=self.geodata_df["GEOCOD6"].astype(str).str[:6])
+        geodata_df = geodata_df.drop_duplicates(subset="GEOCOD6").sort_values(by="GEOCOD6").reset_index(drop=True)
+
+        def field(name, default):
+            if name in geodata_df.columns:
+                return geodata_df[name].to_numpy()
+            return np.full(geodata_df.shape[0], default)
+
+        codes = geodata_df["GEOCOD6"].to_numpy()
+        self.node_table = pd.DataFrame({'municipio_code': codes,
+                                        'municipio_name': field("NM_MUNICIP", ''),
+                                        'uf_code': geodata_df["GEOCOD6"].str[:2].to_numpy(),
+                                        'macro_id': field("MACRO_ID", -1),
+                                        'macro_new_id': field("MACRO_ID_PROPOSAL", -1), # -- optional
+                                        'macro_name': field("MACRO_NOME", ''),
+                                        'cres_id': field("CRES_ID", -1),
+                                        'lat': field("municip_lat", np.nan).astype(np.float64),
+                                        'lon': field("municip_lon", np.nan).astype(np.float64)})
+
+        labels = np.arange(len(codes))
+        # -- codes -> labels only as a pandas.Series ('code_to_muni_label' is not built)
+        self.muni_labels = pd.Series(labels, index=codes, dtype=np.int64)
+        self.code_to_muni_label = None
+        self.node_regions = {'macro': self.node_table["macro_id"].to_numpy(), 'cres': self.node_table["cres_id"].to_numpy()}
+        # -- attributes written in bulk, one column at a time
+        self.graph.add_nodes_from(labels.tolist())
+        for name in self.node_table.columns:
+            nx.set_node_attributes(self.graph, dict(zip(labels.tolist(), self.node_table[name].tolist())), name)
+        self.geopos_net = dict(zip(labels.tolist(), self.node_table[["lon", "lat"]].to_numpy()))
+        return self
+
+    def calculate_fluxes(self, sih_df, multilayer_icd=False, self_edges=False, icd_level='chapter', strata=None, cost_sketch=False, 
+                         distinct=None, stay=False):
         '''
             Define the directed edges (flux of people and money between cities) of the 
             network and their metadata.
@@ -112,86 +533,167 @@ class CityFlux(BaseFlux):
                     pandas.DataFrame.
                 multilayer_icd:
                     Bool. Whether we should include information of stratified fluxes
-                    based on ICD-10 chapters.
+                    based on ICD-10 groups.
+                icd_level:
+                    String. Level of the ICD-10 groups: 'chapter' (default), 'block' or
+                    'category' (see fluxsus.icd10).
+                strata:
+                    List of Strings. Other dimensions to stratify the fluxes by ('age',
+                    'death', 'icu', 'complexity' and/or 'specialty', see 
+                    fluxsus.fluxnets.strata), all computed in a single groupby. Each
+                    layer becomes a pair of edge attributes (e.g. 'admission_count_death_yes'),
+                    and the fluxes per joint stratum are kept in 'flux_tensor'.
+                cost_sketch:
+                    Bool. Whether to build a mergeable sketch of the cost of the admissions
+                    of each edge (kept in 'cost_sketch', see fluxsus.fluxnets.sketches), and
+                    include the quantiles of the cost as edge attributes ('cost_p50',
+                    'cost_p90' and 'cost_p99').
+                distinct:
+                    List of Strings. Fields whose distinct values are counted per edge
+                    (e.g. ["N_AIH", "CNES"]) by mergeable HyperLogLog sketches (kept in
+                    'distinct_sketches', see fluxsus.fluxnets.sketches), included as edge
+                    attributes (e.g. 'distinct_n_aih').
+                stay:
+                    Bool. Whether to include the total and mean length of stay and ICU days
+                    of the admissions ('total_stay_days', 'mean_stay_days', 'total_icu_days'
+                    and 'mean_icu_days'), per edge and per layer, computed in the same
+                    groupby as the counts and costs (see fluxsus.fluxnets.stay).
         '''
         # -- define the period of the data that was used to define the fluxes.
         if 'COMPETEN' in sih_df.columns:
             self.graph.graph['init_period'] = sih_df["COMPETEN"].min()
             self.graph.graph['final_period'] = sih_df["COMPETEN"].max()
 
+        # -- number of admissions, total cost (and length of stay) of each edge in a single groupby
+        edges = fstay.aggregate(sih_df, ["MUNIC_RES", "MUNIC_MOV"], stay=stay)
+        icd_edges = None
+        # -- fluxes stratified by ICD-10 group: single groupby over the group of each record
         if multilayer_icd:
-            sih_df["DIAG_PRINC3"] = sih_df["DIAG_PRINC"].apply(lambda x: x[:3])
+            group = icd10.classify(sih_df["DIAG_PRINC"], level=icd_level).to_numpy()
+            strat_df = sih_df[["MUNIC_RES", "MUNIC_MOV", "VAL_TOT"]+fstay.fields(sih_df, stay)][group>=0].assign(ICD=group[group>=0])
+            icd_edges = fstay.aggregate(strat_df, ["MUNIC_RES", "MUNIC_MOV", "ICD"], stay=stay)
+        # -- fluxes stratified by the other dimensions: single groupby over the joint stratum of each record
+        self.flux_tensor = fstrata.flux_tensor(sih_df, "MUNIC_RES", "MUNIC_MOV", strata, stay=stay) if strata else None
+        # -- sketches of the cost of the admissions of each edge
+        self.cost_sketch = fsketch.CostSketch.from_records(sih_df, ["MUNIC_RES", "MUNIC_MOV"]) if cost_sketch else None
+        self.distinct_sketches = { field: fsketch.DistinctSketch.from_records(sih_df, ["MUNIC_RES", "MUNIC_MOV"], field) for field in (distinct or []) }
+        return self._set_edges(edges, icd_edges, self_edges, icd_level=icd_level, tensor=self.flux_tensor, strata=strata, sketch=self.cost_sketch,
+                               distinct=self.distinct_sketches)
+
+    def calculate_fluxes_from_cube(self, cube, init_period, final_period, multilayer_icd=False, self_edges=False, icd_level=None, 
+                                   cost_sketch=False, distinct=None):
+        '''
+            Same as 'calculate_fluxes', with the fluxes of the period summed from the
+            monthly aggregates of a flux cube instead of the records of the admissions.
 
-        self.count_sum_edge_with_code = sih_df.groupby(["MUNIC_RES", "MUNIC_MOV"])["VAL_TOT"].agg(['sum', 'count']).reset_index()
+            Args:
+            -----
+                cube:
+                    FluxCube. Monthly fluxes with target "MUNIC_MOV" (see fluxsus.fluxnets.fluxcube).
+                init_period:
+                    String. Format "XXUFYYMM" (or Integer YYYYMM) of the first month.
+                final_period:
+                    String. Format "XXUFYYMM" (or Integer YYYYMM) of the last month.
+                multilayer_icd:
+                    Bool. Whether we should include information of stratified fluxes
+                    based on ICD-10 groups.
+                self_edges:
+                    Bool. Whether to include self-edges in the flux network.
+                icd_level:
+                    String. Level of the ICD-10 groups, the level of the cube or a coarser
+                    one. Default None, which uses the level of the cube.
+                cost_sketch:
+                    Bool. Whether to include the quantiles of the cost, merged from the
+                    monthly sketches of the cube (see FluxCube.cost_sketch).
+                distinct:
+                    List of Strings. Fields whose distinct values per edge are included,
+                    merged from the monthly sketches of the cube (see FluxCube.distinct_sketch).
+        '''
+        periods = cube.periods_between(init_period, final_period)
+        if len(periods):
+            self.graph.graph['init_period'] = str(periods[0])
+            self.graph.graph['final_period'] = str(periods[-1])
+        icd_level = cube.icd_level if icd_level is None else icd_level
+        edges, icd_edges = cube.aggregate(init_period, final_period, multilayer_icd=multilayer_icd, icd_level=icd_level)
+        self.cost_sketch = cube.cost_sketch(init_period, final_period) if cost_sketch else None
+        self.distinct_sketches = { field: cube.distinct_sketch(field, init_period, final_period) for field in (distinct or []) }
+        return self._set_edges(edges, icd_edges, self_edges, icd_level=icd_level, sketch=self.cost_sketch, distinct=self.distinct_sketches)
+
+    def calculate_fluxes_streaming(self, sihpath, init_period, final_period, multilayer_icd=False, self_edges=False, 
+                                   icd_level='chapter', strata=None, cost_sketch=False, distinct=None, stay=False, 
+                                   batch_size=500000):
+        '''
+            Same as 'calculate_fluxes', reading the SIHSUS files of the period in batches
+            of records that are reduced to partial fluxes as they are read. The memory
+            used is bounded by the number of distinct edges instead of the number of
+            admissions, for periods too large to be loaded at once.
+
+            Args:
+            -----
+                sihpath:
+                    String or SIHDataset. Folder containing the SIHSUS parquet files, or
+                    its catalog (see fluxsus.fluxnets.catalog).
+                init_period:
+                    String. Format "XXUFYYMM" of the first month.
+                final_period:
+                    String. Format "XXUFYYMM" of the last month.
+                batch_size:
+                    Integer. Maximum number of records read at once.
+
+                (other arguments as in 'calculate_fluxes')
+        '''
+        edges, icd_edges = self._stream_fluxes(sihpath, init_period, final_period, "MUNIC_MOV", multilayer_icd=multilayer_icd,
+                                               icd_level=icd_level, strata=strata, cost_sketch=cost_sketch, distinct=distinct,
+                                               stay=stay, batch_size=batch_size)
+        return self._set_edges(edges, icd_edges, self_edges, icd_level=icd_level, tensor=self.flux_tensor, strata=strata, sketch=self.cost_sketch,
+                               distinct=self.distinct_sketches)
+
+    def _set_edges(self, edges, icd_edges, self_edges=False, icd_level='chapter', tensor=None, strata=None, sketch=None, distinct=None):
+        '''
+            Add the edges to the network given the aggregated fluxes (sum and count
+            of VAL_TOT) per pair of nodes, and per ICD-10 group if 'icd_edges' is
+            not None (same fluxes with the column "ICD", the id of the group at the
+            level 'icd_level', see fluxsus.icd10), and per stratum of the dimensions
+            'strata' if 'tensor' is not None (see fluxsus.fluxnets.strata). The quantiles
+            of the cost are included if 'sketch' is not None, and the distinct counts
+            of the fields of 'distinct' (dictionary field -> DistinctSketch), see
+            fluxsus.fluxnets.sketches. The length of stay and ICU days are included
+            if the fluxes have their sums (see fluxsus.fluxnets.stay).
+        '''
+        edges = futils.decategorize(edges, ["MUNIC_RES", "MUNIC_MOV"])
         # -- if 'self_edges' is False, removes self-edges of the network.
         if not self_edges:
-            self.count_sum_edge_with_code = self.count_sum_edge_with_code[self.count_sum_edge_with_code["MUNIC_RES"]!=self.count_sum_edge_with_code["MUNIC_MOV"]]
-        # -- get source node info
-        self.count_sum_edge_with_code = self.count_sum_edge_with_code.merge(self.geodata_df[["GEOCOD6", "MACRO_ID", "CRES_ID", "MACRO_NOME"]], left_on="MUNIC_RES", right_on="GEOCOD6", how="left")
-        self.count_sum_edge_with_code = self.count_sum_edge_with_code.rename({"MACRO_ID": "source_macro", "CRES_ID": "source_cres", "MACRO_NOME": "source_macro_nome"}, axis=1)
-        # -- get target node info
-        self.count_sum_edge_with_code = self.count_sum_edge_with_code.merge(self.geodata_df[["GEOCOD6", "MACRO_ID", "CRES_ID", "MACRO_NOME"]], left_on="MUNIC_MOV", right_on="GEOCOD6", how="left")
-        self.count_sum_edge_with_code = self.count_sum_edge_with_code.rename({"MACRO_ID": "target_macro", "CRES_ID": "target_cres", "MACRO_NOME": "target_macro_nome"}, axis=1)
-        # -- auxiliary metadata (probably for drawing)
-        self.count_sum_edge_with_code["same_micro"] = self.count_sum_edge_with_code[["source_cres", "target_cres"]].apply(lambda x: x["source_cres"] if x["source_cres"]==x["target_cres"] else -1, axis=1)
-        self.count_sum_edge_with_code["same_macro"] = self.count_sum_edge_with_code[["source_macro", "target_macro"]].apply(lambda x: x["source_macro"] if x["source_macro"]==x["target_macro"] else -1, axis=1)
-
-        self.count_sum_edge_with_code["MUNIC_RES"] = self.count_sum_edge_with_code["MUNIC_RES"].apply(lambda x: self.code_to_muni_label[x])
-        self.count_sum_edge_with_code["MUNIC_MOV"] = self.count_sum_edge_with_code["MUNIC_MOV"].apply(lambda x: self.code_to_muni_label[x])
-        count_sum_edge_with_label = self.count_sum_edge_with_code[(self.count_sum_edge_with_code["MUNIC_RES"]!=-1) & (self.count_sum_edge_with_code["MUNIC_MOV"]!=-1)]
-
-        # -- include multilayered information on edges (fluxes stratified by ICD-10 chapter)
-        if multilayer_icd:
-            chapters = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 
-                        'IX', 'X', 'XI', 'XII', 'XIII', 'XIV', 'XV', 'XVI',
-                        'XVII', 'XVIII', 'XIX', 'XX', 'XXI', 'XXII']
-            for chapter in chapters:
-                ch_codes = futils.filter_chapter(chapter)
-                count_sum_edge_strat_icd = sih_df[sih_df["DIAG_PRINC3"].isin(ch_codes)].groupby(["MUNIC_RES", "MUNIC_MOV"])["VAL_TOT"].agg(['sum', 'count']).reset_index().rename({'sum': f'sum_ch{chapter}', 'count': f'count_ch{chapter}'}, axis=1)
-                count_sum_edge_strat_icd = count_sum_edge_strat_icd[count_sum_edge_strat_icd["MUNIC_RES"]!=count_sum_edge_strat_icd["MUNIC_MOV"]]
-                count_sum_edge_strat_icd["MUNIC_RES"] = count_sum_edge_strat_icd["MUNIC_RES"].apply(lambda x: self.code_to_muni_label[x])
-                count_sum_edge_strat_icd["MUNIC_MOV"] = count_sum_edge_strat_icd["MUNIC_MOV"].apply(lambda x: self.code_to_muni_label[x])
-                count_sum_edge_strat_icd = count_sum_edge_strat_icd[(count_sum_edge_strat_icd["MUNIC_RES"]!=-1) & (count_sum_edge_strat_icd["MUNIC_MOV"]!=-1)]
-                # -- join with the main dataframe
-                count_sum_edge_with_label = count_sum_edge_with_label.merge(count_sum_edge_strat_icd, on=["MUNIC_RES", "MUNIC_MOV"], how='left').fillna(0)
-
-        self.edges_metadata = []
-        for edge, row in count_sum_edge_with_label.iterrows():
-            self.edges_metadata.append(
-                (row["MUNIC_RES"], row["MUNIC_MOV"], {'admission_count': row['count'], 'total_cost': row['sum'], 
-                                                      'source_macro': row['source_macro'], 'target_macro': row['target_macro'],
-                                                      'source_micro': row['source_cres'], 'target_micro': row['target_cres'],
-                                                      'same_macro' : row['same_macro'], 'same_micro': row['same_micro'],
-                                                      'admission_count_ch1': row['count_chI'], 'total_cost_ch1': row['sum_chI'],
-                                                      'admission_count_ch2': row['count_chII'], 'total_cost_ch2': row['sum_chII'],
-                                                      'admission_count_ch3': row['count_chIII'], 'total_cost_ch3': row['sum_chIII'],
-                                                      'admission_count_ch4': row['count_chIV'], 'total_cost_ch4': row['sum_chIV'],
-                                                      'admission_count_ch5': row['count_chV'], 'total_cost_ch5': row['sum_chV'],
-                                                      'admission_count_ch6': row['count_chVI'], 'total_cost_ch6': row['sum_chVI'],
-                                                      'admission_count_ch7': row['count_chVII'], 'total_cost_ch7': row['sum_chVII'],
-                                                      'admission_count_ch8': row['count_chVIII'], 'total_cost_ch8': row['sum_chVIII'],
-                                                      'admission_count_ch9': row['count_chIX'], 'total_cost_ch9': row['sum_chIX'],
-                                                      'admission_count_ch10': row['count_chX'], 'total_cost_ch10': row['sum_chX'],
-                                                      'admission_count_ch11': row['count_chXI'], 'total_cost_ch11': row['sum_chXI'],
-                                                      'admission_count_ch12': row['count_chXII'], 'total_cost_ch12': row['sum_chXII'],
-                                                      'admission_count_ch13': row['count_chXIII'], 'total_cost_ch13': row['sum_chXIII'],
-                                                      'admission_count_ch14': row['count_chXIV'], 'total_cost_ch14': row['sum_chXIV'],
-                                                      'admission_count_ch15': row['count_chXV'], 'total_cost_ch15': row['sum_chXV'],
-                                                      'admission_count_ch16': row['count_chXVI'], 'total_cost_ch16': row['sum_chXVI'],
-                                                      'admission_count_ch17': row['count_chXVII'], 'total_cost_ch17': row['sum_chXVII'],
-                                                      'admission_count_ch18': row['count_chXVIII'], 'total_cost_ch18': row['sum_chXVIII'],
-                                                      'admission_count_ch19': row['count_chXIX'], 'total_cost_ch19': row['sum_chXIX'],
-                                                      'admission_count_ch20': row['count_chXX'], 'total_cost_ch20': row['sum_chXX'],
-                                                      'admission_count_ch21': row['count_chXXI'], 'total_cost_ch21': row['sum_chXXI'],
-                                                      'admission_count_ch22': row['count_chXXII'], 'total_cost_ch22': row['sum_chXXII'], })
-            )
-        self.graph.add_edges_from(self.edges_metadata)
-        return self
-    
-    def to_gml(self, output):
-        if self.graph is not None:
-            nx.write_gml(self.graph, os.path.join(output))
+            edges = edges[edges["MUNIC_RES"]!=edges["MUNIC_MOV"]]
+        # -- labels of the nodes, keeping only the edges between cities of the network
+        source = self._labels(self.muni_labels, edges["MUNIC_RES"])
+        target = self._labels(self.muni_labels, edges["MUNIC_MOV"])
+        valid = (source!=-1) & (target!=-1)
+        outside = ((source==-1).any(), (target==-1).any())
+        edges, source, target = edges[valid], source[valid], target[valid]
+
+        # -- regions of the source and target nodes (and the shared ones, auxiliary metadata probably for drawing)
+        attrs = {'admission_count': edges["count"].to_numpy(), 'total_cost': edges["sum"].to_numpy(),
+                 **self._region_attrs({region: ids[source] for region, ids in self.node_regions.items()},
+                                      {region: ids[target] for region, ids in self.node_regions.items()}, *outside)}
+        if sketch is not None:
+            attrs.update(self._cost_attrs(edges, sketch))
+        if distinct:
+            attrs.update(self._distinct_attrs(edges, distinct))
+        if fstay.has_stay(edges):
+            attrs.update(fstay.stay_attrs(edges))
+
+        # -- include multilayered information on edges (fluxes stratified by ICD-10 group)
+        if icd_edges is not None:
+            icd_edges = futils.decategorize(icd_edges.copy(), ["MUNIC_RES", "MUNIC_MOV"])
+            icd_edges["source"] = self._labels(self.muni_labels, icd_edges["MUNIC_RES"])
+            icd_edges["target"] = self._labels(self.muni_labels, icd_edges["MUNIC_MOV"])
+        if tensor is not None:
+            tensor = futils.decategorize(tensor.copy(), ["MUNIC_RES", "MUNIC_MOV"])
+            tensor["source"] = self._labels(self.muni_labels, tensor["MUNIC_RES"])
+            tensor["target"] = self._labels(self.muni_labels, tensor["MUNIC_MOV"])
+        return self._add_edges(source, target, attrs, *self._layer_edges(icd_edges, icd_level, tensor, strata))
     
+
 class CityHospitalFlux(BaseFlux):
     
     def define_network(self):
@@ -215,6 +717,7 @@ class CityHospitalFlux(BaseFlux):
 
         # -- return -1 if city code not included in the network
         self.code_to_muni_label = defaultdict(lambda: -1, { municip_codes[n]: n for n in range(len(municip_codes)) })
+        self.node_regions = {'macro': np.array(macro_ids), 'cres': np.array(cres_ids)}
 
         self.nodes_metadata = []
         for label, mun_code in enumerate(municip_codes):
@@ -241,6 +744,9 @@ class CityHospitalFlux(BaseFlux):
 
         # -- return -1 if hospital code not included in the network
         self.code_to_hosp_label = defaultdict(lambda: -1, { hospital_codes[n]: n+label for n in range(len(hospital_codes)) })
+        # -- regions of the hospitals, indexed by label minus 'hospital_offset'
+        self.hospital_offset = label
+        self.hospital_regions = {'macro': np.array(macro_ids), 'cres': np.array(cres_ids)}
 
         for label_hosp, hosp_code in enumerate(hospital_codes):
             self.nodes_metadata.append(
@@ -256,12 +762,15 @@ class CityHospitalFlux(BaseFlux):
             )
         
         self.graph.add_nodes_from(self.nodes_metadata)
+        self.muni_labels = self._label_index(self.code_to_muni_label)
+        self.hosp_labels = self._label_index(self.code_to_hosp_label)
         return self
 
-    def calculate_fluxes(self, sih_df, multilayer_icd=False):
+    def calculate_fluxes(self, sih_df, multilayer_icd=False, icd_level='chapter', strata=None, cost_sketch=False, distinct=None, 
+                         stay=False):
         '''
             Define the directed edges (flux of people and money between cities and hospitals) 
-            of the network and their metadata.
+            of the network and their metadata (see CityFlux.calculate_fluxes for the options).
 
             Metadata refers to the name and code of a city, and the ids of the
             micro/macro regions for which the city belongs to. 
@@ -270,76 +779,172 @@ class CityHospitalFlux(BaseFlux):
             self.graph.graph['init_period'] = sih_df["COMPETEN"].min()
             self.graph.graph['final_period'] = sih_df["COMPETEN"].max()
 
+        # -- number of admissions, total cost (and length of stay) of each edge in a single groupby
+        edges = fstay.aggregate(sih_df, ["MUNIC_RES", "CNES"], stay=stay)
+        icd_edges = None
+        # -- fluxes stratified by ICD-10 group: single groupby over the group of each record
         if multilayer_icd:
-            sih_df["DIAG_PRINC3"] = sih_df["DIAG_PRINC"].apply(lambda x: x[:3])
+            group = icd10.classify(sih_df["DIAG_PRINC"], level=icd_level).to_numpy()
+            strat_df = sih_df[["MUNIC_RES", "CNES", "VAL_TOT"]+fstay.fields(sih_df, stay)][group>=0].assign(ICD=group[group>=0])
+            icd_edges = fstay.aggregate(strat_df, ["MUNIC_RES", "CNES", "ICD"], stay=stay)
+        # -- fluxes stratified by the other dimensions: single groupby over the joint stratum of each record
+        self.flux_tensor = fstrata.flux_tensor(sih_df, "MUNIC_RES", "CNES", strata, stay=stay) if strata else None
+        # -- sketches of the cost of the admissions of each edge
+        self.cost_sketch = fsketch.CostSketch.from_records(sih_df, ["MUNIC_RES", "CNES"]) if cost_sketch else None
+        self.distinct_sketches = { field: fsketch.DistinctSketch.from_records(sih_df, ["MUNIC_RES", "CNES"], field) for field in (distinct or []) }
+        return self._set_edges(edges, icd_edges, icd_level=icd_level, tensor=self.flux_tensor, strata=strata, sketch=self.cost_sketch,
+                               distinct=self.distinct_sketches)
+
+    def calculate_fluxes_from_cube(self, cube, init_period, final_period, multilayer_icd=False, icd_level=None, cost_sketch=False, 
+                                   distinct=None):
+        '''
+            Same as 'calculate_fluxes', with the fluxes of the period summed from the
+            monthly aggregates of a flux cube instead of the records of the admissions.
 
+            Args:
+            -----
+                cube:
+                    FluxCube. Monthly fluxes with target "CNES" (see fluxsus.fluxnets.fluxcube).
+                init_period:
+                    String. Format "XXUFYYMM" (or Integer YYYYMM) of the first month.
+                final_period:
+                    String. Format "XXUFYYMM" (or Integer YYYYMM) of the last month.
+                multilayer_icd:
+                    Bool. Whether we should include information of stratified fluxes
+                    based on ICD-10 groups.
+                icd_level:
+                    String. Level of the ICD-10 groups, the level of the cube or a coarser
+                    one. Default None, which uses the level of the cube.
+                cost_sketch:
+                    Bool. Whether to include the quantiles of the cost, merged from the
+                    monthly sketches of the cube (see FluxCube.cost_sketch).
+                distinct:
+                    List of Strings. Fields whose distinct values per edge are included,
+                    merged from the monthly sketches of the cube (see FluxCube.distinct_sketch).
+        '''
+        periods = cube.periods_between(init_period, final_period)
+        if len(periods):
+            self.graph.graph['init_period'] = str(periods[0])
+            self.graph.graph['final_period'] = str(periods[-1])
+        icd_level = cube.icd_level if icd_level is None else icd_level
+        edges, icd_edges = cube.aggregate(init_period, final_period, multilayer_icd=multilayer_icd, icd_level=icd_level)
+        self.cost_sketch = cube.cost_sketch(init_period, final_period) if cost_sketch else None
+        self.distinct_sketches = { field: cube.distinct_sketch(field, init_period, final_period) for field in (distinct or []) }
+        return self._set_edges(edges, icd_edges, icd_level=icd_level, sketch=self.cost_sketch, distinct=self.distinct_sketches)
+
+    def calculate_fluxes_streaming(self, sihpath, init_period, final_period, multilayer_icd=False, icd_level='chapter', 
+                                   strata=None, cost_sketch=False, distinct=None, stay=False, batch_size=500000):
+        '''
+            Same as 'calculate_fluxes', reading the SIHSUS files of the period in batches
+            of records that are reduced to partial fluxes as they are read (see
+            CityFlux.calculate_fluxes_streaming).
+        '''
+        edges, icd_edges = self._stream_fluxes(sihpath, init_period, final_period, "CNES", multilayer_icd=multilayer_icd,
+                                               icd_level=icd_level, strata=strata, cost_sketch=cost_sketch, distinct=distinct,
+                                               stay=stay, batch_size=batch_size)
+        return self._set_edges(edges, icd_edges, icd_level=icd_level, tensor=self.flux_tensor, strata=strata, sketch=self.cost_sketch,
+                               distinct=self.distinct_sketches)
 
-        # -- total cost (slow way - find faster way - vectorize!)
-        self.count_sum_edge_with_code = sih_df.groupby(["MUNIC_RES", "CNES"])["VAL_TOT"].agg(['sum', 'count']).reset_index()
+    def _set_edges(self, edges, icd_edges, icd_level='chapter', tensor=None, strata=None, sketch=None, distinct=None):
+        '''
+            Add the edges to the network given the aggregated fluxes (sum and count
+            of VAL_TOT) per pair of nodes, and per ICD-10 group if 'icd_edges' is
+            not None (same fluxes with the column "ICD", the id of the group at the
+            level 'icd_level', see fluxsus.icd10), and per stratum of the dimensions
+            'strata' if 'tensor' is not None (see fluxsus.fluxnets.strata). The quantiles
+            of the cost are included if 'sketch' is not None, and the distinct counts
+            of the fields of 'distinct' (dictionary field -> DistinctSketch), see
+            fluxsus.fluxnets.sketches. The length of stay and ICU days are included
+            if the fluxes have their sums (see fluxsus.fluxnets.stay).
+        '''
+        edges = futils.decategorize(edges, ["MUNIC_RES", "CNES"])
         # -- in this case, there is no self-edges, only cities where the hospital is
-        #self.count_sum_edge_with_code = self.count_sum_edge_with_code[self.count_sum_edge_with_code["MUNIC_RES"]!=self.count_sum_edge_with_code["MUNIC_MOV"]]
-        # -- get source node info
-        self.count_sum_edge_with_code = self.count_sum_edge_with_code.merge(self.geodata_df[["GEOCOD6", "MACRO_ID", "CRES_ID", "MACRO_NOME"]], left_on="MUNIC_RES", right_on="GEOCOD6", how="left")
-        self.count_sum_edge_with_code = self.count_sum_edge_with_code.rename({"MACRO_ID": "source_macro", "CRES_ID": "source_cres", "MACRO_NOME": "source_macro_nome"}, axis=1)
-        # -- get target node info
-        self.count_sum_edge_with_code = self.count_sum_edge_with_code.merge(self.cnes_df[["CNES", "MACRO_ID", "CRES_ID", "MACRO_NOME"]], left_on="CNES", right_on="CNES", how="left")
-        self.count_sum_edge_with_code = self.count_sum_edge_with_code.rename({"MACRO_ID": "target_macro", "CRES_ID": "target_cres", "MACRO_NOME": "target_macro_nome"}, axis=1)
-        # -- auxiliary metadata (for drawing)
-        self.count_sum_edge_with_code["same_micro"] = self.count_sum_edge_with_code[["source_cres", "target_cres"]].apply(lambda x: x["source_cres"] if x["source_cres"]==x["target_cres"] else -1, axis=1)
-        self.count_sum_edge_with_code["same_macro"] = self.count_sum_edge_with_code[["source_macro", "target_macro"]].apply(lambda x: x["source_macro"] if x["source_macro"]==x["target_macro"] else -1, axis=1)
-
-        self.count_sum_edge_with_code["MUNIC_RES"] = self.count_sum_edge_with_code["MUNIC_RES"].apply(lambda x: self.code_to_muni_label[x])
-        self.count_sum_edge_with_code["CNES"] = self.count_sum_edge_with_code["CNES"].apply(lambda x: self.code_to_hosp_label[x])
-        count_sum_edge_with_label = self.count_sum_edge_with_code[(self.count_sum_edge_with_code["MUNIC_RES"]!=-1) & (self.count_sum_edge_with_code["CNES"]!=-1)]
-
-        # -- include multilayered information on edges (fluxes stratified by ICD-10 chapter)
-        if multilayer_icd:
-            chapters = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII', 'VIII', 
-                        'IX', 'X', 'XI', 'XII', 'XIII', 'XIV', 'XV', 'XVI',
-                        'XVII', 'XVIII', 'XIX', 'XX', 'XXI', 'XXII']
-            for chapter in chapters:
-                ch_codes = futils.filter_chapter(chapter)
-                count_sum_edge_strat_icd = sih_df[sih_df["DIAG_PRINC3"].isin(ch_codes)].groupby(["MUNIC_RES", "CNES"])["VAL_TOT"].agg(['sum', 'count']).reset_index().rename({'sum': f'sum_ch{chapter}', 'count': f'count_ch{chapter}'}, axis=1)
-                count_sum_edge_strat_icd = count_sum_edge_strat_icd[count_sum_edge_strat_icd["MUNIC_RES"]!=count_sum_edge_strat_icd["CNES"]]
-                count_sum_edge_strat_icd["MUNIC_RES"] = count_sum_edge_strat_icd["MUNIC_RES"].apply(lambda x: self.code_to_muni_label[x])
-                count_sum_edge_strat_icd["CNES"] = count_sum_edge_strat_icd["CNES"].apply(lambda x: self.code_to_muni_label[x])
-                count_sum_edge_strat_icd = count_sum_edge_strat_icd[(count_sum_edge_strat_icd["MUNIC_RES"]!=-1) & (count_sum_edge_strat_icd["CNES"]!=-1)]
-                # -- join with the main dataframe
-                count_sum_edge_with_label = count_sum_edge_with_label.merge(count_sum_edge_strat_icd, on=["MUNIC_RES", "CNES"], how='left').fillna(0)
-
-        self.edges_metadata = []
-        for edge, row in count_sum_edge_with_label.iterrows():
-            self.edges_metadata.append(
-                (row["MUNIC_RES"], row["CNES"], {'admission_count': row['count'], 'total_cost': row['sum'], 
-                                                 'source_macro': row['source_macro'], 'target_macro': row['target_macro'],
-                                                 'source_micro': row['source_cres'], 'target_micro': row['target_cres'],
-                                                 'same_macro' : row['same_macro'], 'same_micro': row['same_micro'],
-                                                 'admission_count_ch1': row['count_chI'], 'total_cost_ch1': row['sum_chI'],
-                                                 'admission_count_ch2': row['count_chII'], 'total_cost_ch2': row['sum_chII'],
-                                                 'admission_count_ch3': row['count_chIII'], 'total_cost_ch3': row['sum_chIII'],
-                                                 'admission_count_ch4': row['count_chIV'], 'total_cost_ch4': row['sum_chIV'],
-                                                 'admission_count_ch5': row['count_chV'], 'total_cost_ch5': row['sum_chV'],
-                                                 'admission_count_ch6': row['count_chVI'], 'total_cost_ch6': row['sum_chVI'],
-                                                 'admission_count_ch7': row['count_chVII'], 'total_cost_ch7': row['sum_chVII'],
-                                                 'admission_count_ch8': row['count_chVIII'], 'total_cost_ch8': row['sum_chVIII'],
-                                                 'admission_count_ch9': row['count_chIX'], 'total_cost_ch9': row['sum_chIX'],
-                                                 'admission_count_ch10': row['count_chX'], 'total_cost_ch10': row['sum_chX'],
-                                                 'admission_count_ch11': row['count_chXI'], 'total_cost_ch11': row['sum_chXI'],
-                                                 'admission_count_ch12': row['count_chXII'], 'total_cost_ch12': row['sum_chXII'],
-                                                 'admission_count_ch13': row['count_chXIII'], 'total_cost_ch13': row['sum_chXIII'],
-                                                 'admission_count_ch14': row['count_chXIV'], 'total_cost_ch14': row['sum_chXIV'],
-                                                 'admission_count_ch15': row['count_chXV'], 'total_cost_ch15': row['sum_chXV'],
-                                                 'admission_count_ch16': row['count_chXVI'], 'total_cost_ch16': row['sum_chXVI'],
-                                                 'admission_count_ch17': row['count_chXVII'], 'total_cost_ch17': row['sum_chXVII'],
-                                                 'admission_count_ch18': row['count_chXVIII'], 'total_cost_ch18': row['sum_chXVIII'],
-                                                 'admission_count_ch19': row['count_chXIX'], 'total_cost_ch19': row['sum_chXIX'],
-                                                 'admission_count_ch20': row['count_chXX'], 'total_cost_ch20': row['sum_chXX'],
-                                                 'admission_count_ch21': row['count_chXXI'], 'total_cost_ch21': row['sum_chXXI'],
-                                                 'admission_count_ch22': row['count_chXXII'], 'total_cost_ch22': row['sum_chXXII'], })
-            )
-        self.graph.add_edges_from(self.edges_metadata)
-        return self
-    
-    def to_gml(self, output):
-        if self.graph is not None:
-            nx.write_gml(self.graph, os.path.join(output))
\ No newline at end of file
+        # -- labels of the nodes, keeping only the edges between cities and hospitals of the network
+        source = self._labels(self.muni_labels, edges["MUNIC_RES"])
+        target = self._labels(self.hosp_labels, edges["CNES"])
+        valid = (source!=-1) & (target!=-1)
+        outside = ((source==-1).any(), (target==-1).any())
+        edges, source, target = edges[valid], source[valid], target[valid]
+
+        # -- regions of the source (city) and target (hospital) nodes (and the shared ones, auxiliary metadata for drawing)
+        attrs = {'admission_count': edges["count"].to_numpy(), 'total_cost': edges["sum"].to_numpy(),
+                 **self._region_attrs({region: ids[source] for region, ids in self.node_regions.items()},
+                                      {region: ids[target-self.hospital_offset] for region, ids in self.hospital_regions.items()},
+                                      *outside)}
+        if sketch is not None:
+            attrs.update(self._cost_attrs(edges, sketch))
+        if distinct:
+            attrs.update(self._distinct_attrs(edges, distinct))
+        if fstay.has_stay(edges):
+            attrs.update(fstay.stay_attrs(edges))
+
+        # -- include multilayered information on edges (fluxes stratified by ICD-10 group)
+        if icd_edges is not None:
+            icd_edges = futils.decategorize(icd_edges.copy(), ["MUNIC_RES", "CNES"])
+            icd_edges["source"] = self._labels(self.muni_labels, icd_edges["MUNIC_RES"])
+            icd_edges["target"] = self._labels(self.hosp_labels, icd_edges["CNES"])
+        if tensor is not None:
+            tensor = futils.decategorize(tensor.copy(), ["MUNIC_RES", "CNES"])
+            tensor["source"] = self._labels(self.muni_labels, tensor["MUNIC_RES"])
+            tensor["target"] = self._labels(self.hosp_labels, tensor["CNES"])
+        return self._add_edges(source, target, attrs, *self._layer_edges(icd_edges, icd_level, tensor, strata))
+
+    def biadjacency(self, weight='admission_count', layer=None):
+        '''
+            Fluxes of the network as a sparse biadjacency matrix.
+
+            Args:
+            -----
+                weight:
+                    String. Edge attribute ('admission_count' or 'total_cost').
+                layer:
+                    String. Suffix of the attributes of a layer (e.g. 'ch9' or
+                    'death_yes'). Default None, which uses the fluxes of all admissions.
+
+            Return:
+            -------
+                scipy.sparse.csr_matrix. Shape (number of cities, number of hospitals),
+                where the row i is the city of label i and the column j the hospital
+                of label j+'hospital_offset' (the order of 'geodata_df' and 'cnes_df').
+        '''
+        ncities, nhospitals = len(self.node_regions['macro']), len(self.hospital_regions['macro'])
+        if self.backend == 'sparse':
+            matrix = self.sparse.weight(weight, layer)
+            return sp.csr_matrix(matrix[:ncities, self.hospital_offset:self.hospital_offset+nhospitals])
+        edges = self.count_sum_edge_with_code
+        if layer is None:
+            values = edges[weight].to_numpy().astype(np.float64)
+        else:
+            values = self.edge_layer_attrs[weight][:, self.layers.index(layer)].toarray().ravel()
+        return sp.csr_matrix((values, 
+                              (edges["source"].to_numpy(), edges["target"].to_numpy()-self.hospital_offset)), 
+                             shape=(ncities, nhospitals))
+
+    def projection(self, side='hospital', method='count', weight='admission_count', layer=None, top_k=None, self_loops=False):
+        '''
+            Hospital-hospital (shared catchment) or city-city (shared hospitals) network
+            computed from the biadjacency matrix by sparse products (see
+            fluxsus.fluxnets.projections.project).
+
+            Args:
+            -----
+                side:
+                    String. 'hospital' or 'city'.
+                method:
+                    String. 'count' (co-usage), 'cosine' or 'resource_allocation'.
+                weight:
+                    String. Edge attribute of the fluxes (see 'biadjacency').
+                layer:
+                    String. Layer of the fluxes (see 'biadjacency').
+                top_k:
+                    Integer. Number of strongest links kept per node. Default None,
+                    which keeps all.
+                self_loops:
+                    Bool. Whether to keep the diagonal of the projection.
+
+            Return:
+            -------
+                scipy.sparse.csr_matrix. Weights between the columns ('hospital') or
+                the rows ('city') of 'biadjacency'.
+        '''
+        return fproj.project(self.biadjacency(weight, layer), side=side, method=method, top_k=top_k, self_loops=self_loops)
@@ -1,13 +1,25 @@
 import os
-import glob
+import time
 import numpy as np
-from tqdm import tqdm
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from collections import defaultdict
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fluxsus import icd10
 from fluxsus.DBFIX import DBFIX
 from fluxsus.fluxnets.fluxnets import CityFlux, CityHospitalFlux
+from fluxsus.fluxnets.catalog import SIHDataset
+from fluxsus.fluxnets.fluxcube import FluxCube
 
-def create_citynet(sihpath, cnes_df, geodata_df, init_period, final_period, output, self_edges=False):
+# -- fields of the SIHSUS files used by the network builders
+CITYNET_FIELDS = ["MUNIC_RES", "MUNIC_MOV", "VAL_TOT", "DIAG_PRINC", "ANO_CMPT", "MES_CMPT"]
+CITYHOSPITALNET_FIELDS = ["MUNIC_RES", "CNES", "VAL_TOT", "DIAG_PRINC", "ANO_CMPT", "MES_CMPT"]
+# -- ICD-10 chapters used to stratify the fluxes (see fluxsus.icd10)
+ICD_CHAPTERS = icd10.CHAPTER_NAMES
+
+def create_citynet(sihpath, cnes_df, geodata_df, init_period, final_period, output, self_edges=False, streaming=False, national=False):
     '''
         Create a city flux network for a given period.
 
@@ -16,7 +28,9 @@ def create_citynet(sihpath, cnes_df, geodata_df, init_period, final_period, outp
         Args:
         -----
             sihpath:
-                String.
+                String, SIHDataset or FluxCube. Folder containing the SIHSUS parquet
+                files, its catalog (see fluxsus.fluxnets.catalog), or the monthly
+                fluxes computed from them (see fluxsus.fluxnets.fluxcube).
             cnes_df:
                 pandas.DataFrame.
             geodata_df:
@@ -35,28 +49,30 @@ def create_citynet(sihpath, cnes_df, geodata_df, init_period, final_period, outp
                 String.
             self_edges:
                 Bool. Whether to include self-edges in the flux network.
+            streaming:
+                Bool. Whether to aggregate the files in batches of records instead of
+                loading the whole period at once (for periods that do not fit in memory).
+            national:
+                Bool. Whether to include all the municipalities of 'geodata_df' (see
+                CityFlux). Periods with the state code "BR" (e.g. "RDBR2301") read the
+                files of all states.
     '''
-    preffix = init_period[:4]
-    list_of_files = glob.glob(os.path.join(sihpath, f'{preffix}*'))
-
-    init_index = [idx for idx, s in enumerate(list_of_files) if init_period in s][0]
-    final_index = [idx for idx, s in enumerate(list_of_files) if final_period in s][0]
-    if final_index is None:
-        raise Exception(f"no file {final_period} was found.")
-    list_of_files = list_of_files[init_index:final_index+1]
-
-    sih_df = []
-    for fname in tqdm(list_of_files):
-        cur_df = pd.read_parquet(fname)
-        sih_df.append( cur_df )
-    sih_df = pd.concat(sih_df, axis=0)
-    sih_df["COMPETEN"] = sih_df["ANO_CMPT"].astype(str)+sih_df["MES_CMPT"].astype(str)
-
     # -- generate network
-    cityflux = CityFlux(cnes_df, geodata_df)
-    cityflux.define_network().calculate_fluxes(sih_df, multilayer_icd=True, self_edges=self_edges).to_gml(output)
+    cityflux = CityFlux(cnes_df, geodata_df, national=national).define_network()
+    # -- sum the monthly fluxes of a precomputed cube instead of reading the records
+    if isinstance(sihpath, FluxCube):
+        cityflux.calculate_fluxes_from_cube(sihpath, init_period, final_period, multilayer_icd=True, self_edges=self_edges).to_gml(output)
+        return
+
+    if streaming:
+        cityflux.calculate_fluxes_streaming(sihpath, init_period, final_period, multilayer_icd=True, self_edges=self_edges).to_gml(output)
+        return
 
-def create_cityhospitalnet(sihpath, cnes_df, geodata_df, init_period, final_period, output):
+    sih_df = as_dataset(sihpath).to_pandas(init_period, final_period, columns=CITYNET_FIELDS)
+    sih_df["COMPETEN"] = (sih_df["ANO_CMPT"].astype(int)*100+sih_df["MES_CMPT"].astype(int)).astype(str)
+    cityflux.calculate_fluxes(sih_df, multilayer_icd=True, self_edges=self_edges).to_gml(output)
+
+def create_cityhospitalnet(sihpath, cnes_df, geodata_df, init_period, final_period, output, streaming=False):
     '''
         Create a city flux network for a given period.
 
@@ -65,7 +81,9 @@ def create_cityhospitalnet(sihpath, cnes_df, geodata_df, init_period, final_peri
         Args:
         -----
             sihpath:
-                String.
+                String, SIHDataset or FluxCube. Folder containing the SIHSUS parquet
+                files, its catalog (see fluxsus.fluxnets.catalog), or the monthly
+                fluxes computed from them (see fluxsus.fluxnets.fluxcube).
             cnes_df:
                 pandas.DataFrame.
             geodata_df:
@@ -82,27 +100,188 @@ def create_cityhospitalnet(sihpath, cnes_df, geodata_df, init_period, final_peri
                 of the period.
             output:
                 String.
+            streaming:
+                Bool. Whether to aggregate the files in batches of records instead of
+                loading the whole period at once (for periods that do not fit in memory).
     '''
-    preffix = init_period[:4]
-    list_of_files = glob.glob(os.path.join(sihpath, f'{preffix}*'))
-
-    init_index = [idx for idx, s in enumerate(list_of_files) if init_period in s][0]
-    final_index = [idx for idx, s in enumerate(list_of_files) if final_period in s][0]
-    if final_index is None:
-        raise Exception(f"no file {final_period} was found.")
-    list_of_files = list_of_files[init_index:final_index+1]
-
-    sih_df = []
-    for fname in tqdm(list_of_files):
-        cur_df = pd.read_parquet(fname)
-        sih_df.append( cur_df )
-    sih_df = pd.concat(sih_df, axis=0)
-    sih_df["COMPETEN"] = sih_df["ANO_CMPT"].astype(str)+sih_df["MES_CMPT"].astype(str)
-
     # -- generate network
-    cityhospitalflux = CityHospitalFlux(cnes_df, geodata_df)
-    cityhospitalflux.define_network().calculate_fluxes(sih_df, multilayer_icd=True).to_gml(output)
+    cityhospitalflux = CityHospitalFlux(cnes_df, geodata_df).define_network()
+    # -- sum the monthly fluxes of a precomputed cube instead of reading the records
+    if isinstance(sihpath, FluxCube):
+        cityhospitalflux.calculate_fluxes_from_cube(sihpath, init_period, final_period, multilayer_icd=True).to_gml(output)
+        return
+
+    if streaming:
+        cityhospitalflux.calculate_fluxes_streaming(sihpath, init_period, final_period, multilayer_icd=True).to_gml(output)
+        return
 
+    sih_df = as_dataset(sihpath).to_pandas(init_period, final_period, columns=CITYHOSPITALNET_FIELDS)
+    sih_df["COMPETEN"] = (sih_df["ANO_CMPT"].astype(int)*100+sih_df["MES_CMPT"].astype(int)).astype(str)
+    cityhospitalflux.calculate_fluxes(sih_df, multilayer_icd=True).to_gml(output)
+
+
+# -- builders of the batch jobs and the target of the flux cube they use
+BUILDERS = {
+    'citynet': (create_citynet, "MUNIC_MOV"),
+    'cityhospitalnet': (create_cityhospitalnet, "CNES"),
+}
+
+def run_network_jobs(jobs, sihpath, cnes_df, geodata_df, n_jobs=None):
+    '''
+        Build a batch of networks in a process pool.
+
+        The inputs shared by all jobs (CNES data, geodata and flux cubes) are written
+        once to shared memory and loaded once by each worker, instead of being sent
+        along with every job.
+
+        Args:
+        -----
+            jobs:
+                List of Tuples. (builder, (init_period, final_period), options, output)
+                of each network, where 'builder' is "citynet" or "cityhospitalnet"
+                (see create_citynet and create_cityhospitalnet), the periods follow
+                the format "XXUFYYMM", 'options' is a dictionary of extra arguments
+                of the builder (e.g. {'self_edges': True}) and 'output' is the GML file.
+            sihpath:
+                String, FluxCube or Dictionary. Folder containing the SIHSUS parquet
+                files, a flux cube, or a dictionary target -> FluxCube with the cubes
+                of both builders ("MUNIC_MOV" and "CNES").
+            cnes_df:
+                pandas.DataFrame.
+            geodata_df:
+                pandas.DataFrame. Geometry columns are not shared (not used by the builders).
+            n_jobs:
+                Integer. Number of worker processes. Default None, which uses the
+                number of processors of the machine.
+
+        Return:
+        -------
+            report:
+                pandas.DataFrame. One row per job with the builder, the periods, the
+                output, the status ('done' or 'failed'), the time in seconds and the
+                error message of failed jobs.
+    '''
+    for builder, periods, options, output in jobs:
+        if builder not in BUILDERS:
+            raise ValueError(f'Unknown builder "{builder}" (options: {list(BUILDERS.keys())}).')
+
+    cubes = {}
+    if isinstance(sihpath, FluxCube):
+        cubes, sihpath = {sihpath.target: sihpath}, None
+    elif isinstance(sihpath, dict):
+        cubes, sihpath = dict(sihpath), None
+
+    geodata_df = pd.DataFrame(geodata_df[[ col for col in geodata_df.columns if geodata_df[col].dtype.name != 'geometry' ]])
+    frames = {'cnes_df': cnes_df, 'geodata_df': geodata_df}
+    frames.update({ f'cube_{target}': cube.cells for target, cube in cubes.items() })
+    cube_info = { target: (cube.prefix, cube.uf) for target, cube in cubes.items() }
+
+    blocks, shared = [], {}
+    try:
+        for key, df in frames.items():
+            block, size = _share_frame(df)
+            blocks.append(block)
+            shared[key] = (block.name, size)
+
+        report = []
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_attach_shared, 
+                                 initargs=(shared, cube_info, sihpath)) as executor:
+            futures = { executor.submit(_run_job, builder, periods, options, output): n 
+                        for n, (builder, periods, options, output) in enumerate(jobs) }
+            for future in as_completed(futures):
+                n = futures[future]
+                builder, (init_period, final_period), options, output = jobs[n]
+                row = {'job': n, 'builder': builder, 'init_period': init_period, 'final_period': final_period, 'output': output}
+                try:
+                    row.update({'status': 'done', 'seconds': future.result(), 'error': None})
+                except Exception as err:
+                    row.update({'status': 'failed', 'seconds': None, 'error': repr(err)})
+                report.append(row)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    report = pd.DataFrame(report, columns=['job', 'builder', 'init_period', 'final_period', 'output', 'status', 'seconds', 'error'])
+    return report.sort_values(by="job").drop("job", axis=1).reset_index(drop=True)
+
+# -- inputs of the batch jobs loaded by each worker process (see run_network_jobs)
+_SHARED = {}
+
+def _share_frame(df):
+    '''
+        Write a DataFrame (Arrow IPC stream) to a new block of shared memory.
+    '''
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    buffer = sink.getvalue()
+    block = shared_memory.SharedMemory(create=True, size=max(buffer.size, 1))
+    np.frombuffer(block.buf, dtype=np.uint8, count=buffer.size)[:] = np.frombuffer(buffer, dtype=np.uint8)
+    return block, buffer.size
+
+def _attach_shared(shared, cube_info, sihpath):
+    '''
+        Load the shared inputs of the batch jobs (worker process initializer).
+    '''
+    frames, _SHARED['blocks'] = {}, []
+    for key, (name, size) in shared.items():
+        # -- blocks stay attached while the worker lives (the frames may point to them)
+        block = shared_memory.SharedMemory(name=name)
+        _SHARED['blocks'].append(block)
+        frames[key] = pa.ipc.open_stream(pa.py_buffer(block.buf[:size])).read_all().to_pandas()
+
+    _SHARED['cnes_df'] = frames['cnes_df']
+    _SHARED['geodata_df'] = frames['geodata_df']
+    _SHARED['cubes'] = { target: FluxCube(target, frames[f'cube_{target}'], prefix=prefix, uf=uf)
+                         for target, (prefix, uf) in cube_info.items() }
+    _SHARED['sihpath'] = sihpath
+
+def _run_job(builder, periods, options, output):
+    '''
+        Build one network (worker process) and return the time it took.
+    '''
+    start = time.time()
+    create, target = BUILDERS[builder]
+    source = _SHARED['cubes'].get(target, _SHARED['sihpath'])
+    if source is None:
+        raise ValueError(f'No flux cube with target "{target}" nor folder of SIHSUS files was given.')
+    init_period, final_period = periods
+    create(source, _SHARED['cnes_df'], _SHARED['geodata_df'], init_period, final_period, output, **(options or {}))
+    return time.time()-start
+
+def as_dataset(sihpath):
+    '''
+        Catalog of the SIHSUS parquet files of a folder (kept as is if already a catalog).
+    '''
+    if isinstance(sihpath, SIHDataset):
+        return sihpath
+    return SIHDataset(sihpath)
+
+def decategorize(df, columns):
+    '''
+        Convert categorical columns back to the type of their categories.
+
+        Codes loaded as categoricals (see SIHDataset.to_pandas) from different files do not
+        share categories, so they are converted before being compared or merged.
+
+        Args:
+        -----
+            df:
+                pandas.DataFrame.
+            columns:
+                List of Strings. Columns to convert (non-categorical ones are kept).
+
+        Return:
+        -------
+            df:
+                pandas.DataFrame.
+    '''
+    for col in columns:
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
 
 def list_of_cnes_with_aih(sihpath, init_period, final_period):
     '''
@@ -114,7 +293,8 @@ def list_of_cnes_with_aih(sihpath, init_period, final_period):
         Args:
         -----
             sihpath:
-                String.
+                String or SIHDataset. Folder containing the SIHSUS parquet files, or
+                its catalog (see fluxsus.fluxnets.catalog).
             init:
                 String. Format "XXUFYYMM", where 'XX' stands for the preffix of the
                 SIHSUS file (as described by DATASUS), 'UF' stands for state code to
@@ -128,21 +308,10 @@ def list_of_cnes_with_aih(sihpath, init_period, final_period):
             output:
                 String.
     '''
-    preffix = init_period[:4]
-    list_of_files = glob.glob(os.path.join(sihpath, f'{preffix}*'))
-
-    init_index = [idx for idx, s in enumerate(list_of_files) if init_period in s][0]
-    final_index = [idx for idx, s in enumerate(list_of_files) if final_period in s][0]
-    if final_index is None:
-        raise Exception(f"no file {final_period} was found.")
-    list_of_files = list_of_files[init_index:final_index+1]
-
-    list_of_cnes = []
-    for fname in tqdm(list_of_files):
-        cur_df = pd.read_parquet(fname)
-        cnes_unique = cur_df["CNES"].unique().tolist()
-        list_of_cnes += cnes_unique
-    list_of_cnes = list(set(list_of_cnes))
+    cnes = as_dataset(sihpath).to_table(init_period, final_period, columns=["CNES"])["CNES"]
+    if pa.types.is_dictionary(cnes.type):
+        cnes = cnes.cast(cnes.type.value_type)
+    list_of_cnes = pc.unique(cnes).drop_null().to_pylist()
     return list_of_cnes
 
 def cca_health(sector_rel, hospital_rel, lsector, lhos, ident_col="IDENT"):
@@ -351,62 +520,43 @@ def filter_chapter(chapter: str):
             List. 
 
     '''
-    cid10_chapters = defaultdict(lambda: [])
-
-    # -- certain infectious and parasitic diseases
-    cid10_chapters['I'] = [ 'A'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    cid10_chapters['I'] += [ 'B'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- neoplasms     
-    cid10_chapters['II'] = [ 'C'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    cid10_chapters['II'] += [ 'D'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 48+1) ]
-    # -- diseases of the blood and blood-forming organs and certain disorders involving the immune mechanism
-    cid10_chapters['III'] = [ 'D'+f'{n:2.0f}'.replace(' ', '0') for n in range(50, 89+1) ]
-    # -- endocrine, nutritional and metabolic diseases
-    cid10_chapters['IV'] = [ 'E'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 90+1) ]
-    # -- mental and behavioural disorders
-    cid10_chapters['V'] = [ 'F'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- diseases of the nervous system
-    cid10_chapters['VI'] = [ 'G'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- diseases of the eye and adnexa
-    cid10_chapters['VII'] = [ 'H'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 59+1) ]
-    # -- diseases of the ear and mastoid process
-    cid10_chapters['VIII'] = [ 'H'+f'{n:2.0f}'.replace(' ', '0') for n in range(60, 95+1) ]
-    # -- diseases of the circulatory system
-    cid10_chapters['IX'] = [ 'I'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- diseases of the respiratory system
-    cid10_chapters['X'] = [ 'J'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- diseases of the digestive system
-    cid10_chapters['XI'] = [ 'K'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 93+1) ]
-    # -- diseases of the skin and subcutaneous tissue
-    cid10_chapters['XII'] = [ 'L'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- diseases of the musculoskeletal system and connective tissue
-    cid10_chapters['XIII'] = [ 'M'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- diseases of the genitourinary system
-    cid10_chapters['XIV'] = [ 'N'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- pregnancy, childbirth and the puerperium
-    cid10_chapters['XV'] = [ 'O'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- certain conditions originating in the perinatal period
-    cid10_chapters['XVI'] = [ 'P'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 96+1) ]
-    # -- congenital malformations, deformations and chromosomal abnormalities
-    cid10_chapters['XVII'] = [ 'Q'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- Symptoms, signs and abnormal clinical and laboratory findings, not elsewhere classified
-    cid10_chapters['XVIII'] = [ 'R'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- injury, poisoning and certain other consequences of external causes
-    cid10_chapters['XIX'] = [ 'S'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    cid10_chapters['XIX'] += [ 'T'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 98+1) ]
-    # -- external causes of morbidity and mortality
-    cid10_chapters['XX'] = [ 'V'+f'{n:2.0f}'.replace(' ', '0') for n in range(1, 99+1) ]
-    cid10_chapters['XX'] += [ 'Y'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 98+1) ]
-    # -- factors influencing health status and contact with health services
-    cid10_chapters['XXI'] = [ 'Z'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-    # -- factors influencing health status and contact with health services
-    cid10_chapters['XXII'] = [ 'U'+f'{n:2.0f}'.replace(' ', '0') for n in range(0, 99+1) ]
-
-    if chapter not in cid10_chapters.keys():
-        raise Exception('Chapter not included in the list.')
-    
-    return cid10_chapters[chapter]
+    return icd10.codes_of(chapter)
 
+def chapter_codes(diag):
+    '''
+        ICD-10 chapter of each code of a column of diagnoses (e.g. DIAG_PRINC), in a
+        single vectorized lookup (see fluxsus.icd10.classify).
+
+        Return:
+        -------
+            pandas.Series. Index of the chapter of each code in ICD_CHAPTERS (int8),
+            or -1 for missing codes and codes outside of the chapters.
+    '''
+    return icd10.classify(diag, level='chapter')
+
+def icd_layers(icd_level='chapter', ids=None):
+    '''
+        Suffix of the edge attributes holding the fluxes of each ICD-10 group.
+
+        Chapters are always all included ('ch1' to 'ch22', in the order of ICD_CHAPTERS),
+        while blocks (e.g. 'A00_A09') and 3-character categories (e.g. 'A00') are
+        only included for the groups in 'ids'.
+
+        Args:
+        -----
+            icd_level:
+                String. 'chapter', 'block' or 'category' (see fluxsus.icd10).
+            ids:
+                Array-like of Integers. Ids of the groups observed in the fluxes.
+
+        Return:
+        -------
+            Dictionary. Id of the group -> suffix of the attributes.
+    '''
+    if icd_level == 'chapter':
+        return { number: f'ch{number+1}' for number in range(len(ICD_CHAPTERS)) }
+    names = icd10.names(icd_level)
+    return { int(number): names[number].replace('-', '_') for number in np.sort(np.unique(ids)) if number >= 0 }
 
 # -- keep track of proposal
 def macro_proposal():
@@ -0,0 +1,94 @@
+'''
+    Weighted projections of the bipartite city to hospital flux networks.
+
+    The fluxes are given as a sparse biadjacency matrix B (cities x hospitals).
+    Hospitals sharing the cities they serve (shared catchment), or cities sharing
+    the hospitals they use, are linked by sparse matrix products of B, optionally
+    keeping only the strongest links of each node.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import numpy as np
+import scipy.sparse as sp
+
+# -- weights of the links of a projection
+METHODS = ['count', 'cosine', 'resource_allocation']
+
+def project(biadjacency, side='hospital', method='count', top_k=None, self_loops=False):
+    '''
+        Projection of a bipartite network onto one of its sides.
+
+        Args:
+        -----
+            biadjacency:
+                scipy.sparse matrix. Fluxes B from the cities (rows) to the hospitals
+                (columns).
+            side:
+                String. 'hospital' (hospitals linked by the cities they share) or 'city'
+                (cities linked by the hospitals they share).
+            method:
+                String. Weight of the links between i and j, where c runs over the
+                nodes of the other side:
+                    'count': sum_c B_ci*B_cj (co-usage);
+                    'cosine': cosine similarity of the columns i and j of B;
+                    'resource_allocation': sum_c B_ci*B_cj/s_c, where s_c is the
+                    total flux of c.
+            top_k:
+                Integer. Number of strongest links kept per row (see 'sparsify_top_k').
+                Default None, which keeps all.
+            self_loops:
+                Bool. Whether to keep the diagonal of the projection.
+
+        Return:
+        -------
+            scipy.sparse.csr_matrix. Weights of the projection (square, symmetric
+            unless 'top_k' is given), indexed as the rows ('city') or columns
+            ('hospital') of 'biadjacency'.
+    '''
+    if side not in ['hospital', 'city']:
+        raise ValueError('side must be "hospital" or "city".')
+    if method not in METHODS:
+        raise ValueError(f'method must be one of {METHODS}.')
+    # -- nodes of the projection as columns, nodes they share as rows
+    matrix = sp.csr_matrix(biadjacency, dtype=np.float64)
+    if side == 'city':
+        matrix = matrix.T.tocsr()
+
+    if method == 'cosine':
+        norm = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+        matrix = matrix @ sp.diags(np.divide(1.0, norm, out=np.zeros_like(norm), where=norm>0))
+        weights = matrix.T @ matrix
+    elif method == 'resource_allocation':
+        strength = np.asarray(matrix.sum(axis=1)).ravel()
+        weights = matrix.T @ sp.diags(np.divide(1.0, strength, out=np.zeros_like(strength), where=strength>0)) @ matrix
+    else:
+        weights = matrix.T @ matrix
+
+    weights = sp.csr_matrix(weights)
+    if not self_loops:
+        weights.setdiag(0)
+    weights.eliminate_zeros()
+    if top_k is not None:
+        weights = sparsify_top_k(weights, top_k)
+    return weights
+
+def sparsify_top_k(matrix, k):
+    '''
+        Keep the k largest entries of each row of a sparse matrix (ties broken by
+        column).
+
+        Return:
+        -------
+            scipy.sparse.csr_matrix.
+    '''
+    matrix = sp.csr_matrix(matrix)
+    matrix.sort_indices()
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    # -- entries sorted by row and decreasing value: rank of each entry within its row
+    order = np.lexsort((-matrix.data, rows))
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - matrix.indptr[rows[order]]
+    keep = rank < k
+    return sp.csr_matrix((matrix.data[keep], (rows[keep], matrix.indices[keep])), shape=matrix.shape)
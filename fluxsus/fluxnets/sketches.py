@@ -0,0 +1,428 @@
+'''
+    Mergeable sketches of the admissions behind each edge of the flux networks.
+
+    The cost (VAL_TOT) of the admissions of each edge is summarized by a log-bucketed
+    histogram (as in DDSketch): a value v > 0 falls into the bucket ceil(log(v)/log(g)),
+    where g = (1+alpha)/(1-alpha), so any quantile is estimated within a relative
+    error alpha. The keys of the edges are kept once, and the counts of the non-empty
+    buckets as integer arrays of (edge, bucket, count): merging sketches (e.g. of
+    monthly partitions into a window) is a sum of counts.
+
+    The number of distinct values of a field (e.g. N_AIH or CNES) behind each edge is
+    estimated by HyperLogLog: 2^p registers of one byte per edge keep the maximum rank
+    (position of the first 1-bit) of the hashes falling into them, and sketches are
+    merged by the maximum of their registers.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# -- relative accuracy of the quantiles of the cost sketches
+COST_ALPHA = 0.01
+# -- quantiles of the cost included as edge attributes (e.g. 'cost_p90')
+COST_QUANTILES = [0.5, 0.9, 0.99]
+# -- bucket of the values equal to zero (or negative)
+ZERO_BUCKET = np.iinfo(np.int32).min
+# -- precision of the distinct counts: 2^p registers (bytes) per edge, standard
+# -- error of about 1.04/sqrt(2^p) (6.5% for p=8)
+HLL_PRECISION = 8
+
+class CostSketch:
+    def __init__(self, keys, index=None, edge=None, bucket=None, count=None, alpha=COST_ALPHA):
+        '''
+            Log-bucketed histograms of the cost of the admissions per edge.
+
+            Args:
+            -----
+                keys:
+                    List of Strings. Columns identifying each edge (e.g. ["MUNIC_RES",
+                    "MUNIC_MOV"], and "PERIOD" for monthly partitions).
+                index:
+                    pandas.DataFrame. Columns keys, one row per edge.
+                edge:
+                    numpy.ndarray (int64). Row of 'index' of each non-empty bucket.
+                bucket:
+                    numpy.ndarray (int32). Bucket, aligned with 'edge'.
+                count:
+                    numpy.ndarray (int64). Number of admissions, aligned with 'edge'.
+                alpha:
+                    Float. Relative accuracy of the quantiles.
+        '''
+        self.keys = list(keys)
+        self.alpha = alpha
+        self.gamma = (1+alpha)/(1-alpha)
+        if index is None:
+            index = pd.DataFrame({ col: pd.Series(dtype=str) for col in self.keys })
+            edge, bucket, count = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        self.index = index[self.keys].reset_index(drop=True)
+        # -- buckets sorted by edge and bucket, one entry per (edge, bucket)
+        self.edge, self.bucket, self.count = _sum_counts(edge, bucket, count)
+
+    @classmethod
+    def from_records(cls, sih_df, keys, value_col="VAL_TOT", alpha=COST_ALPHA):
+        '''
+            Sketches of a set of admissions, in a single grouping of the records by edge.
+
+            Args:
+            -----
+                sih_df:
+                    pandas.DataFrame. Records with the columns 'keys' and 'value_col'.
+                    Records without a value are ignored.
+        '''
+        sketch = cls(keys, alpha=alpha)
+        values = pd.to_numeric(sih_df[value_col], errors='coerce').to_numpy().astype(np.float64)
+        valid = ~np.isnan(values)
+        records = sih_df[sketch.keys][valid]
+        edge = records.groupby(sketch.keys, observed=True, sort=False).ngroup().to_numpy()
+        records, values = records[edge>=0], values[valid][edge>=0]
+        edge = edge[edge>=0]
+
+        first = pd.Series(np.arange(len(edge))).groupby(edge).first().to_numpy()
+        return cls(keys, records.iloc[first], edge, sketch.buckets(values), np.ones(len(edge), dtype=np.int64), alpha=alpha)
+
+    def buckets(self, values):
+        '''
+            Bucket of each value.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        positive = values > 0
+        logs = np.log(np.where(positive, values, 1.0))/np.log(self.gamma)
+        return np.where(positive, np.ceil(logs), ZERO_BUCKET).astype(np.int32)
+
+    def values(self, buckets):
+        '''
+            Value representing each bucket (within a relative error alpha of its values).
+        '''
+        buckets = np.asarray(buckets)
+        zero = buckets == ZERO_BUCKET
+        return np.where(zero, 0.0, 2*np.power(self.gamma, np.where(zero, 0, buckets).astype(np.float64))/(self.gamma+1))
+
+    def merge(self, *others):
+        '''
+            Sketches of the admissions of this and other sketches (same keys and accuracy).
+
+            Return:
+            -------
+                CostSketch.
+        '''
+        for other in others:
+            if other.keys != self.keys or other.alpha != self.alpha:
+                raise ValueError('Sketches with different keys or accuracy cannot be merged.')
+        sketches = [self] + list(others)
+        offsets = np.cumsum([0] + [ sketch.index.shape[0] for sketch in sketches[:-1] ])
+        index = pd.concat([ sketch.index for sketch in sketches ], ignore_index=True)
+        edge = np.concatenate([ sketch.edge+offset for sketch, offset in zip(sketches, offsets) ])
+        bucket = np.concatenate([ sketch.bucket for sketch in sketches ])
+        count = np.concatenate([ sketch.count for sketch in sketches ])
+        return self._reduce(index, edge, bucket, count, self.keys)
+
+    def combine(self, keys):
+        '''
+            Sketches of coarser edges, merging the ones sharing the columns 'keys'
+            (e.g. the months of a window, dropping "PERIOD").
+
+            Return:
+            -------
+                CostSketch.
+        '''
+        return self._reduce(self.index, self.edge, self.bucket, self.count, list(keys))
+
+    def take(self, rows):
+        '''
+            Sketches of a subset of the edges (e.g. the months of a window).
+
+            Args:
+            -----
+                rows:
+                    Array-like of Bools. Whether to keep each row of 'index'.
+
+            Return:
+            -------
+                CostSketch.
+        '''
+        rows = np.asarray(rows, dtype=bool)
+        keep = rows[self.edge]
+        position = np.cumsum(rows) - 1
+        return CostSketch(self.keys, self.index[rows], position[self.edge[keep]], self.bucket[keep], self.count[keep], alpha=self.alpha)
+
+    def _reduce(self, index, edge, bucket, count, keys):
+        '''
+            Sum of the counts of the buckets of the rows of 'index' sharing the same 'keys'.
+        '''
+        if not index.shape[0]:
+            return CostSketch(keys, alpha=self.alpha)
+        group = index.groupby(keys, observed=True, sort=True).ngroup().to_numpy()
+        first = pd.Series(np.arange(len(group))).groupby(group).first().to_numpy()
+        return CostSketch(keys, index.iloc[first], group[edge], bucket, count, alpha=self.alpha)
+
+    def quantiles(self, quantiles=COST_QUANTILES):
+        '''
+            Estimated quantiles of the cost of each edge.
+
+            Args:
+            -----
+                quantiles:
+                    List of Floats. Quantiles between 0 and 1.
+
+            Return:
+            -------
+                pandas.DataFrame. Columns keys and one column per quantile (e.g. 0.9).
+        '''
+        nedges = self.index.shape[0]
+        total = np.bincount(self.edge, weights=self.count, minlength=nedges)
+        # -- cumulative counts within each edge (the buckets of an edge are contiguous)
+        cumulative = np.cumsum(self.count)
+        cumulative = cumulative - (np.cumsum(total) - total)[self.edge]
+
+        result = self.index.copy()
+        for q in quantiles:
+            # -- first bucket whose cumulative count exceeds the rank of the quantile
+            rank = q*(total-1)
+            above = np.flatnonzero(cumulative > rank[self.edge])
+            edges, first = np.unique(self.edge[above], return_index=True)
+            estimate = np.full(nedges, np.nan)
+            estimate[edges] = self.values(self.bucket[above[first]])
+            result[q] = estimate
+        return result
+
+    def histogram(self, bins):
+        '''
+            Number of admissions of each edge per cost bin.
+
+            Args:
+            -----
+                bins:
+                    Array-like. Edges of the bins (increasing). Costs out of the bins
+                    are not counted.
+
+            Return:
+            -------
+                pandas.DataFrame. Columns keys and one column per bin (its lower edge),
+                for the edges with costs within the bins.
+        '''
+        bins = np.asarray(bins, dtype=np.float64)
+        nbins = len(bins)-1
+        position = np.searchsorted(bins, self.values(self.bucket), side='right') - 1
+        inside = (position>=0) & (position<nbins)
+        hist = np.bincount(self.edge[inside]*nbins + position[inside], weights=self.count[inside],
+                           minlength=self.index.shape[0]*nbins).reshape(-1, nbins).astype(np.int64)
+        edges = np.unique(self.edge[inside])
+        return self.index.iloc[edges].reset_index(drop=True).join(pd.DataFrame(hist[edges], columns=bins[:-1]))
+
+    def to_parquet(self, fname):
+        '''
+            Save the sketches (and their keys and accuracy) as a parquet file, with the
+            buckets and counts of each edge as list columns.
+        '''
+        table = pa.Table.from_pandas(self.index, preserve_index=False)
+        offsets = pa.array(np.r_[0, np.cumsum(np.bincount(self.edge, minlength=self.index.shape[0]))].astype(np.int32))
+        table = table.append_column("BUCKETS", pa.ListArray.from_arrays(offsets, pa.array(self.bucket)))
+        table = table.append_column("COUNTS", pa.ListArray.from_arrays(offsets, pa.array(self.count)))
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'costsketch'] = json.dumps({'keys': self.keys, 'alpha': self.alpha}).encode()
+        pq.write_table(table.replace_schema_metadata(metadata), fname)
+        return self
+
+    @classmethod
+    def read_parquet(cls, fname):
+        '''
+            Load sketches saved with 'to_parquet'.
+        '''
+        table = pq.read_table(fname)
+        info = json.loads(table.schema.metadata[b'costsketch'])
+        buckets = table["BUCKETS"].combine_chunks()
+        sizes = np.diff(buckets.offsets.to_numpy())
+        edge = np.repeat(np.arange(len(sizes)), sizes)
+        bucket = buckets.flatten().to_numpy().astype(np.int32)
+        count = table["COUNTS"].combine_chunks().flatten().to_numpy().astype(np.int64)
+        return cls(info['keys'], table.drop(["BUCKETS", "COUNTS"]).to_pandas(), edge, bucket, count, alpha=info['alpha'])
+
+class DistinctSketch:
+    def __init__(self, keys, index=None, registers=None, p=HLL_PRECISION):
+        '''
+            HyperLogLog sketches of the distinct values of a field per edge.
+
+            Args:
+            -----
+                keys:
+                    List of Strings. Columns identifying each edge (e.g. ["MUNIC_RES",
+                    "MUNIC_MOV"], and "PERIOD" for monthly partitions).
+                index:
+                    pandas.DataFrame. Columns keys, one row per edge.
+                registers:
+                    numpy.ndarray (uint8). Shape (number of edges, 2^p), aligned with 'index'.
+                p:
+                    Integer. Precision (number of bits of the hash choosing the register).
+        '''
+        self.keys = list(keys)
+        self.p = p
+        self.m = 1 << p
+        if index is None:
+            index = pd.DataFrame({ col: pd.Series(dtype=str) for col in self.keys })
+            registers = np.zeros((0, self.m), dtype=np.uint8)
+        self.index = index[self.keys].reset_index(drop=True)
+        self.registers = registers
+
+    @classmethod
+    def from_records(cls, sih_df, keys, field, p=HLL_PRECISION):
+        '''
+            Sketches of the values of 'field' in a set of admissions. Records without
+            a value are ignored. The field may also be one of the keys (e.g. the
+            distinct CNES behind each (MUNIC_RES, CNES) edge).
+        '''
+        sketch = cls(keys, p=p)
+        valid = sih_df[field].notna().to_numpy()
+        records = sih_df[list(dict.fromkeys(sketch.keys+[field]))][valid]
+        edge = records.groupby(sketch.keys, observed=True, sort=False).ngroup().to_numpy()
+        records, edge = records[edge>=0], edge[edge>=0]
+
+        hashes = pd.util.hash_array(_canonical(records[field]))
+        register = (hashes >> np.uint64(64-p)).astype(np.int64)
+        # -- position of the first 1-bit of the remaining bits of the hash
+        rank = 64 - _bit_length(hashes << np.uint64(p)) + 1
+        registers = np.zeros((edge.max()+1 if len(edge) else 0, sketch.m), dtype=np.uint8)
+        np.maximum.at(registers, (edge, register), np.minimum(rank, 64-p+1).astype(np.uint8))
+
+        first = pd.Series(np.arange(len(edge))).groupby(edge).first().to_numpy()
+        sketch.index = records[sketch.keys].iloc[first].reset_index(drop=True)
+        sketch.registers = registers
+        return sketch
+
+    def merge(self, *others):
+        '''
+            Sketches of the values of this and other sketches (same keys and precision).
+
+            Return:
+            -------
+                DistinctSketch.
+        '''
+        for other in others:
+            if other.keys != self.keys or other.p != self.p:
+                raise ValueError('Sketches with different keys or precision cannot be merged.')
+        sketches = [self] + list(others)
+        index = pd.concat([ sketch.index for sketch in sketches ], ignore_index=True)
+        registers = np.vstack([ sketch.registers for sketch in sketches ])
+        return self._reduce(index, registers, self.keys)
+
+    def combine(self, keys):
+        '''
+            Sketches of coarser edges, merging the ones sharing the columns 'keys'
+            (e.g. the months of a window, dropping "PERIOD").
+
+            Return:
+            -------
+                DistinctSketch.
+        '''
+        return self._reduce(self.index, self.registers, list(keys))
+
+    def take(self, rows):
+        '''
+            Sketches of a subset of the edges (e.g. the months of a window).
+
+            Args:
+            -----
+                rows:
+                    Array-like of Bools. Whether to keep each row of 'index'.
+
+            Return:
+            -------
+                DistinctSketch.
+        '''
+        rows = np.asarray(rows, dtype=bool)
+        return DistinctSketch(self.keys, self.index[rows], self.registers[rows], p=self.p)
+
+    def _reduce(self, index, registers, keys):
+        '''
+            Maximum of the registers of the rows of 'index' sharing the same 'keys'.
+        '''
+        if not index.shape[0]:
+            return DistinctSketch(keys, p=self.p)
+        group = index.groupby(keys, observed=True, sort=True).ngroup().to_numpy()
+        order = np.argsort(group, kind='stable')
+        bounds = np.r_[0, np.flatnonzero(np.diff(group[order]))+1]
+        registers = np.maximum.reduceat(registers[order], bounds, axis=0)
+        return DistinctSketch(keys, index.iloc[order[bounds]], registers, p=self.p)
+
+    def estimate(self):
+        '''
+            Estimated number of distinct values per edge.
+
+            Return:
+            -------
+                pandas.DataFrame. Columns keys and "distinct".
+        '''
+        m = self.m
+        alpha = 0.7213/(1+1.079/m)
+        raw = alpha*m*m/np.power(2.0, -self.registers.astype(np.float64)).sum(axis=1)
+        zeros = (self.registers == 0).sum(axis=1)
+        # -- small range correction (linear counting)
+        linear = m*np.log(m/np.maximum(zeros, 1))
+        estimate = np.where((raw <= 2.5*m) & (zeros > 0), linear, raw)
+        return self.index.assign(distinct=estimate)
+
+    def to_parquet(self, fname):
+        '''
+            Save the sketches (and their keys and precision) as a parquet file, with the
+            registers of each edge as a binary column.
+        '''
+        table = pa.Table.from_pandas(self.index, preserve_index=False)
+        table = table.append_column("REGISTERS", pa.array([ row.tobytes() for row in self.registers ], type=pa.binary(self.m)))
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'distinctsketch'] = json.dumps({'keys': self.keys, 'p': self.p}).encode()
+        pq.write_table(table.replace_schema_metadata(metadata), fname)
+        return self
+
+    @classmethod
+    def read_parquet(cls, fname):
+        '''
+            Load sketches saved with 'to_parquet'.
+        '''
+        table = pq.read_table(fname)
+        info = json.loads(table.schema.metadata[b'distinctsketch'])
+        m = 1 << info['p']
+        registers = np.frombuffer(b''.join(table["REGISTERS"].to_pylist()), dtype=np.uint8).reshape(-1, m)
+        return cls(info['keys'], table.drop(["REGISTERS"]).to_pandas(), registers.copy(), p=info['p'])
+
+def _canonical(column):
+    '''
+        Values of a field as strings that do not depend on its dtype, so sketches of
+        files or batches loaded with different dtypes can be merged: integer values
+        are written without decimals whether stored as integers or as floats (e.g.
+        a month with missing values), so 123 and 123.0 give "123".
+    '''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype(column.cat.categories.dtype)
+    if pd.api.types.is_float_dtype(column.dtype):
+        values = column.to_numpy(dtype=np.float64)
+        integral = np.isfinite(values) & (values == np.floor(values)) & (np.abs(values) < 2.0**63)
+        strings = column.astype(str).to_numpy(dtype=object)
+        strings[integral] = values[integral].astype(np.int64).astype(str)
+        return strings
+    return column.astype(str).to_numpy(dtype=object)
+
+def _sum_counts(edge, bucket, count):
+    '''
+        Counts of the same (edge, bucket) summed, sorted by edge and bucket.
+    '''
+    key = (np.asarray(edge, dtype=np.int64) << 32) | (np.asarray(bucket, dtype=np.int64) - ZERO_BUCKET)
+    key, inverse = np.unique(key, return_inverse=True)
+    count = np.bincount(inverse, weights=count, minlength=len(key))
+    return key >> 32, ((key & 0xFFFFFFFF) + ZERO_BUCKET).astype(np.int32), np.rint(count).astype(np.int64)
+
+def _bit_length(values):
+    '''
+        Number of bits of each unsigned 64-bit integer (0 for zero).
+    '''
+    values = values.copy()
+    length = np.zeros(len(values), dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        high = values >= (np.uint64(1) << np.uint64(shift))
+        length[high] += shift
+        values[high] >>= np.uint64(shift)
+    return length + (values > 0)
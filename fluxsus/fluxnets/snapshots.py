@@ -0,0 +1,221 @@
+'''
+    Day-resolution index of the SIHSUS admissions for flux network snapshots.
+
+    The admissions are aggregated once per (day of admission, pair of nodes) and,
+    for each pair of nodes, the daily counts and costs are accumulated along the
+    days. The fluxes of any window of dates are then the difference of two
+    cumulative values per pair of nodes, found by binary search, so snapshots of
+    any length and stride are built without reading the records again.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import numpy as np
+import pandas as pd
+
+from fluxsus import icd10
+
+class SnapshotIndex:
+    def __init__(self, target="MUNIC_MOV", multilayer_icd=False, date_col="DT_INTER", icd_level='chapter'):
+        '''
+            Cumulative fluxes per pair of nodes along the days of admission.
+
+            Args:
+            -----
+                target:
+                    String. Field of the target nodes: "MUNIC_MOV" (city flux network)
+                    or "CNES" (city to hospital flux network).
+                multilayer_icd:
+                    Bool. Whether to also index the fluxes of each ICD-10 group.
+                date_col:
+                    String. Date field defining the day of each admission.
+                icd_level:
+                    String. Level of the ICD-10 groups: 'chapter', 'block' or 'category'
+                    (see fluxsus.icd10).
+        '''
+        if target not in ["MUNIC_MOV", "CNES"]:
+            raise ValueError('target must be "MUNIC_MOV" or "CNES".')
+        if icd_level not in icd10.LEVELS:
+            raise ValueError(f'icd_level must be one of {icd10.LEVELS}.')
+        self.target = target
+        self.multilayer_icd = multilayer_icd
+        self.date_col = date_col
+        self.icd_level = icd_level
+        self.keys = ["MUNIC_RES", target] + (["ICD"] if multilayer_icd else [])
+
+        # -- daily cells of the records added, indexed on demand
+        self._cells = []
+        self._index = None
+
+    @property
+    def fields(self):
+        '''
+            Fields of the SIHSUS files needed by the index.
+        '''
+        return ["MUNIC_RES", self.target, "VAL_TOT", self.date_col] + (["DIAG_PRINC"] if self.multilayer_icd else [])
+
+    @classmethod
+    def from_parquet(cls, files, target="MUNIC_MOV", multilayer_icd=False, date_col="DT_INTER", icd_level='chapter'):
+        '''
+            Index of the admissions of a list of SIHSUS parquet files, read once each.
+        '''
+        index = cls(target, multilayer_icd=multilayer_icd, date_col=date_col, icd_level=icd_level)
+        for fname in files:
+            index.add(pd.read_parquet(fname, columns=index.fields))
+        return index
+
+    def add(self, sih_df):
+        '''
+            Add admissions to the index.
+
+            Args:
+            -----
+                sih_df:
+                    pandas.DataFrame. Records with the fields in 'fields'. Records
+                    without a valid date are ignored.
+
+            Return:
+            -------
+                self.
+        '''
+        days = pd.to_datetime(sih_df[self.date_col], errors='coerce')
+        sih_df = sih_df.assign(DAY=days.to_numpy().astype('datetime64[D]').astype(np.int64))[days.notna().to_numpy()]
+        if self.multilayer_icd:
+            sih_df["ICD"] = icd10.classify(sih_df["DIAG_PRINC"], level=self.icd_level)
+
+        cells = sih_df.groupby(["DAY"]+self.keys, observed=True)["VAL_TOT"].agg(sum='sum', count='count', rows='size').reset_index()
+        for col in ["MUNIC_RES", self.target]:
+            if isinstance(cells[col].dtype, pd.CategoricalDtype):
+                cells[col] = cells[col].astype(cells[col].cat.categories.dtype)
+        self._cells.append(cells)
+        self._index = None
+        return self
+
+    def _build(self):
+        '''
+            Sort the daily cells by (pair of nodes, day) and accumulate them per pair.
+        '''
+        cells = pd.concat(self._cells, ignore_index=True)
+        # -- records of the same day may come from different files
+        cells = cells.groupby(self.keys+["DAY"], observed=True)[["sum", "count", "rows"]].sum().reset_index()
+        self._cells = [cells]
+
+        edges = cells[self.keys].drop_duplicates().reset_index(drop=True)
+        # -- cells of each pair are contiguous and sorted by day: position of the
+        # -- first cell of each pair and cumulative values within the pair
+        starts = np.r_[0, np.cumsum(cells.groupby(self.keys, sort=True, observed=True).size().to_numpy())]
+        edge_id = np.repeat(np.arange(edges.shape[0]), np.diff(starts))
+        cumulative = { col: cells.groupby(edge_id)[col].cumsum().to_numpy() for col in ["sum", "count", "rows"] }
+
+        # -- search key of each cell: pair in the high bits, day in the low bits
+        days = cells["DAY"].to_numpy()
+        first_day = days.min() if len(days) else 0
+        key = (edge_id.astype(np.int64) << 32) + (days - first_day)
+
+        self._index = {'edges': edges, 'starts': starts, 'key': key, 'first_day': first_day,
+                       'days': days, 'cumulative': cumulative}
+
+    @property
+    def date_range(self):
+        '''
+            First and last day of admission in the index (numpy.datetime64).
+        '''
+        if self._index is None:
+            self._build()
+        days = self._index['days']
+        return days.min().astype('datetime64[D]'), days.max().astype('datetime64[D]')
+
+    def aggregate(self, start, end):
+        '''
+            Number of admissions and total cost per pair of nodes for admissions
+            between 'start' and 'end' (inclusive).
+
+            Args:
+            -----
+                start:
+                    Date (datetime, numpy.datetime64 or "YYYY-MM-DD").
+                end:
+                    Date (datetime, numpy.datetime64 or "YYYY-MM-DD").
+
+            Return:
+            -------
+                edges:
+                    pandas.DataFrame. Columns "MUNIC_RES", target, "sum" and "count".
+                icd_edges:
+                    pandas.DataFrame. Same as 'edges' per ICD-10 group, with the column
+                    "ICD" (id of the group, see fluxsus.icd10.names). None if the index
+                    is not stratified by ICD-10 group.
+        '''
+        if self._index is None:
+            self._build()
+        index = self._index
+        start, end = _day(start), _day(end)
+
+        # -- cells of each pair within the window: [first, last)
+        starts = index['starts']
+        base = np.arange(len(starts)-1, dtype=np.int64) << 32
+        start = np.clip(start-index['first_day'], 0, (1 << 32)-1)
+        end = np.clip(end-index['first_day'], -1, (1 << 32)-2)
+        first = np.searchsorted(index['key'], base+start, side='left')
+        last = np.searchsorted(index['key'], base+end, side='right')
+
+        window = {}
+        for col, cumulative in index['cumulative'].items():
+            cumulative = np.r_[0, cumulative]
+            # -- cumulative values restart at each pair
+            before = np.where(first>starts[:-1], cumulative[first], 0)
+            window[col] = np.where(last>starts[:-1], cumulative[last], 0) - before
+        active = window['rows'] > 0
+        window_df = index['edges'][active].reset_index(drop=True)
+        window_df["sum"] = window['sum'][active]
+        window_df["count"] = window['count'][active]
+
+        icd_edges = None
+        if self.multilayer_icd:
+            edges = window_df.groupby(["MUNIC_RES", self.target])[["sum", "count"]].sum().reset_index()
+            icd_edges = window_df[window_df["ICD"]>=0].reset_index(drop=True)
+        else:
+            edges = window_df
+        return edges, icd_edges
+
+    def snapshots(self, start, end, length, stride=None):
+        '''
+            Fluxes of a series of windows of dates between 'start' and 'end'.
+
+            Windows begin every 'stride' days from 'start' (while before 'end') and
+            span 'length' days, the last one being cut at 'end'.
+
+            Args:
+            -----
+                start:
+                    Date. First day of the first window.
+                end:
+                    Date. Last day of the last window.
+                length:
+                    Integer. Number of days of each window.
+                stride:
+                    Integer. Number of days between the beginning of consecutive
+                    windows. Default None, which uses 'length' (no overlap).
+
+            Return:
+            -------
+                Generator of Tuples. (first day, last day, edges, icd_edges) of
+                each window, with days as numpy.datetime64 and the tables as in 'aggregate'.
+        '''
+        stride = length if stride is None else stride
+        if length < 1 or stride < 1:
+            raise ValueError('length and stride must be positive.')
+        start, end = _day(start), _day(end)
+        for first in range(start, end, stride):
+            last = min(first+length-1, end)
+            edges, icd_edges = self.aggregate(first, last)
+            yield np.datetime64(first, 'D'), np.datetime64(last, 'D'), edges, icd_edges
+
+def _day(date):
+    '''
+        Number of days since 1970-01-01 of a date.
+    '''
+    if isinstance(date, (int, np.integer)):
+        return int(date)
+    return int(np.datetime64(pd.Timestamp(date), 'D').astype(np.int64))
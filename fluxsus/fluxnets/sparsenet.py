@@ -0,0 +1,150 @@
+'''
+    Sparse-matrix container of the flux networks.
+
+    Nodes are kept as attribute arrays indexed by label, and each edge attribute
+    (admission count, total cost, regions of the endpoints, ...) as a CSR matrix
+    over the same sparsity pattern. The fluxes of the ICD-10 groups are stacked
+    into a single CSR matrix per attribute, so any computation over all groups is
+    a single sparse product. The networkx graph is only built when requested.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import numpy as np
+import pandas as pd
+import networkx as nx
+import scipy.sparse as sp
+
+class SparseNet:
+    def __init__(self, node_graph, source, target, attrs, layers=None, layer_attrs=None):
+        '''
+            Flux network stored as sparse matrices.
+
+            Args:
+            -----
+                node_graph:
+                    networkx.DiGraph or networkx.Graph. Graph holding the nodes (labels
+                    0 to n-1) with their metadata and the graph attributes, without edges.
+                source:
+                    numpy.ndarray. Label of the source node of each edge.
+                target:
+                    numpy.ndarray. Label of the target node of each edge.
+                attrs:
+                    Dictionary. Name of the edge attribute -> array aligned with 'source'.
+                layers:
+                    List of Strings. Suffix of the attributes of each ICD-10 group
+                    (e.g. 'ch1'), in the order of the stacked matrices.
+                layer_attrs:
+                    Dictionary. Name of the attribute ('admission_count', 'total_cost',
+                    ...) -> scipy.sparse.csr_matrix of shape (len(layers)*n, n), where the
+                    rows k*n to (k+1)*n-1 hold the fluxes of the k-th group.
+
+            Attributes:
+            -----------
+                n:
+                    Integer. Number of node labels (size of the square matrices).
+                directed:
+                    Bool. Whether the network is directed.
+                graph_attrs:
+                    Dictionary. Attributes of the network (e.g. 'init_period').
+                weights:
+                    Dictionary. Name of the edge attribute -> scipy.sparse.csr_matrix (n, n).
+        '''
+        self.node_graph = node_graph
+        self.directed = node_graph.is_directed()
+        self.graph_attrs = dict(node_graph.graph)
+        self.n = max(node_graph.nodes)+1 if node_graph.number_of_nodes() else 0
+        self.layers = list(layers) if layers is not None else []
+        self.layer_attrs = layer_attrs if layer_attrs is not None else {}
+        self._nodes = None
+        self._graph = None
+
+        # -- shared sparsity pattern of the edges, sorted by (source, target)
+        order = np.lexsort((target, source))
+        self._source, self._target = np.asarray(source)[order], np.asarray(target)[order]
+        indptr = np.r_[0, np.cumsum(np.bincount(self._source, minlength=self.n))]
+        self.weights = { name: sp.csr_matrix((np.asarray(values)[order], self._target, indptr), shape=(self.n, self.n))
+                         for name, values in attrs.items() }
+
+    @property
+    def nodes(self):
+        '''
+            pandas.DataFrame of the node attributes, indexed by label. Columns added
+            to it (e.g. by NetProperties) are included in 'to_networkx'.
+        '''
+        if self._nodes is None:
+            self._nodes = pd.DataFrame.from_dict(dict(self.node_graph.nodes(data=True)), orient='index').sort_index()
+            self._node_columns = set(self._nodes.columns)
+        return self._nodes
+
+    def set_node_attributes(self, table):
+        '''
+            Bulk write of node attributes given a DataFrame indexed by label (one
+            attribute per column), as columns of 'nodes'.
+        '''
+        nodes = self.nodes
+        table = table.reindex(nodes.index)
+        self._nodes = pd.concat([nodes.drop(columns=[ col for col in table.columns if col in nodes.columns ]), table], axis=1)
+        return self
+
+    def number_of_nodes(self):
+        return self.node_graph.number_of_nodes()
+
+    def number_of_edges(self):
+        return len(self._source)
+
+    def weight(self, name, layer=None):
+        '''
+            Weight matrix (n, n) of an edge attribute, of the whole network or of an
+            ICD-10 group (suffix of its attributes, e.g. 'ch9', or its position).
+        '''
+        if layer is None:
+            return self.weights[name]
+        k = layer if isinstance(layer, (int, np.integer)) else self.layers.index(layer)
+        return self.layer_attrs[name][k*self.n:(k+1)*self.n]
+
+    def edges(self):
+        '''
+            pandas.DataFrame with one row per edge: "source", "target" and the edge
+            attributes (the ones of the ICD-10 groups as '<name>_<layer>').
+        '''
+        table = {'source': self._source, 'target': self._target}
+        for name, matrix in self.weights.items():
+            table[name] = matrix.data
+        for layer in self.layers:
+            for name in self.layer_attrs:
+                table[f'{name}_{layer}'] = self._layer_values(name, layer)
+        return pd.DataFrame(table)
+
+    def _layer_values(self, name, layer):
+        '''
+            Values of an ICD-10 group aligned with the edges (zero where absent).
+        '''
+        return np.asarray(self.weight(name, layer)[self._source, self._target]).ravel()
+
+    def to_networkx(self):
+        '''
+            networkx graph of the network (same nodes and attributes as the networkx
+            backend of the flux classes). The edges are built once and cached, while
+            the node attributes added to 'nodes' are updated at each call.
+        '''
+        if self._graph is None:
+            self._graph = self._build_networkx()
+        # -- node attributes added after the creation of the network
+        if self._nodes is not None:
+            for col in [ col for col in self._nodes.columns if col not in self._node_columns ]:
+                nx.set_node_attributes(self._graph, dict(zip(self._nodes.index.tolist(), self._nodes[col].tolist())), col)
+        return self._graph
+
+    def _build_networkx(self):
+        graph = self.node_graph.copy()
+        graph.graph.update(self.graph_attrs)
+        columns = { name: matrix.data for name, matrix in self.weights.items() }
+        for layer in self.layers:
+            for name in self.layer_attrs:
+                columns[f'{name}_{layer}'] = self._layer_values(name, layer)
+        names = list(columns.keys())
+        values = zip(*[ col.tolist() for col in columns.values() ])
+        graph.add_edges_from( (u, v, dict(zip(names, row))) for u, v, row in zip(self._source.tolist(), self._target.tolist(), values) )
+        return graph
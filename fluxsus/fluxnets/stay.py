@@ -0,0 +1,114 @@
+'''
+    Length of stay and ICU days of the SIHSUS admissions, aggregated per pair of
+    nodes together with the number of admissions and their total cost.
+
+    The length of stay of a record is the number of days between its admission
+    (DT_INTER) and its discharge (DT_SAIDA), or DIAS_PERM when the dates are not
+    available. The ICU days are given by UTI_MES_TO (zero when MARCA_UTI says no
+    ICU was used). Undefined values (missing or negative) are left out of the sums
+    and of the counts of their means.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import numpy as np
+import pandas as pd
+
+# -- fields of the SIHSUS files used, when available
+FIELDS = ["DT_INTER", "DT_SAIDA", "DIAS_PERM", "MARCA_UTI", "UTI_MES_TO"]
+# -- columns of the aggregates beyond "sum" and "count" (of VAL_TOT)
+VALUES = ["stay_sum", "stay_count", "icu_sum", "icu_count"]
+
+def fields(sih_df, stay=True):
+    '''
+        Fields of FIELDS present in the records (none if 'stay' is False).
+    '''
+    return [ field for field in FIELDS if field in sih_df.columns ] if stay else []
+
+def _dates(column):
+    '''
+        Dates of a field stored as dates or as "YYYYMMDD" strings (NaT if invalid).
+    '''
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column
+    # -- date fields of the parquet files are loaded as datetime.date objects
+    if pd.api.types.infer_dtype(column, skipna=True) in ['date', 'datetime']:
+        return pd.to_datetime(column, errors='coerce')
+    return pd.to_datetime(column.astype(str), format="%Y%m%d", errors='coerce')
+
+def _numeric(sih_df, field):
+    if field not in sih_df.columns:
+        return np.full(sih_df.shape[0], np.nan)
+    return pd.to_numeric(sih_df[field], errors='coerce').to_numpy().astype(np.float64)
+
+def stay_days(sih_df):
+    '''
+        Length of stay of each record, in days (NaN if undefined).
+    '''
+    days = _numeric(sih_df, "DIAS_PERM")
+    if "DT_INTER" in sih_df.columns and "DT_SAIDA" in sih_df.columns:
+        delta = (_dates(sih_df["DT_SAIDA"]) - _dates(sih_df["DT_INTER"])).dt.days.to_numpy().astype(np.float64)
+        days = np.where(np.isnan(delta), days, delta)
+    return np.where(days>=0, days, np.nan)
+
+def icu_days(sih_df):
+    '''
+        Number of ICU days of each record (NaN if undefined).
+    '''
+    days = _numeric(sih_df, "UTI_MES_TO")
+    if "MARCA_UTI" in sih_df.columns:
+        marca = _numeric(sih_df, "MARCA_UTI")
+        days = np.where(marca==0, 0, days)
+    return np.where(days>=0, days, np.nan)
+
+def aggregate(sih_df, keys, stay=False):
+    '''
+        Number of admissions and total cost (sum and count of VAL_TOT) per value
+        of the keys and, optionally, the totals and counts of the length of stay
+        and of the ICU days, in a single groupby.
+
+        Args:
+        -----
+            sih_df:
+                pandas.DataFrame. Records with "VAL_TOT", the keys and, if 'stay' is
+                True, the available fields of FIELDS.
+            keys:
+                List of Strings. Columns to group the records by.
+            stay:
+                Bool. Whether to include the columns VALUES.
+
+        Return:
+        -------
+            pandas.DataFrame. Columns keys, "sum", "count" and, if 'stay' is True, VALUES.
+    '''
+    if not stay:
+        return sih_df.groupby(keys, observed=True)["VAL_TOT"].agg(['sum', 'count']).reset_index()
+    records = sih_df[keys+["VAL_TOT"]].assign(STAY=stay_days(sih_df), ICU=icu_days(sih_df))
+    return records.groupby(keys, observed=True).agg(sum=("VAL_TOT", "sum"), count=("VAL_TOT", "count"),
+                                                    stay_sum=("STAY", "sum"), stay_count=("STAY", "count"),
+                                                    icu_sum=("ICU", "sum"), icu_count=("ICU", "count")).reset_index()
+
+def has_stay(table):
+    '''
+        Whether an aggregate has the columns of the length of stay.
+    '''
+    return table is not None and all( col in table.columns for col in VALUES )
+
+def stay_attrs(table):
+    '''
+        Total and mean length of stay and ICU days of each row of an aggregate
+        (mean NaN when no record has the value defined).
+
+        Return:
+        -------
+            Dictionary. 'total_stay_days', 'mean_stay_days', 'total_icu_days' and
+            'mean_icu_days' -> arrays aligned with 'table'.
+    '''
+    attrs = {}
+    for name, col in [("stay_days", "stay"), ("icu_days", "icu")]:
+        total = table[f'{col}_sum'].to_numpy().astype(np.float64)
+        count = table[f'{col}_count'].to_numpy().astype(np.float64)
+        attrs[f'total_{name}'] = total
+        attrs[f'mean_{name}'] = np.divide(total, count, out=np.full(len(total), np.nan), where=count>0)
+    return attrs
@@ -0,0 +1,199 @@
+'''
+    Stratification of the fluxes of the SIHSUS admissions by attributes of the
+    records (age band, death, ICU use, complexity and specialty).
+
+    Each dimension maps the records to integer codes (-1 for records outside of
+    it). Several dimensions are combined into a single stratum id (mixed radix),
+    so the fluxes of all strata come from one groupby over (source, target, stratum):
+    a sparse tensor in long format. The layers of each dimension are the marginals
+    of this tensor, summed from it without reading the records again.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import numpy as np
+import pandas as pd
+
+from fluxsus.fluxnets import stay as fstay
+
+# -- lower bounds of the age bands, in years
+AGE_BANDS = [0, 1, 5, 15, 30, 45, 60, 75]
+
+def _age_codes(sih_df):
+    '''
+        Age band of each record. IDADE is given in the unit of COD_IDADE:
+        hours, days or months (0 to 3, less than one year), years (4) or
+        years above 100 (5).
+    '''
+    unit = pd.to_numeric(sih_df["COD_IDADE"], errors='coerce').to_numpy().astype(np.float64)
+    age = pd.to_numeric(sih_df["IDADE"], errors='coerce').to_numpy().astype(np.float64)
+    years = np.where(unit==4, age, np.where(unit==5, 100+age, np.where(unit<4, 0, np.nan)))
+    codes = np.searchsorted(AGE_BANDS, years, side='right') - 1
+    return np.where(np.isnan(years) | (codes<0), -1, codes)
+
+def _value_codes(values):
+    '''
+        Codes of a field given the list of its valid values (in the order of the labels).
+    '''
+    def codes(column):
+        return pd.Index(values).get_indexer(pd.to_numeric(column, errors='coerce'))
+    return codes
+
+def _icu_codes(sih_df):
+    '''
+        Whether each record used an ICU (MARCA_UTI different from zero).
+    '''
+    marca = pd.to_numeric(sih_df["MARCA_UTI"], errors='coerce').to_numpy().astype(np.float64)
+    return np.where(np.isnan(marca), -1, (marca>0).astype(np.int64))
+
+# -- dimensions of the stratification: fields of the SIHSUS files, labels
+# -- (suffix of the edge attributes) and codes of each record (-1 if undefined)
+DIMENSIONS = {
+    'age': {
+        'fields': ["IDADE", "COD_IDADE"],
+        'labels': [ f'{low}_{high-1}' for low, high in zip(AGE_BANDS[:-1], AGE_BANDS[1:]) ] + [f'{AGE_BANDS[-1]}plus'],
+        'codes': _age_codes,
+    },
+    # -- MORTE: 0 (discharge) or 1 (death)
+    'death': {
+        'fields': ["MORTE"],
+        'labels': ['no', 'yes'],
+        'codes': lambda sih_df: _value_codes([0, 1])(sih_df["MORTE"]),
+    },
+    # -- MARCA_UTI: 0 if no ICU was used, or the type of ICU
+    'icu': {
+        'fields': ["MARCA_UTI"],
+        'labels': ['no', 'yes'],
+        'codes': _icu_codes,
+    },
+    # -- COMPLEX: 1 (primary care), 2 (medium complexity) or 3 (high complexity)
+    'complexity': {
+        'fields': ["COMPLEX"],
+        'labels': ['basic', 'medium', 'high'],
+        'codes': lambda sih_df: _value_codes([1, 2, 3])(sih_df["COMPLEX"]),
+    },
+    # -- ESPEC: specialty of the hospital bed (01 surgical, 02 obstetric, 03 clinical,
+    # -- 04 chronic, 05 psychiatric, 06 phthisiology, 07 pediatric, 08 rehabilitation,
+    # -- 09 to 14 day hospital)
+    'specialty': {
+        'fields': ["ESPEC"],
+        'labels': [ f'{code:02d}' for code in range(1, 15) ],
+        'codes': lambda sih_df: _value_codes(list(range(1, 15)))(sih_df["ESPEC"]),
+    },
+}
+
+def _check(dimensions):
+    for dim in dimensions:
+        if dim not in DIMENSIONS:
+            raise ValueError(f'"{dim}" is not a dimension of the stratification ({list(DIMENSIONS.keys())}).')
+
+def fields(dimensions):
+    '''
+        Fields of the SIHSUS files needed by a list of dimensions.
+    '''
+    _check(dimensions)
+    return list(dict.fromkeys( field for dim in dimensions for field in DIMENSIONS[dim]['fields'] ))
+
+def layer_names(dimensions):
+    '''
+        Suffix of the edge attributes of each layer of a list of dimensions
+        (e.g. 'age_15_29', 'death_yes'), in the order of the layer ids.
+    '''
+    _check(dimensions)
+    return [ f'{dim}_{label}' for dim in dimensions for label in DIMENSIONS[dim]['labels'] ]
+
+def stratum_codes(sih_df, dimensions):
+    '''
+        Joint stratum of each record over a list of dimensions.
+
+        Args:
+        -----
+            sih_df:
+                pandas.DataFrame. Records with the fields of the dimensions.
+            dimensions:
+                List of Strings. Names of the dimensions (see DIMENSIONS).
+
+        Return:
+        -------
+            numpy.ndarray (int64). Id of the stratum of each record, where the code
+            of the last dimension varies fastest, or -1 if any code is undefined.
+    '''
+    _check(dimensions)
+    strata = np.zeros(sih_df.shape[0], dtype=np.int64)
+    valid = np.ones(sih_df.shape[0], dtype=bool)
+    for dim in dimensions:
+        codes = np.asarray(DIMENSIONS[dim]['codes'](sih_df))
+        strata = strata*len(DIMENSIONS[dim]['labels']) + codes
+        valid &= codes>=0
+    return np.where(valid, strata, -1)
+
+def unravel(strata, dimensions):
+    '''
+        Code of each dimension of an array of stratum ids.
+
+        Return:
+        -------
+            pandas.DataFrame. One column per dimension.
+    '''
+    _check(dimensions)
+    strata = np.asarray(strata)
+    sizes = [ len(DIMENSIONS[dim]['labels']) for dim in dimensions ]
+    codes = np.unravel_index(strata, sizes) if len(strata) else [ np.array([], dtype=np.int64) for dim in dimensions ]
+    return pd.DataFrame(dict(zip(dimensions, codes)))
+
+def flux_tensor(sih_df, source_col, target_col, dimensions, stay=False):
+    '''
+        Number of admissions and total cost per (source, target, stratum), in a
+        single groupby.
+
+        Args:
+        -----
+            sih_df:
+                pandas.DataFrame. Records with "VAL_TOT" and the fields of the dimensions.
+            source_col:
+                String. Field of the source nodes (e.g. "MUNIC_RES").
+            target_col:
+                String. Field of the target nodes (e.g. "MUNIC_MOV" or "CNES").
+            dimensions:
+                List of Strings. Names of the dimensions (see DIMENSIONS).
+            stay:
+                Bool. Whether to also aggregate the length of stay and the ICU days
+                (see fluxsus.fluxnets.stay).
+
+        Return:
+        -------
+            pandas.DataFrame. Columns source_col, target_col, "STRATUM" (see 'stratum_codes'),
+            "sum", "count" (and stay.VALUES if 'stay' is True), only for the observed
+            combinations.
+    '''
+    strata = stratum_codes(sih_df, dimensions)
+    strat_df = sih_df[[source_col, target_col, "VAL_TOT"]+fstay.fields(sih_df, stay)][strata>=0].assign(STRATUM=strata[strata>=0])
+    return fstay.aggregate(strat_df, [source_col, target_col, "STRATUM"], stay=stay)
+
+def layer_edges(tensor, dimensions, keys):
+    '''
+        Fluxes of each layer of each dimension, as marginals of a flux tensor.
+
+        Args:
+        -----
+            tensor:
+                pandas.DataFrame. Output of 'flux_tensor'.
+            dimensions:
+                List of Strings. Dimensions of the tensor.
+            keys:
+                List of Strings. Columns of the source and target nodes.
+
+        Return:
+        -------
+            pandas.DataFrame. Columns keys, "LAYER" (position in 'layer_names'),
+            "sum" and "count" (and stay.VALUES if the tensor has them).
+    '''
+    codes = unravel(tensor["STRATUM"].to_numpy(), dimensions)
+    values = ["sum", "count"] + (fstay.VALUES if fstay.has_stay(tensor) else [])
+    tables, offset = [], 0
+    for dim in dimensions:
+        layer = tensor[keys+values].assign(LAYER=codes[dim].to_numpy()+offset)
+        tables.append(layer.groupby(keys+["LAYER"], observed=True)[values].sum().reset_index())
+        offset += len(DIMENSIONS[dim]['labels'])
+    return pd.concat(tables, ignore_index=True)
@@ -0,0 +1,278 @@
+'''
+    Out-of-core aggregation of the fluxes of the SIHSUS admissions.
+
+    The records are read in batches (row groups of each monthly file) and each batch
+    is reduced to partial sums and counts of VAL_TOT per pair of nodes (and per
+    ICD-10 group and stratum), optionally with the sums of the length of stay and
+    ICU days. Partials are merged whenever they grow larger than
+    the merged table, so the memory used is bounded by the number of distinct
+    edges instead of the number of admissions. Accumulators of different files
+    can also be merged (map-reduce).
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from fluxsus import icd10
+from fluxsus.fluxnets import strata as fstrata
+from fluxsus.fluxnets import stay as fstay
+from fluxsus.fluxnets.sketches import CostSketch, DistinctSketch
+
+class FluxAccumulator:
+    def __init__(self, target="MUNIC_MOV", multilayer_icd=False, icd_level='chapter', strata=None, cost_sketch=False, distinct=None, 
+                 stay=False, merge_rows=1000000):
+        '''
+            Running sums and counts of VAL_TOT per pair of nodes.
+
+            Args:
+            -----
+                target:
+                    String. Field of the target nodes: "MUNIC_MOV" (city flux network)
+                    or "CNES" (city to hospital flux network).
+                multilayer_icd:
+                    Bool. Whether to also aggregate the fluxes of each ICD-10 group.
+                icd_level:
+                    String. Level of the ICD-10 groups: 'chapter', 'block' or 'category'
+                    (see fluxsus.icd10).
+                strata:
+                    List of Strings. Dimensions to stratify the fluxes by (see
+                    fluxsus.fluxnets.strata).
+                cost_sketch:
+                    Bool. Whether to also build the sketches of the cost of the admissions
+                    of each pair of nodes (see fluxsus.fluxnets.sketches.CostSketch).
+                distinct:
+                    List of Strings. Fields whose distinct values per pair of nodes are
+                    counted (see fluxsus.fluxnets.sketches.DistinctSketch).
+                stay:
+                    Bool. Whether to also sum the length of stay and the ICU days of the
+                    admissions (see fluxsus.fluxnets.stay).
+                merge_rows:
+                    Integer. Minimum number of rows of pending partials before they
+                    are merged.
+        '''
+        if target not in ["MUNIC_MOV", "CNES"]:
+            raise ValueError('target must be "MUNIC_MOV" or "CNES".')
+        if icd_level not in icd10.LEVELS:
+            raise ValueError(f'icd_level must be one of {icd10.LEVELS}.')
+        self.target = target
+        self.multilayer_icd = multilayer_icd
+        self.icd_level = icd_level
+        self.strata = list(strata) if strata else []
+        self.cost_sketch = cost_sketch
+        self.distinct = list(distinct) if distinct else []
+        self.stay = stay
+        self.merge_rows = merge_rows
+        self.keys = ["MUNIC_RES", target]
+        # -- merged sketch and pending partial sketches of the cost and of the distinct values of each field
+        self._sketches = { ('distinct', field): [DistinctSketch(self.keys)] for field in self.distinct }
+        if self.cost_sketch:
+            self._sketches[('cost', "VAL_TOT")] = [CostSketch(self.keys)]
+        self._sketch_pending = { name: 0 for name in self._sketches }
+        # -- first and last month (YYYYMM) of the records added
+        self.init_period, self.final_period = None, None
+
+        # -- merged table and pending partials of each kind of flux
+        self._tables = { kind: [] for kind in self.kinds }
+        self._pending = { kind: 0 for kind in self.kinds }
+
+    @property
+    def kinds(self):
+        '''
+            Kinds of fluxes aggregated and their keys beyond the pair of nodes.
+        '''
+        kinds = {'edges': []}
+        if self.multilayer_icd:
+            kinds['icd_edges'] = ["ICD"]
+        if self.strata:
+            kinds['tensor'] = ["STRATUM"]
+        return kinds
+
+    @property
+    def fields(self):
+        '''
+            Fields of the SIHSUS files needed by the accumulator (the fields of the
+            length of stay are read when available, see 'from_parquet').
+        '''
+        fields = self.keys + ["VAL_TOT"] + (["DIAG_PRINC"] if self.multilayer_icd else [])
+        fields = fields + [ field for field in fstrata.fields(self.strata) if field not in fields ]
+        return fields + [ field for field in self.distinct if field not in fields ]
+
+    @classmethod
+    def from_parquet(cls, files, target="MUNIC_MOV", multilayer_icd=False, icd_level='chapter', strata=None, cost_sketch=False, 
+                     distinct=None, stay=False, batch_size=500000):
+        '''
+            Fluxes of a list of SIHSUS parquet files, read in batches of records.
+
+            Args:
+            -----
+                files:
+                    List of Strings. Paths to the parquet files.
+                batch_size:
+                    Integer. Maximum number of records read at once.
+
+            Return:
+            -------
+                FluxAccumulator.
+        '''
+        acc = cls(target, multilayer_icd=multilayer_icd, icd_level=icd_level, strata=strata, cost_sketch=cost_sketch, distinct=distinct, 
+                  stay=stay)
+        for fname in files:
+            parquet = pq.ParquetFile(fname)
+            names = parquet.schema_arrow.names
+            optional = ["ANO_CMPT", "MES_CMPT"] + (fstay.FIELDS if stay else [])
+            columns = acc.fields + [ col for col in dict.fromkeys(optional) if col in names and col not in acc.fields ]
+            for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+                acc.add(batch.to_pandas())
+        return acc
+
+    def add(self, sih_df):
+        '''
+            Reduce a batch of admissions to partial fluxes.
+
+            Args:
+            -----
+                sih_df:
+                    pandas.DataFrame. Records with the fields in 'fields' and, optionally,
+                    "ANO_CMPT" and "MES_CMPT" (period of the records).
+
+            Return:
+            -------
+                self.
+        '''
+        if not sih_df.shape[0]:
+            return self
+        # -- codes loaded as categoricals do not share categories between batches
+        for col in self.keys:
+            if isinstance(sih_df[col].dtype, pd.CategoricalDtype):
+                sih_df = sih_df.assign(**{col: sih_df[col].astype(sih_df[col].cat.categories.dtype)})
+
+        if "ANO_CMPT" in sih_df.columns and "MES_CMPT" in sih_df.columns:
+            # -- years and months are stored as small unsigned integers
+            year = pd.to_numeric(sih_df["ANO_CMPT"], errors='coerce').astype('float64')
+            competen = year*100 + pd.to_numeric(sih_df["MES_CMPT"], errors='coerce').astype('float64')
+            if competen.notna().any():
+                self._update_periods(int(competen.min()), int(competen.max()))
+
+        partials = {'edges': fstay.aggregate(sih_df, self.keys, stay=self.stay)}
+        if self.multilayer_icd:
+            group = icd10.classify(sih_df["DIAG_PRINC"], level=self.icd_level).to_numpy()
+            strat_df = sih_df[self.keys+["VAL_TOT"]+fstay.fields(sih_df, self.stay)][group>=0].assign(ICD=group[group>=0])
+            partials['icd_edges'] = fstay.aggregate(strat_df, self.keys+["ICD"], stay=self.stay)
+        if self.strata:
+            partials['tensor'] = fstrata.flux_tensor(sih_df, self.keys[0], self.keys[1], self.strata, stay=self.stay)
+        if self.cost_sketch:
+            self._push_sketch(('cost', "VAL_TOT"), CostSketch.from_records(sih_df, self.keys))
+        for field in self.distinct:
+            self._push_sketch(('distinct', field), DistinctSketch.from_records(sih_df, self.keys, field))
+
+        for kind, partial in partials.items():
+            self._push(kind, partial)
+        return self
+
+    def merge(self, other):
+        '''
+            Add the fluxes of another accumulator (e.g. of other files) with the same options.
+
+            Return:
+            -------
+                self.
+        '''
+        options = lambda acc: (acc.target, acc.multilayer_icd, acc.icd_level, acc.strata, acc.cost_sketch, acc.distinct, acc.stay)
+        if options(other) != options(self):
+            raise ValueError('Accumulators with different options cannot be merged.')
+        if other.init_period is not None:
+            self._update_periods(other.init_period, other.final_period)
+        for kind in self.kinds:
+            for partial in other._tables[kind]:
+                self._push(kind, partial)
+        for name, sketches in other._sketches.items():
+            for sketch in sketches:
+                self._push_sketch(name, sketch)
+        return self
+
+    def fluxes(self):
+        '''
+            Merged fluxes of all records added.
+
+            Return:
+            -------
+                edges:
+                    pandas.DataFrame. Columns "MUNIC_RES", target, "sum" and "count" (and
+                    the columns fluxsus.fluxnets.stay.VALUES if 'stay' is True).
+                icd_edges:
+                    pandas.DataFrame. Same as 'edges' per ICD-10 group, with the column
+                    "ICD" (id of the group, see fluxsus.icd10.names). None if 'multilayer_icd'
+                    is False.
+                tensor:
+                    pandas.DataFrame. Same as 'edges' per stratum, with the column "STRATUM"
+                    (see fluxsus.fluxnets.strata.flux_tensor). None if there are no strata.
+        '''
+        for kind in self.kinds:
+            self._merge(kind)
+        tables = { kind: self._tables[kind][0] if len(self._tables[kind]) else self._empty(kind) for kind in self.kinds }
+        return tables['edges'], tables.get('icd_edges'), tables.get('tensor')
+
+    def sketch(self):
+        '''
+            Merged sketches of the cost per pair of nodes (CostSketch), or None if
+            'cost_sketch' is False.
+        '''
+        if not self.cost_sketch:
+            return None
+        self._merge_sketch(('cost', "VAL_TOT"))
+        return self._sketches[('cost', "VAL_TOT")][0]
+
+    def distinct_sketches(self):
+        '''
+            Dictionary. Field -> sketches of its distinct values per pair of nodes
+            (DistinctSketch).
+        '''
+        for field in self.distinct:
+            self._merge_sketch(('distinct', field))
+        return { field: self._sketches[('distinct', field)][0] for field in self.distinct }
+
+    def _push(self, kind, partial):
+        tables = self._tables[kind]
+        tables.append(partial)
+        self._pending[kind] += partial.shape[0]
+        # -- merge when the partials are larger than the merged table (amortized cost)
+        if self._pending[kind] >= max(self.merge_rows, tables[0].shape[0]):
+            self._merge(kind)
+
+    def _merge(self, kind):
+        tables = self._tables[kind]
+        if len(tables) > 1:
+            keys = self.keys + self.kinds[kind]
+            values = [ col for col in ["sum", "count"]+fstay.VALUES if col in tables[0].columns ]
+            merged = pd.concat(tables, ignore_index=True).groupby(keys)[values].sum().reset_index()
+            self._tables[kind] = [merged]
+        self._pending[kind] = 0
+
+    def _push_sketch(self, name, sketch):
+        sketches = self._sketches[name]
+        sketches.append(sketch)
+        self._sketch_pending[name] += sketch.index.shape[0]
+        # -- same amortized merges as the tables of fluxes (see '_push'), over the edges of the sketches
+        if self._sketch_pending[name] >= max(self.merge_rows, sketches[0].index.shape[0]):
+            self._merge_sketch(name)
+
+    def _merge_sketch(self, name):
+        sketches = self._sketches[name]
+        if len(sketches) > 1:
+            self._sketches[name] = [sketches[0].merge(*sketches[1:])]
+        self._sketch_pending[name] = 0
+
+    def _empty(self, kind):
+        columns = { col: pd.Series(dtype=str) for col in self.keys }
+        columns.update({ col: pd.Series(dtype='int64') for col in self.kinds[kind] })
+        columns.update({"sum": pd.Series(dtype='float64'), "count": pd.Series(dtype='int64')})
+        if self.stay:
+            columns.update({ col: pd.Series(dtype='float64' if col.endswith('sum') else 'int64') for col in fstay.VALUES })
+        return pd.DataFrame(columns)
+
+    def _update_periods(self, init, final):
+        self.init_period = init if self.init_period is None else min(self.init_period, init)
+        self.final_period = final if self.final_period is None else max(self.final_period, final)
@@ -0,0 +1,230 @@
+'''
+    Community detection over many flux networks, weights and trials in a process
+    pool.
+
+    Each task is a (graph, weight, algorithm, seed) combination. The weighted edge
+    list of each (graph, weight) pair is extracted once and sent once to each
+    worker, which runs the algorithm and returns the partition of the nodes. The
+    partitions, codelengths (Infomap) and modularities of all tasks are gathered
+    into a single table, which can be written back to the graphs as node properties.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import time
+import numpy as np
+import pandas as pd
+import networkx as nx
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from infomap import Infomap
+
+from fluxsus.fluxnets.sparsenet import SparseNet
+from fluxsus.preprocessing.netfunctions import stacked_weights, set_node_properties
+
+ALGORITHMS = ['infomap', 'louvain']
+# -- columns of the table of 'detect_communities'
+COLUMNS = ['graph', 'weight', 'algorithm', 'seed', 'node', 'module', 'n_modules', 'codelength', 'modularity',
+           'seconds', 'status', 'error']
+
+def edge_list(graph, weight):
+    '''
+        Weighted edge list of a network, without the edges of zero weight (e.g.
+        absent from a layer).
+
+        Args:
+        -----
+            graph:
+                networkx.DiGraph, networkx.Graph or SparseNet.
+            weight:
+                String. Edge attribute, of the whole network (e.g. 'admission_count')
+                or of a layer (e.g. 'admission_count_ch1').
+
+        Return:
+        -------
+            Dictionary. 'nodes' (pandas.Index, node of each position), 'source' and
+            'target' (positions of the endpoints of each edge), 'weight' and 'directed'.
+    '''
+    if isinstance(graph, SparseNet):
+        directed = graph.directed
+        if weight in graph.weights:
+            matrix = graph.weight(weight)
+        else:
+            layer = next(( layer for layer in graph.layers if weight.endswith(f'_{layer}') and weight[:-len(layer)-1] in graph.layer_attrs ), None)
+            if layer is None:
+                raise ValueError(f'"{weight}" is not an edge attribute of the network.')
+            matrix = graph.weight(weight[:-len(layer)-1], layer)
+        nodes = pd.RangeIndex(graph.n)
+    else:
+        directed = nx.is_directed(graph)
+        matrix, names, nodes, integer = stacked_weights(graph, [weight])
+    matrix = matrix.tocoo()
+    keep = matrix.data!=0
+    return {'nodes': nodes, 'source': matrix.row[keep], 'target': matrix.col[keep],
+            'weight': matrix.data[keep].astype(np.float64), 'directed': directed}
+
+def detect_communities(graphs, weights=None, algorithms=None, seeds=None, trials=5, n_jobs=None):
+    '''
+        Run community detection algorithms over a set of networks, weights and
+        seeds in a process pool.
+
+        Args:
+        -----
+            graphs:
+                Dictionary. Name -> network (networkx graph or SparseNet), e.g. one
+                per snapshot. A single network is named 'graph'.
+            weights:
+                List of Strings. Edge attributes used as weights, of the whole network
+                or of a layer (e.g. 'admission_count_ch1'). Default None, which uses
+                'admission_count' and 'total_cost'.
+            algorithms:
+                List of Strings. Algorithms of ALGORITHMS: 'infomap' (directed for
+                directed networks) and 'louvain' (networkx). Default None, which uses
+                both.
+            seeds:
+                List of Integers. Seeds of the random number generators, one task
+                per seed. Default None, which uses [0].
+            trials:
+                Integer. Number of trials of each Infomap run (the best is kept).
+            n_jobs:
+                Integer. Number of worker processes. Default None, which uses the
+                number of processors of the machine.
+
+        Return:
+        -------
+            pandas.DataFrame. One row per (graph, weight, algorithm, seed, node) with
+            the module of the node (starting at 1), and the number of modules, the
+            codelength (Infomap, NaN for Louvain), the modularity, the time in seconds,
+            the status ('done' or 'failed') and the error message of its task. Failed
+            tasks have a single row without node.
+    '''
+    if not isinstance(graphs, dict):
+        graphs = {'graph': graphs}
+    weights = ['admission_count', 'total_cost'] if weights is None else list(weights)
+    algorithms = list(ALGORITHMS) if algorithms is None else list(algorithms)
+    seeds = [0] if seeds is None else list(seeds)
+    for algorithm in algorithms:
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f'Unknown algorithm "{algorithm}" (options: {ALGORITHMS}).')
+
+    # -- edge lists extracted once per (graph, weight) and loaded once by each worker
+    edges = { (name, weight): edge_list(graph, weight) for name, graph in graphs.items() for weight in weights }
+    tasks = list(product(graphs.keys(), weights, algorithms, seeds))
+
+    tables = []
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_attach_edges, initargs=(edges,)) as executor:
+        futures = { executor.submit(_run_task, name, weight, algorithm, seed, trials): n
+                    for n, (name, weight, algorithm, seed) in enumerate(tasks) }
+        for future in as_completed(futures):
+            n = futures[future]
+            name, weight, algorithm, seed = tasks[n]
+            task = {'task': n, 'graph': name, 'weight': weight, 'algorithm': algorithm, 'seed': seed}
+            try:
+                modules, codelength, modularity, seconds = future.result()
+            except Exception as err:
+                tables.append(pd.DataFrame([{**task, 'status': 'failed', 'error': repr(err)}]))
+                continue
+            tables.append(pd.DataFrame({**task, 'node': edges[(name, weight)]['nodes'], 'module': modules,
+                                        'n_modules': len(np.unique(modules)), 'codelength': codelength,
+                                        'modularity': modularity, 'seconds': seconds, 'status': 'done', 'error': None}))
+
+    table = pd.concat(tables, ignore_index=True).reindex(columns=['task']+COLUMNS)
+    return table.sort_values(by="task", kind='stable').drop("task", axis=1).reset_index(drop=True)
+
+def best_partitions(table):
+    '''
+        Best task of each (graph, weight, algorithm) among the seeds: lowest
+        codelength for Infomap and highest modularity for Louvain.
+
+        Return:
+        -------
+            pandas.DataFrame. Rows of 'table' of the best tasks.
+    '''
+    table = table[table["status"]=="done"]
+    tasks = table.drop_duplicates(subset=["graph", "weight", "algorithm", "seed"])
+    score = np.where(tasks["algorithm"]=="infomap", tasks["codelength"], -tasks["modularity"])
+    best = tasks.assign(score=score).sort_values(by="score", kind='stable').drop_duplicates(subset=["graph", "weight", "algorithm"])
+    return table.merge(best[["graph", "weight", "algorithm", "seed"]], on=["graph", "weight", "algorithm", "seed"])
+
+def write_partitions(graph, table, name='{algorithm}_{weight}_module_id'):
+    '''
+        Bulk write of the partitions of a network as node properties, one per
+        (algorithm, weight) or per (algorithm, weight, seed).
+
+        Args:
+        -----
+            graph:
+                networkx graph or SparseNet.
+            table:
+                pandas.DataFrame. Rows of 'detect_communities' of this network.
+            name:
+                String. Format of the property names with the fields 'algorithm',
+                'weight' and, optionally, 'seed'. Without 'seed', only the best
+                partition among the seeds is written (see 'best_partitions').
+
+        Return:
+        -------
+            pandas.DataFrame. Properties written, indexed by node.
+    '''
+    table = table[table["status"]=="done"]
+    if '{seed}' not in name:
+        table = best_partitions(table)
+    table = table.assign(property=[ name.format(algorithm=algorithm, weight=weight, seed=seed)
+                                    for algorithm, weight, seed in zip(table["algorithm"], table["weight"], table["seed"]) ])
+    properties = table.pivot(index="node", columns="property", values="module")
+    properties.columns.name = None
+    set_node_properties(graph, properties)
+    return properties
+
+# -- edge lists of the tasks loaded by each worker process (see detect_communities)
+_EDGES = {}
+
+def _attach_edges(edges):
+    '''
+        Load the edge lists of the tasks (worker process initializer).
+    '''
+    _EDGES.update(edges)
+
+def _run_task(name, weight, algorithm, seed, trials):
+    '''
+        Partition of one (graph, weight) by one algorithm (worker process).
+
+        Return:
+        -------
+            modules:
+                numpy.ndarray. Module of each node position (starting at 1).
+            codelength:
+                Float. Codelength of the partition (NaN for Louvain).
+            modularity:
+                Float. Modularity of the partition.
+            seconds:
+                Float. Time of the task.
+    '''
+    start = time.time()
+    edges = _EDGES[(name, weight)]
+    n = len(edges['nodes'])
+    graph = nx.DiGraph() if edges['directed'] else nx.Graph()
+    graph.add_nodes_from(range(n))
+    graph.add_weighted_edges_from(zip(edges['source'].tolist(), edges['target'].tolist(), edges['weight'].tolist()))
+
+    codelength = np.nan
+    if algorithm == 'infomap':
+        im = Infomap(directed=edges['directed'], num_trials=trials, seed=seed, silent=True)
+        im.add_nodes(range(n))
+        for u, v, w in zip(edges['source'].tolist(), edges['target'].tolist(), edges['weight'].tolist()):
+            im.add_link(u, v, w)
+        im.run()
+        node_module = im.get_modules(depth_level=1)
+        modules = np.array([ node_module.get(u, 0) for u in range(n) ])
+        codelength = im.codelength
+    else:
+        communities = nx.community.louvain_communities(graph, weight='weight', seed=seed)
+        modules = np.zeros(n, dtype=np.int64)
+        for module_index, nodes in enumerate(communities):
+            modules[list(nodes)] = module_index+1
+
+    partition = pd.Series(np.arange(n)).groupby(modules).apply(set).tolist()
+    modularity = nx.community.modularity(graph, partition, weight='weight')
+    return modules, codelength, modularity, time.time()-start
@@ -0,0 +1,173 @@
+'''
+    Batch conversion of DATASUS DBF files into parquet files.
+
+    Conversions run in a process pool and are incremental: a manifest keeps the
+    size, modification time and hash of each source file against its output,
+    so only new or changed files are converted again.
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import os
+import json
+import time
+import hashlib
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from fluxsus.DBFIX import DBFIX
+
+MANIFEST_NAME = "manifest.json"
+
+def convert_batch(dbf_files, output_folder, manifest=None, n_jobs=None, force=False, codec='latin',
+                  columns=None, parse_dates=None, schema=None, chunksize=100000, row_group_size=None):
+    '''
+        Convert a list of DBF files to parquet, skipping the ones already converted.
+
+        The output of 'path/to/RDCE2301.dbf' is 'output_folder/RDCE2301.parquet'. A file
+        is converted again only if its output is missing, if the conversion options
+        changed, or if its size or content changed since the last conversion (the hash
+        is only computed when size matches but the modification time does not).
+
+        Args:
+        -----
+            dbf_files:
+                List of Strings. Paths to the DBF (or .dbc) files.
+            output_folder:
+                String. Folder where the parquet files are written.
+            manifest:
+                String. Path to the manifest file (JSON). Default None, which uses
+                'manifest.json' inside 'output_folder'.
+            n_jobs:
+                Integer. Number of worker processes. Default None, which uses the
+                number of processors of the machine.
+            force:
+                Bool. Whether to convert every file regardless of the manifest.
+            codec:
+                String. Codec of the text fields of the DBF files.
+            columns:
+                List of Strings. Fields to convert. Default None, which keeps all fields.
+            parse_dates:
+                List of Strings. Text fields holding "YYYYMMDD" dates, stored as dates.
+                Fields not present in a given file are ignored.
+            schema:
+                Dictionary. Type of the fields, as in fluxsus.schemas (e.g. RD_SCHEMA).
+                Fields not present in a given file are ignored.
+            chunksize:
+                Integer. Number of records decoded at a time.
+            row_group_size:
+                Integer. Number of records per parquet row group.
+
+        Return:
+        -------
+            report:
+                pandas.DataFrame. One row per DBF file with the source, the output,
+                the status ('converted', 'skipped' or 'failed'), the conversion time
+                in seconds and the error message of failed conversions.
+    '''
+    if manifest is None:
+        manifest = os.path.join(output_folder, MANIFEST_NAME)
+    entries = load_manifest(manifest)
+    options = {'codec': codec, 'columns': columns, 'parse_dates': parse_dates, 'schema': schema}
+
+    report, pending = [], []
+    for dbf_path in dbf_files:
+        stem = os.path.splitext(os.path.basename(dbf_path))[0]
+        output = os.path.join(output_folder, f"{stem}.parquet")
+        if not force and _is_up_to_date(dbf_path, output, options, entries.get(output)):
+            report.append({'source': dbf_path, 'output': output, 'status': 'skipped', 'seconds': 0.0, 'error': None})
+            # -- keep the manifest in sync with files touched but not changed
+            entries[output]['mtime'] = os.path.getmtime(dbf_path)
+        else:
+            pending.append((dbf_path, output))
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = { executor.submit(_convert_one, dbf_path, output, options, chunksize, row_group_size): (dbf_path, output)
+                    for dbf_path, output in pending }
+        for future in as_completed(futures):
+            dbf_path, output = futures[future]
+            try:
+                entry, seconds = future.result()
+            except Exception as err:
+                report.append({'source': dbf_path, 'output': output, 'status': 'failed', 'seconds': None, 'error': repr(err)})
+                entries.pop(output, None)
+                continue
+            entries[output] = entry
+            report.append({'source': dbf_path, 'output': output, 'status': 'converted', 'seconds': seconds, 'error': None})
+            # -- save progress after each conversion, so interrupted runs are not lost
+            save_manifest(manifest, entries)
+    save_manifest(manifest, entries)
+
+    order = { dbf_path: n for n, dbf_path in enumerate(dbf_files) }
+    report = pd.DataFrame(report, columns=['source', 'output', 'status', 'seconds', 'error'])
+    return report.sort_values(by="source", key=lambda x: x.map(order)).reset_index(drop=True)
+
+def load_manifest(manifest):
+    '''
+        Load the manifest of converted files (output path -> source metadata).
+    '''
+    if not os.path.isfile(manifest):
+        return {}
+    with open(manifest, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, entries):
+    '''
+        Write the manifest atomically, so an interrupted run never leaves it corrupted.
+    '''
+    tmp = manifest + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest)
+
+def file_hash(fname, blocksize=1<<20):
+    '''
+        SHA-256 of the contents of a file, read in blocks.
+    '''
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _is_up_to_date(dbf_path, output, options, entry):
+    '''
+        Whether the output of a DBF file registered in the manifest is still valid.
+    '''
+    if entry is None or not os.path.isfile(output):
+        return False
+    if entry['source'] != dbf_path or entry['options'] != options:
+        return False
+    stat = os.stat(dbf_path)
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime == entry['mtime']:
+        return True
+    # -- same size but touched: compare the contents
+    return file_hash(dbf_path) == entry['sha256']
+
+def _convert_one(dbf_path, output, options, chunksize, row_group_size):
+    '''
+        Convert one DBF file (worker process) and return its manifest entry.
+    '''
+    start = time.time()
+    stat = os.stat(dbf_path)
+    dbf = DBFIX(dbf_path, codec=options['codec'], columns=options['columns'])
+    parse_dates = [ col for col in (options['parse_dates'] or []) if col in dbf.columns ]
+    # -- write to a temporary file first, so a failure never leaves a partial output
+    tmp = output + ".tmp"
+    try:
+        dbf.to_parquet(tmp, chunksize=chunksize, row_group_size=row_group_size, 
+                       parse_dates=parse_dates, schema=options['schema'])
+    except Exception:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    finally:
+        dbf.f.close()
+    os.replace(tmp, output)
+
+    entry = {'source': dbf_path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+             'sha256': file_hash(dbf_path), 'options': options}
+    return entry, time.time()-start
@@ -1,4 +1,132 @@
+import numpy as np
+import pandas as pd
 import networkx as nx
+import scipy.sparse as sp
+
+from fluxsus.fluxnets.sparsenet import SparseNet
+
+# -- prefixes of the columns of 'node_flows'
+FLOW_KINDS = ['incoming', 'out', 'internal']
+
+def weight_names(weights, layers=None):
+    '''
+        Edge attributes of a list of weights over the whole network and over
+        each layer (e.g. 'admission_count', 'admission_count_ch1', ...).
+    '''
+    layers = [None] + list(layers or [])
+    return [ weight if layer is None else f'{weight}_{layer}' for layer in layers for weight in weights ]
+
+def stacked_weights(graph, weights, layers=None):
+    '''
+        Weight matrices of the edge attributes of a list of weights and layers,
+        stacked into a single sparse matrix.
+
+        Args:
+        -----
+            graph:
+                networkx.DiGraph or SparseNet (see fluxsus.fluxnets.sparsenet).
+            weights:
+                List of Strings. Edge attributes (e.g. 'admission_count', 'total_cost').
+            layers:
+                List of Strings. Suffix of the attributes of each layer (e.g. 'ch1',
+                'death_yes'). Default None, which uses only the whole network.
+
+        Return:
+        -------
+            matrix:
+                scipy.sparse.csr_matrix. Shape (K*n, n), where the rows k*n to (k+1)*n-1
+                hold the weights of the k-th attribute of 'names' (zero where absent).
+            names:
+                List of Strings. Edge attribute of each block (see 'weight_names').
+            nodes:
+                pandas.Index. Node of each row (and column) of a block.
+            integer:
+                List of Bools. Whether the weights of each block are integers.
+    '''
+    names = weight_names(weights, layers)
+    if isinstance(graph, SparseNet):
+        blocks = [ graph.weight(weight, layer) for layer in [None]+list(layers or []) for weight in weights ]
+        integer = [ np.issubdtype(block.dtype, np.integer) for block in blocks ]
+        return sp.vstack(blocks, format='csr', dtype=np.float64), names, pd.RangeIndex(graph.n), integer
+
+    # -- networkx graph: edge lists read once for all the attributes
+    nodes = pd.Index(list(graph.nodes()))
+    edges = list(graph.edges(data=True))
+    n, nedges = len(nodes), len(edges)
+    source = nodes.get_indexer([ u for u, v, d in edges ])
+    target = nodes.get_indexer([ v for u, v, d in edges ])
+    columns = [ np.asarray([ d.get(name, 0) for u, v, d in edges ]) for name in names ]
+    integer = [ np.issubdtype(col.dtype, np.integer) for col in columns ]
+    rows = np.concatenate([ source+k*n for k in range(len(names)) ])
+    values = np.concatenate([ col.astype(np.float64) for col in columns ])
+    matrix = sp.csr_matrix((values, (rows, np.tile(target, len(names)))), shape=(len(names)*n, n))
+    return matrix, names, nodes, integer
+
+def node_flows(graph, weights=None, layers=None):
+    '''
+        Incoming, outgoing and internal (self edge) flows of each node for a list
+        of weights over the whole network and each layer, from sparse products
+        over the stacked weight matrix (see 'stacked_weights'): a single call
+        for all the weights and layers.
+
+        The incoming and outgoing flows do not include the self edges.
+
+        Args:
+        -----
+            graph:
+                networkx.DiGraph or SparseNet (see fluxsus.fluxnets.sparsenet).
+            weights:
+                List of Strings. Edge attributes of the flows. Default None, which uses
+                'admission_count' and 'total_cost'.
+            layers:
+                List of Strings. Suffix of the attributes of each layer (e.g. the
+                'layers' of a SparseNet). Default None, which uses only the whole
+                network.
+
+        Return:
+        -------
+            pandas.DataFrame. Indexed by node, with the columns '<kind>_<attribute>'
+            for each kind of FLOW_KINDS (e.g. 'incoming_admission_count',
+            'out_total_cost_ch1', 'internal_admission_count').
+    '''
+    directed = graph.directed if isinstance(graph, SparseNet) else nx.is_directed(graph)
+    if not directed:
+        raise Exception('graph parsed is not directed.')
+    weights = ['admission_count', 'total_cost'] if weights is None else list(weights)
+    matrix, names, nodes, integer = stacked_weights(graph, weights, layers)
+    k, n = len(names), len(nodes)
+    # -- block sums: rows of the blocks (out), columns of each block (in) and their diagonals
+    blocks = sp.kron(sp.identity(k, format='csr'), np.ones((1, n)), format='csr')
+    diagonals = sp.vstack([sp.identity(n, format='csr')]*k, format='csr')
+    ones = np.ones(n)
+    out_flow = (matrix @ ones).reshape(k, n)
+    in_flow = np.asarray((blocks @ matrix).todense()).reshape(k, n)
+    internal = (matrix.multiply(diagonals) @ ones).reshape(k, n)
+
+    columns = {}
+    for kind, flow in [('incoming', in_flow-internal), ('out', out_flow-internal), ('internal', internal)]:
+        for m, name in enumerate(names):
+            # -- integer weights (e.g. counts) keep integer flows
+            columns[f'{kind}_{name}'] = np.rint(flow[m]).astype(np.int64) if integer[m] else flow[m]
+    table = pd.DataFrame(columns, index=nodes)
+    if isinstance(graph, SparseNet):
+        table = table.loc[graph.nodes.index]
+    return table
+
+def set_node_properties(graph, table):
+    '''
+        Bulk write of node properties given a DataFrame indexed by node (one
+        property per column).
+
+        Return:
+        -------
+            graph.
+    '''
+    if isinstance(graph, SparseNet):
+        graph.set_node_attributes(table)
+        return graph
+    nx.set_node_attributes(graph, table.to_dict('index'))
+    return graph
 
 def calculate_incoming_flow(graph, weight_people_col=None, weight_cost_col=None, 
                             people_property_name='incoming_people', 
@@ -23,17 +151,11 @@ def calculate_incoming_flow(graph, weight_people_col=None, weight_cost_col=None,
                 networkx.DiGraph. The input network augmented with new node
                 properties referring to the total flows calculated.
     '''
-    if not nx.is_directed(graph):
-        raise Exception('graph parsed is not directed.')
-    
-    # -- aggregate incoming information
-    for u in graph.nodes():
-        in_edges = [ e for e in graph.in_edges(u) ]
-        graph.nodes[u][people_property_name] = 0
-        graph.nodes[u][cost_property_name] = 0
-        for e in in_edges:
-            graph.nodes[u][people_property_name] += graph.edges[e][weight_people_col]
-            graph.nodes[u][cost_property_name] += graph.edges[e][weight_cost_col]
+    # -- aggregate incoming information (including self edges)
+    flows = node_flows(graph, [weight_people_col, weight_cost_col])
+    set_node_properties(graph, pd.DataFrame({
+        people_property_name: flows[f'incoming_{weight_people_col}'] + flows[f'internal_{weight_people_col}'],
+        cost_property_name: flows[f'incoming_{weight_cost_col}'] + flows[f'internal_{weight_cost_col}']}))
 
     # -- create new weight based on the number of hospital beds
     #for u, v in graph.edges():
@@ -64,16 +186,10 @@ def calculate_out_flow(graph, weight_people_col=None, weight_cost_col=None,
                 networkx.DiGraph. The input network augmented with new node
                 properties referring to the total flows calculated.
     '''
-    if not nx.is_directed(graph):
-        raise Exception('graph parsed is not directed.')
-    
-    # -- aggregate outgoing information
-    for u in graph.nodes():
-        out_edges = [ e for e in graph.out_edges(u) ]
-        graph.nodes[u][people_property_name] = 0
-        graph.nodes[u][cost_property_name] = 0
-        for e in out_edges:
-            graph.nodes[u][people_property_name] += graph.edges[e][weight_people_col]
-            graph.nodes[u][cost_property_name] += graph.edges[e][weight_cost_col]
+    # -- aggregate outgoing information (including self edges)
+    flows = node_flows(graph, [weight_people_col, weight_cost_col])
+    set_node_properties(graph, pd.DataFrame({
+        people_property_name: flows[f'out_{weight_people_col}'] + flows[f'internal_{weight_people_col}'],
+        cost_property_name: flows[f'out_{weight_cost_col}'] + flows[f'internal_{weight_cost_col}']}))
     
     return graph
\ No newline at end of file
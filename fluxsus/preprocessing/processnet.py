@@ -1,6 +1,7 @@
 import pandas as pd
-import networkx as nx
-from fluxsus.utils_ import f_infomap
+from fluxsus.fluxnets.sparsenet import SparseNet
+from fluxsus.preprocessing.netfunctions import node_flows, set_node_properties
+from fluxsus.preprocessing.communities import detect_communities, write_partitions
 
 class NetProperties:
     '''
@@ -9,10 +10,51 @@ class NetProperties:
         Args:
         -----
             graph:
-                networkx.DiGraph.
+                networkx.DiGraph or SparseNet (see fluxsus.fluxnets.sparsenet). Flows
+                are computed by sparse products over the stacked weight matrices (see
+                fluxsus.preprocessing.netfunctions.node_flows), and for a SparseNet the
+                node properties are written as columns of its 'nodes' table.
     '''
     def __init__(self, graph) -> None:
         self.graph = graph
+        self.sparse = isinstance(graph, SparseNet)
+
+    def calculate_flows(self, weights=None, layers=None, write=True):
+        '''
+            Incoming, outgoing and internal flows of each node for a list of weights
+            over the whole network and each layer, in a single call (see
+            fluxsus.preprocessing.netfunctions.node_flows).
+
+            Args:
+            -----
+                weights:
+                    List of Strings. Edge attributes of the flows. Default None, which
+                    uses 'admission_count' and 'total_cost'.
+                layers:
+                    List of Strings. Suffix of the attributes of each layer (e.g. 'ch1').
+                    Default None, which uses only the whole network.
+                write:
+                    Bool. Whether to write the flows as node properties (one per column).
+
+            Return:
+            -------
+                pandas.DataFrame. Flows indexed by node (e.g. 'incoming_admission_count',
+                'out_total_cost_ch1', 'internal_admission_count').
+        '''
+        flows = node_flows(self.graph, weights, layers)
+        if write:
+            set_node_properties(self.graph, flows)
+        return flows
+
+    def _flow(self, kind, weight_people_col, weight_cost_col, people_property_name, cost_property_name):
+        '''
+            Write one kind of flow ('incoming', 'out' or 'internal') of a pair of
+            weights as node properties.
+        '''
+        flows = node_flows(self.graph, [weight_people_col, weight_cost_col])
+        set_node_properties(self.graph, pd.DataFrame({people_property_name: flows[f'{kind}_{weight_people_col}'],
+                                                      cost_property_name: flows[f'{kind}_{weight_cost_col}']}))
+        return self
 
     def calculate_in_flow(self, weight_people_col=None, weight_cost_col=None, 
                           people_property_name='incoming_people', 
@@ -37,22 +79,8 @@ class NetProperties:
                     networkx.DiGraph. The input network augmented with new node
                     properties referring to the total flows calculated.
         '''
-        if not nx.is_directed(self.graph):
-            raise Exception('self.graph parsed is not directed.')
-
-        # -- aggregate incoming information
-        for u in self.graph.nodes():
-            in_edges = [ e for e in self.graph.in_edges(u) ]
-            self.graph.nodes[u][people_property_name] = 0
-            self.graph.nodes[u][cost_property_name] = 0
-            for e in in_edges:
-                # -- do not include self edges
-                if e[0]==e[1]:
-                    continue
-                self.graph.nodes[u][people_property_name] += self.graph.edges[e][weight_people_col]
-                self.graph.nodes[u][cost_property_name] += self.graph.edges[e][weight_cost_col]
-
-        return self
+        # -- aggregate incoming information (self edges not included)
+        return self._flow('incoming', weight_people_col, weight_cost_col, people_property_name, cost_property_name)
     
 
     def calculate_out_flow(self, weight_people_col=None, weight_cost_col=None, 
@@ -78,22 +106,8 @@ class NetProperties:
                     networkx.DiGraph. The input network augmented with new node
                     properties referring to the total flows calculated.
         '''
-        if not nx.is_directed(self.graph):
-            raise Exception('self.graph parsed is not directed.')
-
-        # -- aggregate outgoing information
-        for u in self.graph.nodes():
-            out_edges = [ e for e in self.graph.out_edges(u) ]
-            self.graph.nodes[u][people_property_name] = 0
-            self.graph.nodes[u][cost_property_name] = 0
-            for e in out_edges:
-                # -- do not include self edges
-                if e[0]==e[1]:
-                    continue
-                self.graph.nodes[u][people_property_name] += self.graph.edges[e][weight_people_col]
-                self.graph.nodes[u][cost_property_name] += self.graph.edges[e][weight_cost_col]
-
-        return self
+        # -- aggregate outgoing information (self edges not included)
+        return self._flow('out', weight_people_col, weight_cost_col, people_property_name, cost_property_name)
     
     def calculate_internal_flow(self, weight_people_col=None, weight_cost_col=None, 
                                 people_property_name='internal_people', 
@@ -118,21 +132,8 @@ class NetProperties:
                     networkx.DiGraph. The input network augmented with new node
                     properties referring to the total flows calculated.
         '''
-        if not nx.is_directed(self.graph):
-            raise Exception('self.graph parsed is not directed.')
-
-        # -- aggregate outgoing information
-        for u in self.graph.nodes():
-            out_edges = [ e for e in self.graph.out_edges(u) ]
-            self.graph.nodes[u][people_property_name] = 0
-            self.graph.nodes[u][cost_property_name] = 0
-            for e in out_edges:
-                # -- include only self edges
-                if e[0]!=e[1]:
-                    continue
-                self.graph.nodes[u][people_property_name] += self.graph.edges[e][weight_people_col]
-                self.graph.nodes[u][cost_property_name] += self.graph.edges[e][weight_cost_col]
-        return self
+        # -- aggregate internal information (only self edges)
+        return self._flow('internal', weight_people_col, weight_cost_col, people_property_name, cost_property_name)
 
     def get_hospitalbeds(self, cnes_df, geodata_df):
         '''
@@ -142,52 +143,92 @@ class NetProperties:
             note: some complexities are not included - temporality not include (some hospitals 
             might exist only after a given date, therefore it might include bias)
         '''
-        cnes_df = cnes_df.merge(self.geodata_df[["MACRO_ID", "CRES_ID", "MACRO_NOME", "GEOCOD6"]], left_on="CODUFMUN", right_on="GEOCOD6", how="left").drop("GEOCOD6", axis=1)
+        cnes_df = cnes_df.merge(geodata_df[["MACRO_ID", "CRES_ID", "MACRO_NOME", "GEOCOD6"]], left_on="CODUFMUN", right_on="GEOCOD6", how="left").drop("GEOCOD6", axis=1)
         cnes_df["NUMLEITOS"] = cnes_df[["QTLEITP1", "QTLEITP2", "QTLEITP3"]].sum(axis=1)
         leitos_aux = cnes_df.groupby(["CODUFMUN"])["NUMLEITOS"].sum().reset_index().rename({"CODUFMUN": "GEOCOD6"}, axis=1)
         geodata_df = geodata_df.merge(leitos_aux, on="GEOCOD6", how="left")
         geodata_df["NUMLEITOS"] = geodata_df["NUMLEITOS"].apply(lambda x: 1 if pd.isna(x) or x==0 else x)
 
         mun_to_numleitos = dict(zip(geodata_df["GEOCOD6"], geodata_df["NUMLEITOS"]))
+        if self.sparse:
+            self.graph.nodes['numleitos'] = self.graph.nodes['municipio_code'].map(mun_to_numleitos)
+            return self
         for u in self.graph.nodes():
             self.graph.nodes[u]['numleitos'] = mun_to_numleitos[self.graph.nodes[u]['municipio_code']]
 
         return self
 
 
+    def detect_communities(self, weights=None, algorithms=None, seeds=None, trials=5, n_jobs=None, 
+                           name='{algorithm}_{weight}_module_id', write=True):
+        '''
+            Partitions of the network for each (weight, algorithm, seed), computed
+            in a process pool (see fluxsus.preprocessing.communities).
+
+            Args:
+            -----
+                weights:
+                    List of Strings. Edge attributes used as weights (e.g. 'admission_count',
+                    'total_cost_ch1'). Default None, which uses 'admission_count' and
+                    'total_cost'.
+                algorithms:
+                    List of Strings. 'infomap' and/or 'louvain'. Default None, which uses both.
+                seeds:
+                    List of Integers. Seeds of the runs. Default None, which uses [0].
+                trials:
+                    Integer. Number of trials of each Infomap run.
+                n_jobs:
+                    Integer. Number of worker processes.
+                name:
+                    String. Format of the names of the node properties (see
+                    communities.write_partitions).
+                write:
+                    Bool. Whether to write the partitions as node properties.
+
+            Return:
+            -------
+                pandas.DataFrame. Module of each node per task, with the codelength and
+                modularity of the partitions (see communities.detect_communities).
+        '''
+        table = detect_communities(self.graph, weights=weights, algorithms=algorithms, seeds=seeds, trials=trials, n_jobs=n_jobs)
+        if write:
+            write_partitions(self.graph, table, name=name)
+        return table
+
+    def _write_modules(self, table, properties):
+        '''
+            Write the modules of each weight of a table of partitions as the node
+            properties of 'properties' (weight -> name).
+        '''
+        failed = table[table["status"]=="failed"]
+        if failed.shape[0]:
+            raise Exception(f'community detection failed: {failed["error"].iloc[0]}')
+        modules = table.pivot(index="node", columns="weight", values="module")
+        set_node_properties(self.graph, pd.DataFrame({ name: modules[weight] for weight, name in properties.items() }))
+
     def process_infomap_graph(self, trials=5, weight_people_col='admission_count', weight_cost_col='total_cost', 
-                              people_property_name='infomap_admission_count_module_id', cost_property_name='infomap_cost_module_id'):
+                              people_property_name='infomap_admission_count_module_id', cost_property_name='infomap_cost_module_id',
+                              seed=123, n_jobs=None):
         ''' 
             return graph with new node metadata on infomap modules.
-        '''
-        # -- community algorithms
-        infomap_admcount, codelength_admcount = f_infomap(self.graph, weight_col=weight_people_col, trials=trials)
-        #infomap_perhospbed = f_infomap(self.graph, weight_col='outflow_per_hospbed')
-        infomap_cost, codelength_cost = f_infomap(self.graph, weight_col=weight_cost_col, trials=trials)
 
-        for u in self.graph.nodes():
-            self.graph.nodes[u][people_property_name] = infomap_admcount[int(u)]
-            #self.graph.nodes[u]['infomap_count_per_leito_module_id'] = infomap_perhospbed[int(u)]
-            self.graph.nodes[u][cost_property_name] = infomap_cost[int(u)]
+            The weights run in parallel (see 'detect_communities'); 'seed' defaults
+            to the one of Infomap.
+        '''
+        table = detect_communities(self.graph, weights=[weight_people_col, weight_cost_col], algorithms=['infomap'], 
+                                   seeds=[seed], trials=trials, n_jobs=n_jobs)
+        self._write_modules(table, {weight_people_col: people_property_name, weight_cost_col: cost_property_name})
         return self
     
-    def process_louvain_graph(self, weight_people_col='admission_count', weight_cost_col='total_cost'):
+    def process_louvain_graph(self, weight_people_col='admission_count', weight_cost_col='total_cost', seed=None, n_jobs=None):
         ''' 
             return graph with new node metadata on louvain communities.
-        '''
-        # -- create new weight based on the number of hospital beds
 
-        # -- community algorithms
-        louvain_modules_count = nx.community.louvain_communities(self.graph, weight=weight_people_col)
-        #louvain_modules_hospbed = nx.community.louvain_communities(self.graph, weight='outflow_per_hospbed')
-        louvain_modules_cost = nx.community.louvain_communities(self.graph, weight=weight_cost_col)
-
-        for module_index, nodes in enumerate(louvain_modules_count): 
-            for node in list(nodes): self.graph.nodes[node]['louvain_count_module_id'] = module_index+1
-        #for module_index, nodes in enumerate(louvain_modules_hospbed): 
-        #    for node in list(nodes): self.graph.nodes[node]['louvain_count_per_leito_module_id'] = module_index+1
-        for module_index, nodes in enumerate(louvain_modules_cost): 
-            for node in list(nodes): self.graph.nodes[node]['louvain_cost_module_id'] = module_index+1
+            The weights run in parallel (see 'detect_communities').
+        '''
+        table = detect_communities(self.graph, weights=[weight_people_col, weight_cost_col], algorithms=['louvain'], 
+                                   seeds=[seed], n_jobs=n_jobs)
+        self._write_modules(table, {weight_people_col: 'louvain_count_module_id', weight_cost_col: 'louvain_cost_module_id'})
         return self.graph
     
     def process_sbm_graph(self):
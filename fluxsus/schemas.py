@@ -0,0 +1,155 @@
+'''
+    Typed schemas of the DATASUS file layouts converted to parquet.
+
+    Each schema maps a field name to the type it is stored with:
+
+        'category'                  dictionary-encoded string (codes, ICD-10, ...)
+        'string'                    plain string
+        'uint8', ..., 'int64'       integer (small enumerations, counts, ...)
+        'float32', 'float64'        real number (values)
+        'date'                      date, from "YYYYMMDD" strings
+
+    Codes are kept as dictionary-encoded strings instead of integers, since they
+    are zero-padded (CNES, IBGE municipality codes) and joined with other tables
+    holding them as strings. Fields not listed keep the type declared in the DBF
+    header (see DBFIX.arrow_schema).
+
+    Author: Higor S. Monteiro
+    email: higor.monteiro@fisica.ufc.br
+'''
+
+import os
+
+# -- SIHSUS: AIH reduzida (RD)
+RD_SCHEMA = {
+    'UF_ZI': 'category',
+    'ANO_CMPT': 'uint16',
+    'MES_CMPT': 'uint8',
+    'ESPEC': 'uint8',
+    'CGC_HOSP': 'category',
+    'N_AIH': 'int64',
+    'IDENT': 'uint8',
+    'CEP': 'category',
+    'MUNIC_RES': 'category',
+    'NASC': 'date',
+    'SEXO': 'uint8',
+    'UTI_MES_TO': 'uint16',
+    'MARCA_UTI': 'uint8',
+    'UTI_INT_TO': 'uint16',
+    'DIAR_ACOM': 'uint16',
+    'QT_DIARIAS': 'uint16',
+    'PROC_SOLIC': 'category',
+    'PROC_REA': 'category',
+    'VAL_SH': 'float64',
+    'VAL_SP': 'float64',
+    'VAL_TOT': 'float64',
+    'VAL_UTI': 'float64',
+    'DT_INTER': 'date',
+    'DT_SAIDA': 'date',
+    'DIAG_PRINC': 'category',
+    'DIAG_SECUN': 'category',
+    'COBRANCA': 'uint8',
+    'NATUREZA': 'uint8',
+    'NAT_JUR': 'category',
+    'GESTAO': 'uint8',
+    'MUNIC_MOV': 'category',
+    'COD_IDADE': 'uint8',
+    'IDADE': 'uint8',
+    'DIAS_PERM': 'uint16',
+    'MORTE': 'uint8',
+    'NACIONAL': 'category',
+    'CAR_INT': 'uint8',
+    'INSTRU': 'uint8',
+    'CID_NOTIF': 'category',
+    'CID_ASSO': 'category',
+    'CID_MORTE': 'category',
+    'CNES': 'category',
+    'COMPLEX': 'uint8',
+    'FINANC': 'uint8',
+    'RACA_COR': 'uint8',
+}
+
+# -- CNES: estabelecimentos (ST)
+ST_SCHEMA = {
+    'CNES': 'category',
+    'CODUFMUN': 'category',
+    'COD_CEP': 'category',
+    'REGSAUDE': 'category',
+    'MICR_REG': 'category',
+    'DISTRSAN': 'category',
+    'DISTRADM': 'category',
+    'PF_PJ': 'uint8',
+    'NIV_DEP': 'uint8',
+    'ESFERA_A': 'uint8',
+    'ATIVIDAD': 'uint8',
+    'RETENCAO': 'uint8',
+    'NATUREZA': 'uint8',
+    'CLIENTEL': 'uint8',
+    'TP_UNID': 'uint8',
+    'TURNO_AT': 'uint8',
+    'NIV_HIER': 'uint8',
+    'TP_PREST': 'uint8',
+    'TPGESTAO': 'category',
+    'NAT_JUR': 'category',
+    'COMPETEN': 'uint32',
+}
+
+# -- SIASUS: APAC de tratamento dialítico (ATD)
+ATD_SCHEMA = {
+    'AP_MVM': 'uint32',
+    'AP_CONDIC': 'category',
+    'AP_GESTAO': 'category',
+    'AP_CODUNI': 'category',
+    'AP_AUTORIZ': 'int64',
+    'AP_CMP': 'uint32',
+    'AP_PRIPAL': 'category',
+    'AP_VL_AP': 'float64',
+    'AP_UFMUN': 'category',
+    'AP_TPUPS': 'uint8',
+    'AP_TIPPRE': 'uint8',
+    'AP_COIDADE': 'uint8',
+    'AP_NUIDADE': 'uint8',
+    'AP_SEXO': 'category',
+    'AP_RACACOR': 'uint8',
+    'AP_MUNPCN': 'category',
+    'AP_DTINIC': 'date',
+    'AP_DTFIM': 'date',
+    'AP_MOTSAI': 'uint8',
+    'AP_OBITO': 'uint8',
+    'AP_DTSOLIC': 'date',
+    'AP_DTAUT': 'date',
+    'AP_CIDCAS': 'category',
+    'AP_CIDPRI': 'category',
+    'AP_CIDSEC': 'category',
+}
+
+SCHEMAS = {
+    'RD': RD_SCHEMA,
+    'ST': ST_SCHEMA,
+    'ATD': ATD_SCHEMA,
+}
+
+def schema_for(fname, columns=None):
+    '''
+        Schema of a DATASUS file given its name, following the pattern
+        "XXUFYYMM.dbf", where 'XX' is the prefix of the layout (e.g. "RDCE2301.dbf").
+
+        Args:
+        -----
+            fname:
+                String. Name (with optional path) of the DATASUS file.
+            columns:
+                List of Strings. Only these fields are kept in the schema. Default
+                None, which keeps all fields.
+
+        Return:
+        -------
+            schema:
+                Dictionary. Field name -> type. Empty if the layout is not registered.
+    '''
+    stem = os.path.splitext(os.path.basename(fname))[0].upper()
+    # -- remove the state code and the period
+    schema = SCHEMAS.get(stem[:-6], {})
+    if columns is not None:
+        schema = { name: typ for name, typ in schema.items() if name in columns }
+    return dict(schema)
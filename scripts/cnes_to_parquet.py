@@ -4,11 +4,18 @@ sys.path.append("..")
 
 import pandas as pd
 from fluxsus.DBFIX import DBFIX
+from fluxsus.preprocessing.convert import convert_batch
+from fluxsus.schemas import ST_SCHEMA
 
-def cnes_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, output_path: str):
+def cnes_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, output_path: str, 
+                    chunksize=100000, row_group_size=None):
     '''
         Convert CNES DBF file to parquet for fast throughput.
 
+        The file is converted in chunks of records, so memory usage does not
+        depend on the size of the DBF file. Fields are stored with the types
+        of fluxsus.schemas.ST_SCHEMA.
+
         Args:
         -----
             dbf_fname:
@@ -17,9 +24,15 @@ def cnes_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, output
                 String. Complete path to the DBF file.
             output_path:
                 ...
+            chunksize:
+                Integer. Number of records decoded at a time.
+            row_group_size:
+                Integer. Number of records per parquet row group. Default None,
+                which writes one row group per chunk.
     '''
-    cnes_df = DBFIX( os.path.join(path_to_file, dbf_fname), codec='latin' ).to_dataframe()
-    cnes_df.to_parquet(os.path.join(output_path, output_fname))
+    dbf = DBFIX( os.path.join(path_to_file, dbf_fname), codec='latin' )
+    dbf.to_parquet(os.path.join(output_path, output_fname), chunksize=chunksize, 
+                   row_group_size=row_group_size, schema=ST_SCHEMA)
 
 if __name__=="__main__":
     # -- change any path according to your own inputs and outputs.
@@ -31,9 +44,10 @@ if __name__=="__main__":
     years_ = [ f'{n:2.0f}'.replace(' ', '0') for n in range(8,23+1) ]
 
     uf = 'CE'
-    for year in years_:
-        for month in months_:
-            fname = f'ST{uf}{year}{month}'
-            print(f'Arquivo {fname} ... ', end='')
-            cnes_to_parquet(fname+'.DBF', input_folder, fname+'.parquet', output_folder)
-            print(f'feito.')
\ No newline at end of file
+    dbf_files = [ os.path.join(input_folder, f'ST{uf}{year}{month}.DBF') for year in years_ for month in months_ ]
+    dbf_files = [ fname for fname in dbf_files if os.path.isfile(fname) ]
+    # -- only new or changed files are converted (see the manifest in the output folder)
+    report = convert_batch(dbf_files, output_folder, schema=ST_SCHEMA)
+    print(report["status"].value_counts().to_dict())
+    for _, row in report[report["status"]=="failed"].iterrows():
+        print(f'Arquivo {row["source"]} falhou: {row["error"]}')
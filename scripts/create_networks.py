@@ -7,106 +7,70 @@ import networkx as nx
 import geopandas as gpd
 import fluxsus.fluxnets.fnets_utils as futils
 from fluxsus.fluxnets.fluxnets import CityFlux, CityHospitalFlux
+from fluxsus.fluxnets.fluxcube import FluxCube
 
 # -------------- network creation --------------
 
 # -- obs: need to convert DBFs to parquet before running this script.
 
-# -- open the three main datasets: cnes, ceará geodata, sihsus.
-basepath = os.path.join(os.environ["HOMEPATH"], "Documents", "data")
-cnespath = os.path.join(basepath, "opendatasus", "cnes")
-sihpath = os.path.join(basepath, "opendatasus", "sihsus", "PARQUET")
-geopath = os.path.join(basepath, "shapefilesceqgis")
-output = os.path.join(basepath, "redes_aih", "novo_completo")
-
-cnes_df = pd.read_parquet(os.path.join(cnespath, "cnes_st_0801_2312.parquet"))
-geodata_df = gpd.read_parquet(os.path.join(geopath, "ce_geodata.parquet"))
-
-# -- city net
-
-# ---- larger agg
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE1301', f'RDCE2212', output=os.path.join(output, f"cityfluxnet_agg_1301_2212.gml"))
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE1801', f'RDCE2212', output=os.path.join(output, f"cityfluxnet_agg_1801_2212.gml"))
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE1801', f'RDCE2306', output=os.path.join(output, f"cityfluxnet_agg_1801_2306.gml"))
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE2001', f'RDCE2212', output=os.path.join(output, f"cityfluxnet_agg_2001_2212.gml"))
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE2001', f'RDCE2306', output=os.path.join(output, f"cityfluxnet_agg_2001_2306.gml"))
-
-# ---- larger agg with self edges
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE1301', f'RDCE2212', output=os.path.join(output, f"cityfluxnet_agg_self_1301_2212.gml"), self_edges=True)
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE1801', f'RDCE2212', output=os.path.join(output, f"cityfluxnet_agg_self_1801_2212.gml"), self_edges=True)
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE1801', f'RDCE2306', output=os.path.join(output, f"cityfluxnet_agg_self_1801_2306.gml"), self_edges=True)
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE2001', f'RDCE2212', output=os.path.join(output, f"cityfluxnet_agg_self_2001_2212.gml"), self_edges=True)
-futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE2001', f'RDCE2306', output=os.path.join(output, f"cityfluxnet_agg_self_2001_2306.gml"), self_edges=True)
-
-# ---- per year
-for yy in [f'{n}' for n in range(10, 23+1)]:
-    futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE{yy}01', f'RDCE{yy}12', output=os.path.join(output, f"cityfluxnet_agg_{yy}01_{yy}12.gml"))
-
-# ---- temporal without overlap
-for yy in [f'{n}' for n in range(10, 23+1)]:
-    for mm_pair in [('01', '03'), ('04', '06'), ('07', '09'), ('10', '12')]:
-        futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE{yy}{mm_pair[0]}', f'RDCE{yy}{mm_pair[1]}', output=os.path.join(output, f"cityfluxnet_noverlap_{yy}{mm_pair[0]}_{yy}{mm_pair[1]}.gml"))
-
-years_ = [ f'{n:2.0f}'.replace(" ", "0") for n in range(10, 24+1) ]
-months_ = [ f'{n:2.0f}'.replace(" ", "0") for n in range(1, 12+1) ]
-yy_left, yy_right = 0, 0
-mm_left, mm_right = 0, 0+2
-
-init_left = f'{years_[yy_left]}{months_[mm_left]}'
-init_right = f'{years_[yy_right]}{months_[mm_right]}'
-while init_right!='2401':
-    print(f'({init_left} - {init_right})')
-    futils.create_citynet(sihpath, cnes_df, geodata_df, f'RDCE{init_left}', f'RDCE{init_right}', output=os.path.join(output, f"cityfluxnet_{init_left}_{init_right}.gml"))
-
-    mm_left+=1
-    mm_right+=1
-    if mm_right>11:
-        mm_right = 0
-        yy_right+=1
-    if mm_left>11:
-        mm_left = 0
-        yy_left+=1
-
-    init_left = f'{years_[yy_left]}{months_[mm_left]}'
-    init_right = f'{years_[yy_right]}{months_[mm_right]}'
-
-# -- city to hospital net (bipartite)
-    
-# ---- larger agg
-futils.create_cityhospitalnet(sihpath, cnes_df, geodata_df, f'RDCE1301', f'RDCE2212', output=os.path.join(output, f"citytohospitalnet_agg_1301_2212.gml"))
-futils.create_cityhospitalnet(sihpath, cnes_df, geodata_df, f'RDCE1801', f'RDCE2212', output=os.path.join(output, f"citytohospitalnet_agg_1801_2212.gml"))
-futils.create_cityhospitalnet(sihpath, cnes_df, geodata_df, f'RDCE1801', f'RDCE2306', output=os.path.join(output, f"citytohospitalnet_agg_1801_2306.gml"))
-futils.create_cityhospitalnet(sihpath, cnes_df, geodata_df, f'RDCE2001', f'RDCE2212', output=os.path.join(output, f"citytohospitalnet_agg_2001_2212.gml"))
-futils.create_cityhospitalnet(sihpath, cnes_df, geodata_df, f'RDCE2001', f'RDCE2306', output=os.path.join(output, f"citytohospitalnet_agg_2001_2306.gml"))
-
-# ---- per year
-for yy in [f'{n}' for n in range(10, 23+1)]:
-    futils.create_cityhospitalnet(sihpath, cnes_df, geodata_df, f'RDCE{yy}01', f'RDCE{yy}12', output=os.path.join(output, f"citytohospitalnet_agg_{yy}01_{yy}12.gml"))
-
-# ---- temporal without overlap
-for yy in [f'{n}' for n in range(10, 23+1)]:
-    for mm_pair in [('01', '03'), ('04', '06'), ('07', '09'), ('10', '12')]:
-        futils.create_cityhospitalnet(sihpath, cnes_df, geodata_df, f'RDCE{yy}{mm_pair[0]}', f'RDCE{yy}{mm_pair[1]}', output=os.path.join(output, f"citytohospitalnet_noverlap_{yy}{mm_pair[0]}_{yy}{mm_pair[1]}.gml"))
-
-years_ = [ f'{n:2.0f}'.replace(" ", "0") for n in range(10, 23+1) ]
-months_ = [ f'{n:2.0f}'.replace(" ", "0") for n in range(1, 12+1) ]
-yy_left, yy_right = 0, 0
-mm_left, mm_right = 0, 0+2
-
-init_left = f'{years_[yy_left]}{months_[mm_left]}'
-init_right = f'{years_[yy_right]}{months_[mm_right]}'
-while init_right!='2312':
-    print(f'({init_left} - {init_right})')
-    futils.create_cityhospitalnet(sihpath, cnes_df, geodata_df, f'RDCE{init_left}', f'RDCE{init_right}', output=os.path.join(output, f"citytohospitalnet_{init_left}_{init_right}.gml"))
-
-    mm_left+=1
-    mm_right+=1
-    if mm_right>11:
-        mm_right = 0
-        yy_right+=1
-    if mm_left>11:
-        mm_left = 0
-        yy_left+=1
-
-    init_left = f'{years_[yy_left]}{months_[mm_left]}'
-    init_right = f'{years_[yy_right]}{months_[mm_right]}'
+def network_jobs(output):
+    '''
+        Networks of fixed windows (builder, periods, options, output file).
+    '''
+    jobs = []
+    for builder, prefix in [('citynet', 'cityfluxnet'), ('cityhospitalnet', 'citytohospitalnet')]:
+        # ---- larger agg
+        for init, final in [('1301', '2212'), ('1801', '2212'), ('1801', '2306'), ('2001', '2212'), ('2001', '2306')]:
+            jobs.append( (builder, (f'RDCE{init}', f'RDCE{final}'), {}, os.path.join(output, f"{prefix}_agg_{init}_{final}.gml")) )
+            # ---- larger agg with self edges
+            if builder=='citynet':
+                jobs.append( (builder, (f'RDCE{init}', f'RDCE{final}'), {'self_edges': True}, os.path.join(output, f"{prefix}_agg_self_{init}_{final}.gml")) )
+
+        # ---- per year
+        for yy in [f'{n}' for n in range(10, 23+1)]:
+            jobs.append( (builder, (f'RDCE{yy}01', f'RDCE{yy}12'), {}, os.path.join(output, f"{prefix}_agg_{yy}01_{yy}12.gml")) )
+
+        # ---- temporal without overlap
+        for yy in [f'{n}' for n in range(10, 23+1)]:
+            for mm_pair in [('01', '03'), ('04', '06'), ('07', '09'), ('10', '12')]:
+                jobs.append( (builder, (f'RDCE{yy}{mm_pair[0]}', f'RDCE{yy}{mm_pair[1]}'), {}, 
+                              os.path.join(output, f"{prefix}_noverlap_{yy}{mm_pair[0]}_{yy}{mm_pair[1]}.gml")) )
+    return jobs
+
+if __name__ == "__main__":
+    # -- open the three main datasets: cnes, ceará geodata, sihsus.
+    basepath = os.path.join(os.environ["HOMEPATH"], "Documents", "data")
+    cnespath = os.path.join(basepath, "opendatasus", "cnes")
+    sihpath = os.path.join(basepath, "opendatasus", "sihsus", "PARQUET")
+    geopath = os.path.join(basepath, "shapefilesceqgis")
+    output = os.path.join(basepath, "redes_aih", "novo_completo")
+
+    cnes_df = pd.read_parquet(os.path.join(cnespath, "cnes_st_0801_2312.parquet"))
+    geodata_df = gpd.read_parquet(os.path.join(geopath, "ce_geodata.parquet"))
+
+    # -- monthly fluxes, aggregated once and kept between runs: every window below
+    # -- is built by summing the months of the cube (only new months are aggregated).
+    cubes = {}
+    for target, cube_name in [("MUNIC_MOV", "fluxcube_city.parquet"), ("CNES", "fluxcube_cityhospital.parquet")]:
+        cube_path = os.path.join(output, cube_name)
+        cube = FluxCube.read_parquet(cube_path) if os.path.isfile(cube_path) else FluxCube(target)
+        cubes[target] = cube.update(sihpath, 'RDCE1001', 'RDCE2412').to_parquet(cube_path)
+    citycube, hospitalcube = cubes["MUNIC_MOV"], cubes["CNES"]
+
+    # -- networks of fixed windows, built in parallel
+    report = futils.run_network_jobs(network_jobs(output), cubes, cnes_df, geodata_df)
+    print(report["status"].value_counts().to_string())
+    for _, row in report[report["status"]=='failed'].iterrows():
+        print(f'{row["output"]}: {row["error"]}')
+
+    # -- city net: sliding window of three months
+    for init, final, cityflux in CityFlux(cnes_df, geodata_df).rolling(citycube, 'RDCE1001', 'RDCE2312', window=3, step=1, multilayer_icd=True):
+        init_left, init_right = str(init)[2:], str(final)[2:]
+        print(f'({init_left} - {init_right})')
+        cityflux.to_gml(os.path.join(output, f"cityfluxnet_{init_left}_{init_right}.gml"))
+
+    # -- city to hospital net (bipartite): sliding window of three months
+    for init, final, cityhospitalflux in CityHospitalFlux(cnes_df, geodata_df).rolling(hospitalcube, 'RDCE1001', 'RDCE2311', window=3, step=1, multilayer_icd=True):
+        init_left, init_right = str(init)[2:], str(final)[2:]
+        print(f'({init_left} - {init_right})')
+        cityhospitalflux.to_gml(os.path.join(output, f"citytohospitalnet_{init_left}_{init_right}.gml"))
@@ -4,32 +4,19 @@ sys.path.append("..")
 
 import pandas as pd
 import datetime as dt
-from datetime import timedelta
 
 import geopandas as gpd
 from fluxsus.fluxnets.fluxnets import CityFlux, CityHospitalFlux
+from fluxsus.fluxnets.snapshots import SnapshotIndex
 
-def create_snapshots_citynet(cnes_df, geodata_df, dt_inicial, dt_final, sihpath, output):
+def snapshot_index(sihpath, dt_inicial, dt_final):
     '''
-    
+        Index the admissions of the yearly SIHSUS files covering the period by day 
+        of admission (DT_INTER), reading each file only once.
     '''
-    year_init = dt_inicial.year
-    year_final = dt_final.year
-    year_range = range(year_init-1, year_final+2, 1)
-
-    sih_df = []
-    for year in year_range:
-        try:
-            cur_df = pd.read_parquet(os.path.join(sihpath, f"RDCE_{year}.parquet"))
-            cur_df = cur_df[(cur_df["DT_INTER"]>=dt_inicial) & (cur_df["DT_INTER"]<=dt_final)]
-            sih_df.append( cur_df )
-        except:
-            pass
-    sih_df = pd.concat(sih_df)
-
-    # -- generate network
-    cityflux = CityFlux(cnes_df, geodata_df)
-    cityflux.define_network().calculate_fluxes(sih_df).to_gml(output)
+    files = [ os.path.join(sihpath, f"RDCE_{year}.parquet") for year in range(dt_inicial.year-1, dt_final.year+2) ]
+    files = [ fname for fname in files if os.path.isfile(fname) ]
+    return SnapshotIndex.from_parquet(files, target="MUNIC_MOV", date_col="DT_INTER")
 
 # -------------- network creation --------------
 
@@ -50,24 +37,11 @@ start = dt.datetime(2008, 1, 1)
 end = dt.datetime(2022, 12, 31)
 delta = 90 # aggregated network over 90 days
 
-last = start
-timelst = []
-while last<end:
-    timelst.append(last)
-    last += timedelta(days=delta)
-if last!=end: timelst.append(end)
-
-# -- create networks for the periods defined
-for time_index in range(len(timelst)-1):
-    dt_inicial = timelst[time_index]
-    dt_final = timelst[time_index+1]
+# -- consecutive windows [t, t+delta] (sharing their last day with the next one)
+sih_index = snapshot_index(sihpath, start, end)
+for dt_inicial, dt_final, cityflux in CityFlux(cnes_df, geodata_df).snapshots(sih_index, start, end, length=delta+1, stride=delta):
+    dt_inicial, dt_final = pd.Timestamp(dt_inicial), pd.Timestamp(dt_final)
     print(dt_inicial, dt_final)
 
     fname = os.path.join(output, f"citynet_allicd_{dt_inicial.strftime('%Y-%m-%d')}_{dt_final.strftime('%Y-%m-%d')}.gml")
-    create_snapshots_citynet(cnes_df, geodata_df, dt_inicial, dt_final, sihpath, fname)
-
-
-
-
-
-
+    cityflux.to_gml(fname)
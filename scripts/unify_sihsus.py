@@ -5,11 +5,26 @@ sys.path.append("..")
 from pathlib import Path
 import pandas as pd
 from fluxsus.DBFIX import DBFIX
-
-def sihsus_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, output_path: str):
+from fluxsus.preprocessing.convert import convert_batch
+from fluxsus.schemas import RD_SCHEMA, ATD_SCHEMA
+
+# -- fields used by the network builders (fluxsus.fluxnets)
+SELECTED_FIELDS = [
+    'ESPEC', 'N_AIH', 'CNES', 'IDENT', 'MUNIC_RES', 'MARCA_UTI', 
+    'VAL_SH', 'VAL_SP', 'VAL_TOT', 'VAL_UTI', 'DT_INTER', 'DT_SAIDA', 
+    'DIAG_PRINC', 'DIAG_SECUN', 'COBRANCA', 'NATUREZA', 'GESTAO', 'MUNIC_MOV', 
+    'MORTE', 'COMPLEX', 'ANO_CMPT', 'MES_CMPT', 'IDADE', 'COD_IDADE', 'UTI_MES_TO'
+]
+
+def sihsus_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, output_path: str, columns=None, 
+                      chunksize=100000, row_group_size=None):
     '''
         Convert SIHSUS DBF file to parquet for fast throughput.
 
+        The file is converted in chunks of records, so memory usage does not
+        depend on the size of the DBF file. Fields are stored with the types
+        of fluxsus.schemas.RD_SCHEMA (codes as categories, dates as dates).
+
         Args:
         -----
             dbf_fname:
@@ -18,23 +33,29 @@ def sihsus_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, outp
                 String. Complete path to the DBF file.
             output_path:
                 ...
+            columns:
+                List of Strings. Fields to read from the DBF file (e.g. 
+                SELECTED_FIELDS). Only these columns are decoded. Default 
+                None, which keeps all fields.
+            chunksize:
+                Integer. Number of records decoded at a time.
+            row_group_size:
+                Integer. Number of records per parquet row group. Default None,
+                which writes one row group per chunk.
     '''
-    selected_fields = [
-        'ESPEC', 'N_AIH', 'CNES', 'IDENT', 'MUNIC_RES', 'MARCA_UTI', 
-        'VAL_SH', 'VAL_SP', 'VAL_TOT', 'VAL_UTI', 'DT_INTER', 'DT_SAIDA', 
-        'DIAG_PRINC', 'DIAG_SECUN', 'COBRANCA', 'NATUREZA', 'GESTAO', 'MUNIC_MOV', 
-        'MORTE', 'COMPLEX', 'ANO_CMPT', 'MES_CMPT'
-    ]
-    sih_df = DBFIX( os.path.join(path_to_file, dbf_fname), codec='latin' ).to_dataframe()
-    sih_df["DT_INTER"] = pd.to_datetime(sih_df["DT_INTER"], format="%Y%m%d", errors="coerce")
-    sih_df["DT_SAIDA"] = pd.to_datetime(sih_df["DT_SAIDA"], format="%Y%m%d", errors="coerce")
-    #sih_df[selected_fields].to_parquet(os.path.join(output_path, output_fname))
-    sih_df.to_parquet(os.path.join(output_path, output_fname))
+    dbf = DBFIX( os.path.join(path_to_file, dbf_fname), codec='latin', columns=columns )
+    dbf.to_parquet(os.path.join(output_path, output_fname), chunksize=chunksize, 
+                   row_group_size=row_group_size, schema=RD_SCHEMA)
 
-def siasus_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, output_path: str):
+def siasus_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, output_path: str, 
+                      chunksize=100000, row_group_size=None):
     '''
         Convert SIASUS DBF file to parquet for fast throughput.
 
+        The file is converted in chunks of records, so memory usage does not
+        depend on the size of the DBF file. Fields are stored with the types
+        of fluxsus.schemas.ATD_SCHEMA.
+
         Args:
         -----
             dbf_fname:
@@ -43,11 +64,15 @@ def siasus_to_parquet(dbf_fname: str, path_to_file: str, output_fname: str, outp
                 String. Complete path to the DBF file.
             output_path:
                 ...
+            chunksize:
+                Integer. Number of records decoded at a time.
+            row_group_size:
+                Integer. Number of records per parquet row group. Default None,
+                which writes one row group per chunk.
     '''
-    sih_df = DBFIX( os.path.join(path_to_file, dbf_fname), codec='latin' ).to_dataframe()
-    #sih_df["DT_INTER"] = pd.to_datetime(sih_df["DT_INTER"], format="%Y%m%d", errors="coerce")
-    #sih_df["DT_SAIDA"] = pd.to_datetime(sih_df["DT_SAIDA"], format="%Y%m%d", errors="coerce")
-    sih_df.to_parquet(os.path.join(output_path, output_fname))
+    dbf = DBFIX( os.path.join(path_to_file, dbf_fname), codec='latin' )
+    dbf.to_parquet(os.path.join(output_path, output_fname), chunksize=chunksize, 
+                   row_group_size=row_group_size, schema=ATD_SCHEMA)
 
 def export_sihsus_year(uf : str, year : int, path_to_files : str):
     '''
@@ -112,12 +137,14 @@ if __name__=="__main__":
     uf_centro = ['GO', 'MS', 'MT', 'DF']
     uf_norte = ['AM', 'PA', 'AC', 'RR', 'RO', 'AP', 'TO']
 
+    # -- only new or changed files are converted (see the manifest in the output folder)
     for uf in uf_centro+uf_norte+uf_ne+uf_sudeste+uf_sul:
-        subset_files = [ fname for fname in dbf_files if uf in fname.stem ]
-        for fname in subset_files:
-            print(f'Arquivo {fname.name} ... ', end='')
-            sihsus_to_parquet(fname.stem+'.DBF', input_folder, fname.stem+'.parquet', output_folder)
-            print(f'feito.')
+        subset_files = [ str(fname) for fname in dbf_files if uf in fname.stem ]
+        report = convert_batch(subset_files, str(output_folder), columns=SELECTED_FIELDS, 
+                               schema=RD_SCHEMA)
+        print(f'{uf}: {report["status"].value_counts().to_dict()}')
+        for _, row in report[report["status"]=="failed"].iterrows():
+            print(f'Arquivo {row["source"]} falhou: {row["error"]}')
     
     
     #for uf in uf_centro+uf_norte: